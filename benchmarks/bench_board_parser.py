@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""Board index parsing benchmark for Wakaba and IichanRu:
+single tree parser against the old split-and-reparse one.
+Pages are built from the test fixtures with real board
+index size (10 threads with a few replies each).
+
+Usage: python benchmarks/bench_board_parser.py
+"""
+
+import os
+import sys
+import time
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, ".")
+from lxml import etree
+from lxml.builder import E
+from parsers.wakaba import Wakaba
+from parsers.iichan_ru import IichanRu
+from etree_wakaba import ETreeWakaba, ETreeIichanRu
+
+
+ROUNDS = 20
+# Best of repeats is reported.
+REPEATS = 5
+THREADS = 10
+REPLIES = 5
+
+
+class _LegacyBoard(object):
+    """task_board which splits page by <hr /> and parses
+    every thread as separate document.
+    """
+
+    def task_board(self, task):
+        data = task["_data"].decode("utf-8")
+        nodes = [etree.HTML(thr) for thr in data.split("<hr />")[2:-1]]
+        threads = []
+        is_first = True
+        for node in nodes:
+            thread = self._get_legacy_thread_node(node, is_first)
+            is_first = False
+            thread_id = self._get_post_id(thread)
+            (text, xhtml) = self._parse_post(
+                thread, task, is_op_post=True, show_images=False,
+                render_xhtml=False, thread_id=thread_id)
+            xhtml = E.span(E.br(), self._HR, E.br(), xhtml)
+            posts = thread.findall(".//td[@class='reply']")
+            if posts:
+                omitted_node = thread.find("span[@class='omittedposts']")
+                if omitted_node is None:
+                    omitted_text = ""
+                    omitted_xhtml = E.br()
+                else:
+                    omitted = omitted_node.text
+                    omitted = omitted[:omitted.find(".")+1].strip()
+                    omitted_text = u"\n\n/%s/" % omitted
+                    omitted_xhtml = E.span(
+                        E.br(), E.br(), omitted, E.br(),
+                        style="color: #707070;")
+                (text2, xhtml2) = self._parse_post(
+                    posts[-1], task, show_images=False,
+                    render_xhtml=False, thread_id=thread_id)
+                text += omitted_text + "\n\n" + text2
+                xhtml.extend((omitted_xhtml, xhtml2))
+            threads.insert(0, (text, self._to_s(xhtml)))
+        if threads:
+            threads.insert(
+                0, (self._HR2, self._to_s(E.span(E.br(), self._HR2))))
+        return {"threads": threads}
+
+
+class LegacyWakaba(_LegacyBoard, ETreeWakaba):
+
+    def _get_legacy_thread_node(self, node, is_first):
+        return node.find("body/form" if is_first else "body")
+
+
+class LegacyIichanRu(_LegacyBoard, ETreeIichanRu):
+
+    def _get_legacy_thread_node(self, node, is_first):
+        return node.find("body/form/div" if is_first else "body/div")
+
+
+def get_page(fixture):
+    with open(os.path.join("tests", "fixtures", fixture), "rb") as f:
+        page = f.read()
+    # Replicate the thread with omitted posts and its
+    # replies to get the usual index page.
+    start = page.index('<form id="delform"')
+    start = page.index(">", start) + 1
+    end = page.index("<hr />", start) + len("<hr />")
+    thread = page[start:end]
+    reply_start = thread.index("<table>")
+    reply_end = thread.index("</table>", reply_start) + len("</table>")
+    reply = thread[reply_start:reply_end]
+    thread = (thread[:reply_start] + reply * REPLIES +
+              thread[reply_end:])
+    return page[:start] + thread * THREADS + page[end:]
+
+
+def run(name, parser, page):
+    task = {"type": "board", "host": "nyak.ru",
+            "url": "http://nyak.ru/b/", "_data": page}
+    return timed(parser, task)
+
+
+def timed(parser, task):
+    best = None
+    for i in xrange(REPEATS):
+        start = time.time()
+        for j in xrange(ROUNDS):
+            res = parser.do_task(task.copy())
+        elapsed = (time.time() - start) / ROUNDS * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, res
+
+
+def main():
+    for name, parser, legacy, fixture in (
+        ("Wakaba", Wakaba(), LegacyWakaba(), "wakaba_board.html"),
+        ("IichanRu", IichanRu(), LegacyIichanRu(),
+         "iichan_ru_board.html"),
+    ):
+        page = get_page(fixture)
+        print "%s page: %d bytes" % (name, len(page))
+        elapsed, res = run(name, parser, page)
+        legacy_elapsed, legacy_res = run(name, legacy, page)
+        assert res == legacy_res
+        print "%-10s %8.2f ms/page (legacy: %.2f ms/page)" % (
+            name, elapsed, legacy_elapsed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""Delivery of one post to 1000 subscribers: serialize-once
+fan-out (XMPPComponent.send_post) against message per
+subscriber (send_message). Both paths end with the bytes
+xmlstream writes; pacing is off.
+
+Needs the same environment as the gate itself (gate.cfg,
+lxml, txmongo). Usage: python benchmarks/bench_fanout.py
+"""
+
+import os
+import re
+import sys
+import time
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, ".")
+from parsers.wakaba import Wakaba
+from post_renderer import RenderedPost
+from fanout import Fanout
+from stanza_queue import StanzaQueue
+from xmpp_component import XMPPComponent
+
+
+SUBSCRIBERS = 1000
+_ATTR = re.compile(r"\w+='[^']*'")
+# Best of repeats is reported.
+REPEATS = 5
+
+
+class _Transport(object):
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+
+def get_post():
+    with open("tests/fixtures/wakaba_thread.html", "rb") as f:
+        page = f.read()
+    wakaba = Wakaba()
+    parsed = wakaba.do_task({
+        "type": "thread_updates", "host": "nyak.ru",
+        "url": "http://nyak.ru/b/res/100.html",
+        "last": 101, "_data": page})
+    # Post with image, several blocks and markup.
+    return wakaba.renderer, parsed["updates"][0]
+
+
+def get_component(out):
+    def write(stanza):
+        # The same as xmlstream.send does.
+        if not isinstance(stanza, basestring):
+            stanza = stanza.toXml()
+        out.append(stanza.encode("utf-8"))
+    xmpp = XMPPComponent()
+    xmpp._queue = StanzaQueue(write, rate=10**9, burst=10**9)
+    xmpp._queue.attach(_Transport())
+    xmpp._fanout = Fanout(xmpp._queue.put, "gate.example.com")
+    return xmpp
+
+
+def normalize(stanza):
+    """Return stanza with sorted attributes of the start tag;
+    domish writes them in dict order.
+    """
+    start, rest = stanza.split(">", 1)
+    name, attrs = start.split(" ", 1)
+    return name, sorted(_ATTR.findall(attrs)), rest
+
+
+def timed(fn):
+    best = None
+    for i in xrange(REPEATS):
+        out = []
+        xmpp = get_component(out)
+        start = time.time()
+        fn(xmpp)
+        elapsed = time.time() - start
+        # Multicast discovery queries of subscribers' servers.
+        out = [stanza for stanza in out if not stanza.startswith("<iq")]
+        best = elapsed if best is None else min(best, elapsed)
+    return best, out
+
+
+def main():
+    renderer, post = get_post()
+    jids = ["user%d@server%d.org" % (i, i % 20) for i in xrange(SUBSCRIBERS)]
+    from_ = "nyak.ru_b_100@gate.example.com/gate"
+
+    def per_message(xmpp):
+        text, xhtml = renderer.render_post(post)
+        for jid in jids:
+            xmpp.send_message(
+                to=jid, from_=from_, body=text, body_xhtml=xhtml)
+
+    def fanout(xmpp):
+        xmpp.send_post(jids, from_, RenderedPost(renderer, post))
+
+    legacy_elapsed, legacy_out = timed(per_message)
+    elapsed, out = timed(fanout)
+    assert map(normalize, out) == map(normalize, legacy_out)
+    print "1 post x %d subscribers, %d bytes/stanza" % (
+        SUBSCRIBERS, len(out[0]))
+    print "fan-out:             %7.2f ms (%.1f us/stanza)" % (
+        elapsed * 1000, elapsed / SUBSCRIBERS * 10**6)
+    print "message per user:    %7.2f ms (%.1f us/stanza)" % (
+        legacy_elapsed * 1000, legacy_elapsed / SUBSCRIBERS * 10**6)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+"""Per-post field extraction benchmark: Wakaba._parse_post
+against the old find/if-chain implementation. Corpus is
+every post of the thread and board fixtures. Rendering is
+included; the old implementation uses lxml tree renderer.
+
+Usage: python benchmarks/bench_parse_post.py
+"""
+
+import os
+import sys
+import time
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, ".")
+from lxml import etree
+from lxml.builder import E
+from parsers.wakaba import Wakaba
+from etree_wakaba import ETreeWakaba
+
+
+ROUNDS = 200
+# Best of repeats is reported.
+REPEATS = 5
+
+
+class LegacyWakaba(ETreeWakaba):
+
+    def _parse_post(self, post_node, task,
+                    is_op_post=False, show_images=True,
+                    render_xhtml=True, thread_id=None):
+        post = {}
+        label = post_node.find("label")
+        if is_op_post:
+            title_class = "filetitle"
+        else:
+            title_class = "replytitle"
+        title = label.find("span[@class='%s']" % title_class)
+        if title is None:
+            post["title"] = ""
+        else:
+            post["title"] = title.text
+        if is_op_post:
+            author_node_class = "postername"
+        else:
+            author_node_class = "commentpostername"
+        author_node = label.find("span[@class='%s']" % author_node_class)
+        author_email_node = author_node.find("a")
+        if author_email_node is None:
+            post["author_email"] = ""
+            post["author_name"] = author_node.text
+        else:
+            post["author_email"] = author_email_node.get("href")
+            post["author_name"] = author_email_node.text
+        if not post["author_name"]:
+            post["author_name"] = ""
+        trip_node = label.find("span[@class='postertrip']")
+        if trip_node is None:
+            post["trip_text"] = ""
+            post["trip_email"] = ""
+            post["date"] = author_node.tail.strip()
+        else:
+            trip_email_node = trip_node.find("a")
+            if trip_email_node is None:
+                post["trip_text"] = trip_node.text
+                post["trip_email"] = ""
+            else:
+                post["trip_text"] = trip_email_node.text
+                post["trip_email"] = trip_email_node.get("href")
+            post["date"] = trip_node.tail.strip()
+        post["id"] = post_node.find("a[@name]").get("name")
+        filesize_node = post_node.find("span[@class='filesize']")
+        if filesize_node is None:
+            post["img_src"] = ""
+        else:
+            em_node = filesize_node.find("em")
+            # TODO: parse it right.
+            if em_node is None:
+                post["img_src"] = ""
+            else:
+                host = "http://" + task["host"]
+                img_a = filesize_node.find("a")
+                post["img_src"] = host + img_a.get("href")
+                post["img_name"] = img_a.text
+                post["img_size"] = em_node.text
+                img_thumb = post_node.find(".//img[@class='thumb']")
+                post["img_thumb_src"] = host + img_thumb.get("src")
+        # Body
+        post_body_node = post_node.find("blockquote")
+        body = []
+        post["body_xhtml"] = E.span()
+        for node in post_body_node:
+            s = ""
+            tag = E.span()
+            if (node.tag == "blockquote" and
+                node.get("class") == "unkfunc"):
+                tag.set("style", "color: #789922;")
+            elif (node.tag == "div" and
+                  node.get("class") == "abbrev"):
+                tag.set("style", "color: #707070;")
+            elif node.tag == "pre":
+                tag.set("style", "font-family: monospace;")
+                node = node[0]
+            # Should be E.p() without additional brs but
+            # xmpp clients processing it incorrect.
+            tag.extend((E.br(), E.br()))
+            if node.text:
+                s += node.text
+                tag[-1].tail = node.text
+            # TODO: <strong><em>bold and italic</em></strong>
+            # TODO: ul, ol
+            for child in node:
+                if child.tag == "a":
+                    s += child.text
+                    url = child.get("href")
+                    if url.startswith("/"):
+                        url = "http://" + task["host"] + url
+                    tag.append(E.a(child.text, href=url))
+                elif child.tag == "br":
+                    s += "\n"
+                    tag.append(E.br())
+                elif child.tag == "strong":
+                    s += "*%s*" % child.text
+                    tag.append(
+                        E.span(child.text, style="font-weight: bold;"))
+                elif child.tag == "em":
+                    # TODO: baaaad hack, fix it!
+                    if child.text is None:
+                        child.text = ""
+                    s += "/%s/" % child.text
+                    tag.append(
+                        E.span(child.text, style="font-style: italic;"))
+                elif child.tag == "del":
+                    s += "-%s-" % child.text
+                    tag.append(E.span(
+                        child.text,
+                        style="text-decoration: line-through;"))
+                elif child.tag == "code":
+                    s += child.text
+                    tag.append(
+                        E.span(child.text, style="font-family: monospace;"))
+                elif child.tag == "span" and child.get("class") == "spoiler":
+                    s += "%%%%%s%%%%" % child.text
+                    tag.append(E.span(
+                        child.text,
+                        style="color: #F0D0B6; background-color: #F0D0B6;"))
+                if child.tail:
+                    s += child.tail
+                    tag[-1].tail = child.tail
+            body.append(s)
+            post["body_xhtml"].append(tag)
+        post["body"] = u"\n\n".join(body)
+        return self._format_post(
+            post, task, show_images, render_xhtml, thread_id)
+
+
+def get_corpus():
+    """Return list of (post node, is_op_post)."""
+    corpus = []
+    for fixture in ("wakaba_thread.html", "wakaba_board.html"):
+        with open(os.path.join("tests", "fixtures", fixture), "rb") as f:
+            tree = etree.HTML(f.read(), Wakaba._utf8_parser)
+        if fixture == "wakaba_thread.html":
+            threads = [tree.find(".//form[@id='delform']")]
+        else:
+            threads = Wakaba()._get_thread_groups(tree)
+        for thread in threads:
+            corpus.append((thread, True))
+            for post in thread.iterfind(".//td[@class='reply']"):
+                corpus.append((post, False))
+    return corpus
+
+
+def parse_post(parser, node, task, is_op):
+    """Return (text, xhtml) of the post."""
+    post = parser._parse_post(node, task, is_op_post=is_op)
+    if isinstance(post, dict):
+        # Post record of the current parser.
+        post = parser.renderer.render_post(post)
+    return post
+
+
+def timed(parser, corpus, task):
+    best = None
+    for i in xrange(REPEATS):
+        start = time.time()
+        for j in xrange(ROUNDS):
+            res = [
+                parse_post(parser, node, task, is_op)
+                for node, is_op in corpus]
+        elapsed = (time.time() - start) / ROUNDS / len(corpus) * 10**6
+        best = elapsed if best is None else min(best, elapsed)
+    return best, res
+
+
+def main():
+    task = {"host": "nyak.ru", "url": "http://nyak.ru/b/res/100.html"}
+    # Legacy implementation changes nodes (empty <em> text)
+    # so every implementation gets its own corpus.
+    elapsed, res = timed(Wakaba(), get_corpus(), task)
+    legacy_elapsed, legacy_res = timed(LegacyWakaba(), get_corpus(), task)
+    assert res == legacy_res
+    print "%d posts: %.1f us/post (legacy: %.1f us/post)" % (
+        len(res), elapsed, legacy_elapsed)
+
+
+if __name__ == "__main__":
+    main()
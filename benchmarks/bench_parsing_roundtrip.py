@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Round-trip latency of tasks sent through ParsingProtocol
+to the real parsing_worker.py process.
+
+Needs the same environment as the gate itself (gate.cfg,
+lxml). Usage: python benchmarks/bench_parsing_roundtrip.py
+"""
+
+import os
+import sys
+import time
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, ".")
+from twisted.internet import defer, reactor
+from parsing_protocol import ParsingProtocol
+
+
+ROUNDS = 2000
+
+
+class _Reporter(object):
+
+    def send_message(self, to, from_, body):
+        print body
+
+
+def report(name, count, elapsed):
+    print "%-36s %8.1f us/task %8.0f tasks/s" % (
+        name, elapsed / count * 10**6, count / elapsed)
+
+
+@defer.inlineCallbacks
+def run():
+    worker = ParsingProtocol(_Reporter())
+    worker.start()
+    # Task without handler: measures pure round trip.
+    ping = {"parser": "wakaba", "type": "ping"}
+    with open("tests/fixtures/wakaba_thread.html", "rb") as f:
+        page = f.read()
+    thread = {
+        "parser": "wakaba", "type": "thread_updates",
+        "host": "nyak.ru", "url": "http://nyak.ru/b/res/100.html",
+        "last": 101,
+    }
+    # Warm up: wait for the worker to start.
+    yield worker.parse(ping, "")
+    for name, task, data in (
+        ("empty task", ping, ""),
+        ("thread page", thread, page),
+    ):
+        start = time.time()
+        for i in xrange(ROUNDS):
+            yield worker.parse(task, data)
+        report(name + ", sequential", ROUNDS, time.time() - start)
+        start = time.time()
+        yield defer.gatherResults([
+            worker.parse(task, data) for i in xrange(ROUNDS)])
+        report(name + ", pipelined", ROUNDS, time.time() - start)
+    worker.stop()
+
+
+def main():
+    d = run()
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
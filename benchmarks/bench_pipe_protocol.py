@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""PipeProtocol decoding benchmark.
+
+Worker side receives multi-megabyte pages in small pipe
+reads; ParsingProtocol side receives many small results in
+one read. Both are measured for the current implementation
+and the old ASCII-prefixed one.
+
+Usage: python benchmarks/bench_pipe_protocol.py
+"""
+
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from pipe_protocol import PipeProtocol
+
+
+class LegacyPipeProtocol(object):
+    """<packet length>|<packet> framing with string slicing."""
+
+    def __init__(self):
+        self._data = ""
+        self._len = None
+
+    def decode(self, data):
+        packets = []
+        self._data += data
+        while True:
+            if self._len is None:
+                pos = self._data.find("|")
+                if pos == -1: break
+                self._len = int(self._data[:pos])
+                self._data = self._data[pos+1:]
+            if len(self._data) >= self._len:
+                packet = self._data[:self._len]
+                self._data = self._data[self._len:]
+                self._len = None
+                packets.append(packet)
+            else:
+                break
+        return packets
+
+    def encode(self, packet):
+        return str(len(packet)) + "|" + packet
+
+
+def chunks(data, size):
+    return [data[i:i+size] for i in xrange(0, len(data), size)]
+
+
+def encode(proto, packet):
+    if isinstance(proto, PipeProtocol):
+        # Packet goes as the raw payload; encode returns
+        # chunks which are written in order.
+        return "".join(proto.encode({}, packet))
+    return proto.encode(packet)
+
+
+def run(name, label, cls, packets, read_size):
+    data = "".join([encode(cls(), p) for p in packets])
+    reads = chunks(data, read_size)
+    proto = cls()
+    start = time.time()
+    count = 0
+    for read in reads:
+        count += len(proto.decode(read))
+    elapsed = time.time() - start
+    assert count == len(packets)
+    print "%-40s %-8s %8.1f ms %8.1f MB/s" % (
+        name, label, elapsed * 1000,
+        len(data) / elapsed / 2**20)
+
+
+def main():
+    page = "<td class=\"reply\">nyak</td>\n" * (4 * 2**20 / 28)
+    small = ["x" * 200] * 20000
+    cases = [
+        ("worker: 4MB page, 4KB reads", [page], 4096),
+        ("worker: 4MB page, 64KB reads", [page], 65536),
+        ("protocol: 20000x200B, one read", small, len(small) * 210),
+        ("protocol: 20000x200B, 64KB reads", small, 65536),
+    ]
+    for name, packets, read_size in cases:
+        run(name, "current", PipeProtocol, packets, read_size)
+        run(name, "legacy", LegacyPipeProtocol, packets, read_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Post rendering benchmark: template renderer against the
+old lxml tree one. Both share field extraction, so the
+difference is rendering. Corpus is every post of the thread
+and board fixtures; board index pages are timed too.
+
+Usage: python benchmarks/bench_post_renderer.py
+"""
+
+import os
+import sys
+import time
+os.chdir(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, ".")
+from parsers.wakaba import Wakaba
+from etree_wakaba import ETreeWakaba
+from bench_parse_post import get_corpus, parse_post
+from bench_board_parser import get_page
+
+
+ROUNDS = 200
+BOARD_ROUNDS = 20
+# Best of repeats is reported.
+REPEATS = 5
+
+
+def best_of(fn, rounds):
+    best = None
+    for i in xrange(REPEATS):
+        start = time.time()
+        for j in xrange(rounds):
+            res = fn()
+        elapsed = (time.time() - start) / rounds
+        best = elapsed if best is None else min(best, elapsed)
+    return best, res
+
+
+def main():
+    task = {"host": "nyak.ru", "url": "http://nyak.ru/b/res/100.html"}
+    corpus = get_corpus()
+    results = []
+    for parser in (Wakaba(), ETreeWakaba()):
+        results.append(best_of(lambda: [
+            parse_post(parser, node, task, is_op)
+            for node, is_op in corpus], ROUNDS))
+    (elapsed, res), (legacy_elapsed, legacy_res) = results
+    assert res == legacy_res
+    print "%d posts: %.1f us/post (lxml tree: %.1f us/post)" % (
+        len(res), elapsed / len(res) * 10**6,
+        legacy_elapsed / len(res) * 10**6)
+    task = {"type": "board", "host": "nyak.ru", "url": "http://nyak.ru/b/",
+            "_data": get_page("wakaba_board.html")}
+    results = []
+    for parser in (Wakaba(), ETreeWakaba()):
+        results.append(best_of(
+            lambda: parser.do_task(task.copy()), BOARD_ROUNDS))
+    (elapsed, res), (legacy_elapsed, legacy_res) = results
+    assert res == legacy_res
+    print "board page: %.2f ms/page (lxml tree: %.2f ms/page)" % (
+        elapsed * 1000, legacy_elapsed * 1000)
+
+
+if __name__ == "__main__":
+    main()
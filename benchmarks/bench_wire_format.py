@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""Task and result serialization benchmark: JSON header with
+raw page or marshal records payload against the old cPickle
+protocol 2 packets.
+
+Usage: python benchmarks/bench_wire_format.py
+"""
+
+import os
+import sys
+import time
+import struct
+import cPickle
+import json
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from parsers.wakaba import Wakaba
+from pipe_protocol import PipeProtocol, pack_records, unpack_records
+
+
+ROUNDS = 200
+
+
+def pickle_encode(message, payload=""):
+    message = message.copy()
+    if payload:
+        message["_data"] = payload
+    packet = cPickle.dumps(message, protocol=2)
+    return [struct.pack(">I", len(packet)) + packet]
+
+
+def pickle_decode(data):
+    return cPickle.loads(data[4:])
+
+
+def get_fixture():
+    path = os.path.join(
+        os.path.dirname(__file__), "..", "tests", "fixtures",
+        "wakaba_thread.html")
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def get_task():
+    page = get_fixture()
+    # Typical thread page of a few hundred posts.
+    body_start = page.index("<table>")
+    body_end = page.rindex("</table>") + len("</table>")
+    page = (page[:body_start] +
+            page[body_start:body_end] * 150 +
+            page[body_end:])
+    task = {
+        "_id": 1, "parser": "wakaba", "type": "thread_updates",
+        "host": u"nyak.ru", "url": u"http://nyak.ru/b/res/100.html",
+        "jid": u"nyak.ru_b_100@example.com", "last": 101,
+        "last_modified": u"Sat, 01 Jan 2011 00:00:00 GMT",
+    }
+    return task, page
+
+
+def get_result():
+    """Return thread_updates result of 50 post records."""
+    parsed = Wakaba().do_task({
+        "type": "thread_updates", "host": "nyak.ru",
+        "url": "http://nyak.ru/b/res/100.html", "last": 100,
+        "_data": get_fixture()})
+    updates = []
+    while len(updates) < 50:
+        for post in parsed["updates"]:
+            # Distinct strings like in real records; pickle
+            # would memoize shared ones.
+            post = json.loads(json.dumps(post))
+            post["id"] = str(101 + len(updates))
+            updates.append(post)
+    return {"_id": 1, "last": 150, "offset": 123456,
+            "updates": updates[:50]}
+
+
+def timed(fn, *args):
+    start = time.time()
+    for i in xrange(ROUNDS):
+        res = fn(*args)
+    return (time.time() - start) / ROUNDS * 10**6, res
+
+
+def run(name, encode, decode):
+    # Encoded parts are written by writeSequence without
+    # joining so only decoding gets whole packet.
+    encode_time, parts = timed(encode)
+    decode_time, _ = timed(decode, "".join(parts))
+    print "%-32s encode %7.1f us  decode %7.1f us  %8d bytes" % (
+        name, encode_time, decode_time, sum(map(len, parts)))
+
+
+def main():
+    proto = PipeProtocol()
+    task, page = get_task()
+    result = get_result()
+    print "page size: %d bytes" % len(page)
+    run("task, cPickle",
+        lambda: pickle_encode(task, page), pickle_decode)
+    run("task, header + payload",
+        lambda: proto.encode(task, page), proto.decode)
+    run("result, cPickle",
+        lambda: pickle_encode(result), pickle_decode)
+    run("result, JSON records",
+        lambda: proto.encode(result), proto.decode)
+    run("result, marshal records",
+        lambda: proto.encode(*pack_records(result)),
+        lambda data: [unpack_records(*p) for p in proto.decode(data)])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+"""Wakaba with the old lxml tree post renderer. Benchmarks
+use it as the reference: output of the template renderer
+must be the same.
+"""
+
+from lxml import etree
+from lxml.builder import E
+from parsers.wakaba import Wakaba, _LABEL_SPANS, _POST_ID, _FILESIZE, \
+    _THUMB, _BODY
+from parsers.iichan_ru import IichanRu
+
+
+class ETreeWakaba(Wakaba):
+
+    _HR = Wakaba.renderer.HR
+    _HR2 = Wakaba.renderer.HR2
+
+    def task_board(self, task):
+        tree = etree.HTML(task["_data"], self._utf8_parser)
+        threads = []
+        for node in self._get_thread_groups(tree):
+            thread = self._get_thread_node(node)
+            thread_id = self._get_post_id(thread)
+            (text, xhtml) = self._parse_post(
+                thread, task, is_op_post=True, show_images=False,
+                render_xhtml=False, thread_id=thread_id)
+            xhtml = E.span(E.br(), self._HR, E.br(), xhtml)
+            posts = thread.findall(".//td[@class='reply']")
+            if posts:
+                omitted_node = thread.find("span[@class='omittedposts']")
+                if omitted_node is None:
+                    omitted_text = ""
+                    omitted_xhtml = E.br()
+                else:
+                    omitted = omitted_node.text
+                    omitted = omitted[:omitted.find(".")+1].strip()
+                    omitted_text = u"\n\n/%s/" % omitted
+                    omitted_xhtml = E.span(
+                        E.br(), E.br(), omitted, E.br(),
+                        style="color: #707070;")
+                (text2, xhtml2) = self._parse_post(
+                    posts[-1], task, show_images=False,
+                    render_xhtml=False, thread_id=thread_id)
+                text += omitted_text + "\n\n" + text2
+                xhtml.extend((omitted_xhtml, xhtml2))
+            threads.insert(0, (text, self._to_s(xhtml)))
+        # Add separator
+        if threads:
+            threads.insert(
+                0, (self._HR2, self._to_s(E.span(E.br(), self._HR2))))
+        return {"threads": threads}
+
+
+    def _get_post_id(self, post_node):
+        return int(post_node.find("a[@name]").get("name"))
+
+    def _parse_post(self, post_node, task,
+                    is_op_post=False, show_images=True,
+                    render_xhtml=True, thread_id=None):
+        post = {}
+        # Label spans by class; the first one wins.
+        spans = {}
+        for span in _LABEL_SPANS(post_node):
+            spans.setdefault(span.get("class"), span)
+        if is_op_post:
+            title = spans.get("filetitle")
+            author_node = spans["postername"]
+        else:
+            title = spans.get("replytitle")
+            author_node = spans["commentpostername"]
+        if title is None:
+            post["title"] = ""
+        else:
+            post["title"] = title.text
+        author_email_node = author_node.find("a")
+        if author_email_node is None:
+            post["author_email"] = ""
+            post["author_name"] = author_node.text
+        else:
+            post["author_email"] = author_email_node.get("href")
+            post["author_name"] = author_email_node.text
+        if not post["author_name"]:
+            post["author_name"] = ""
+        trip_node = spans.get("postertrip")
+        if trip_node is None:
+            post["trip_text"] = ""
+            post["trip_email"] = ""
+            post["date"] = author_node.tail.strip()
+        else:
+            trip_email_node = trip_node.find("a")
+            if trip_email_node is None:
+                post["trip_text"] = trip_node.text
+                post["trip_email"] = ""
+            else:
+                post["trip_text"] = trip_email_node.text
+                post["trip_email"] = trip_email_node.get("href")
+            post["date"] = trip_node.tail.strip()
+        post["id"] = _POST_ID(post_node)[0]
+        filesize_node = _FILESIZE(post_node)
+        if filesize_node:
+            em_node = filesize_node[0].find("em")
+        else:
+            em_node = None
+        # TODO: parse it right.
+        if em_node is None:
+            post["img_src"] = ""
+        else:
+            host = "http://" + task["host"]
+            img_a = filesize_node[0].find("a")
+            post["img_src"] = host + img_a.get("href")
+            post["img_name"] = img_a.text
+            post["img_size"] = em_node.text
+            img_thumb = _THUMB(post_node)[0]
+            post["img_thumb_src"] = host + img_thumb.get("src")
+        # Body
+        host = task["host"]
+        body = []
+        post["body_xhtml"] = body_xhtml = etree.Element("span")
+        for node in _BODY(post_node)[0]:
+            s = ""
+            tag = etree.SubElement(body_xhtml, "span")
+            style = _BLOCK_STYLES.get((node.tag, node.get("class")))
+            if style is not None:
+                tag.set("style", style)
+            elif node.tag == "pre":
+                tag.set("style", "font-family: monospace;")
+                node = node[0]
+            # Should be E.p() without additional brs but
+            # xmpp clients processing it incorrect.
+            etree.SubElement(tag, "br")
+            last = etree.SubElement(tag, "br")
+            if node.text:
+                s += node.text
+                last.tail = node.text
+            # TODO: <strong><em>bold and italic</em></strong>
+            # TODO: ul, ol
+            for child in node:
+                handler = _INLINE_HANDLERS.get(child.tag)
+                if handler is not None:
+                    text = handler(child, host, tag)
+                    if text is not None:
+                        s += text
+                        last = tag[-1]
+                if child.tail:
+                    s += child.tail
+                    last.tail = child.tail
+            body.append(s)
+        post["body"] = u"\n\n".join(body)
+        return self._format_post(
+            post, task, show_images, render_xhtml, thread_id)
+
+    def _format_post(self, post, task, show_images, render_xhtml, thread_id):
+        """Format post to text and xhtml representations."""
+        # Text formatting
+        if thread_id is None:
+            url = task["url"]
+        else:
+            url = "%sres/%d.html" % (task["url"], thread_id)
+        if str(thread_id) != post["id"]:
+            post_url = "%s#%s" %(url, post["id"])
+        else:
+            post_url = url
+        if post["title"]:
+            title = post["title"] + " "
+        else:
+            title = ""
+        if post["author_email"]:
+            email = " <%s>" % post["author_email"]
+        else:
+            email = ""
+        if post["img_src"]:
+            img = "\nFile: %s -(%s) <%s>" % (
+                post["img_name"], post["img_size"], post["img_src"])
+        else:
+            img = ""
+        if post["body"]:
+            body = "\n\n" + post["body"]
+        else:
+            body = ""
+        text = u"%s\n%s%s%s%s %s No.%s%s%s" % (
+            post_url, title, post["author_name"], post["trip_text"],
+            email, post["date"], post["id"], img, body)
+        # XHTML formatting
+        if post["title"]:
+            title = E.span(
+                post["title"], " ",
+                style="font-size: larger; font-weight: bold; color: #CC1105;")
+        else:
+            title = ""
+        if post["author_name"]:
+            if post["author_email"]:
+                author_text = E.a(
+                    post["author_name"], href=post["author_email"])
+            else:
+                author_text = post["author_name"]
+            author = E.span(
+                author_text, style="color: #117743; font-weight: bold;")
+        else:
+            author = ""
+        if post["trip_text"]:
+            if post["trip_email"]:
+                trip_text = E.a(post["trip_text"], href=post["trip_email"])
+            else:
+                trip_text = post["trip_text"]
+            trip = E.span(trip_text, style="color: #228854;")
+        else:
+            trip = ""
+        if post["img_src"]:
+            img = [
+                E.br(),
+                "File: ", E.a(post["img_name"], href=post["img_src"]),
+                " - (", E.span(post["img_size"], style="font-style: italic;"),
+                ")"]
+            if show_images:
+                img.extend((
+                    E.br(),
+                    E.a(E.img(
+                        alt="img", src=post["img_thumb_src"]),
+                        href=post["img_src"])))
+        else:
+            img = ()
+        xhtml = E.span(
+            E.br(), title, author, trip,
+            " ", post["date"], " ",
+            E.a("No.", post["id"], href=post_url),
+            *img)
+        xhtml.append(post["body_xhtml"])
+        if render_xhtml:
+            xhtml = self._to_s(xhtml)
+        return (text, xhtml)
+
+    def _to_s(self, node):
+        return etree.tostring(node, encoding=unicode)
+
+
+
+
+class ETreeIichanRu(ETreeWakaba, IichanRu):
+    pass
+
+
+# (tag, class) -> style of post body blocks.
+_BLOCK_STYLES = {
+    ("blockquote", "unkfunc"): "color: #789922;",
+    ("div", "abbrev"): "color: #707070;",
+}
+
+
+def _styled(tag, text, style):
+    node = etree.SubElement(tag, "span", style=style)
+    node.text = text
+    return text
+
+
+def _format_link(child, host, tag):
+    url = child.get("href")
+    if url.startswith("/"):
+        url = "http://" + host + url
+    node = etree.SubElement(tag, "a", href=url)
+    node.text = child.text or ""
+    return node.text
+
+
+def _format_br(child, host, tag):
+    etree.SubElement(tag, "br")
+    return "\n"
+
+
+def _format_strong(child, host, tag):
+    return "*%s*" % _styled(tag, child.text or "", "font-weight: bold;")
+
+
+def _format_em(child, host, tag):
+    return "/%s/" % _styled(tag, child.text or "", "font-style: italic;")
+
+
+def _format_del(child, host, tag):
+    return "-%s-" % _styled(
+        tag, child.text or "", "text-decoration: line-through;")
+
+
+def _format_code(child, host, tag):
+    return _styled(tag, child.text or "", "font-family: monospace;")
+
+
+def _format_span(child, host, tag):
+    if child.get("class") == "spoiler":
+        return "%%%%%s%%%%" % _styled(
+            tag, child.text or "",
+            "color: #F0D0B6; background-color: #F0D0B6;")
+
+
+# Inline tag -> function which appends xhtml of the post
+# body node to the tag and returns its text or None if
+# node is skipped. Empty nodes are rendered as empty.
+_INLINE_HANDLERS = {
+    "a": _format_link,
+    "br": _format_br,
+    "strong": _format_strong,
+    "em": _format_em,
+    "del": _format_del,
+    "code": _format_code,
+    "span": _format_span,
+}
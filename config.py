@@ -1,4 +1,5 @@
 import ConfigParser
+import multiprocessing
 
 
 _config = ConfigParser.RawConfigParser()
@@ -27,3 +28,9 @@ database_name = _config.get(_sect, "database_name")
 max_command_length = _config.getint(_sect, "max_command_length")
 
 plugins = _config.get(_sect, "plugins").strip().split()
+
+# Number of parsing worker processes; by default one per core.
+if _config.has_option(_sect, "parsing_workers"):
+    parsing_workers = _config.getint(_sect, "parsing_workers")
+else:
+    parsing_workers = multiprocessing.cpu_count()
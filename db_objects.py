@@ -23,6 +23,59 @@ class UserSettings(db.MongoObject):
         else:
             defer.returnValue(False)
 
+    @defer.inlineCallbacks
+    def get_merge_updates(self):
+        """Whether user wants new posts of subscription
+        merged into one message.
+        """
+        res = yield self._db.find_one(
+            {"jid": self._jid},
+            fields=["merge_updates"])
+        defer.returnValue(bool(res and res.get("merge_updates")))
+
+    def set_merge_updates(self, value):
+        return self._db.update(
+            {"jid": self._jid},
+            {"$set": {"merge_updates": value}},
+            upsert=True)
+
+    @classmethod
+    @defer.inlineCallbacks
+    def find_merging(cls, jids):
+        """Return set of given jids which want updates
+        merged.
+        """
+        res = yield cls._db.find(
+            {"jid": {"$in": jids}, "merge_updates": True},
+            fields=["jid"])
+        defer.returnValue(set([user["jid"] for user in res]))
+
+
+class UserPresence(db.MongoObject):
+    """Last known availability of user for our jid
+    (main jid or subscription jid).
+    """
+
+    collection_name = "users_presence"
+    indexes = (
+        (ASCENDING(("jid", "our_jid")), True),
+    )
+
+    def __init__(self, jid, our_jid):
+        self._jid = jid
+        self._our_jid = our_jid
+
+    def set_available(self, available):
+        return self._db.update(
+            {"jid": self._jid, "our_jid": self._our_jid},
+            {"$set": {"available": available}},
+            upsert=True)
+
+    @classmethod
+    def get_list(cls):
+        return cls._db.find(
+            fields=["jid", "our_jid", "available"])
+
 
 class UserSubscriptions(db.MongoObject):
     """User's url subscriptions.
@@ -115,22 +168,39 @@ class Subscription(db.MongoObject):
             yield self._db.remove({"url": self._url})
 
     @classmethod
-    def get_list(cls):
+    def get_list(cls, fields=None):
         """All subscriptions."""
-        return cls._db.find()
+        return cls._db.find(fields=fields)
 
-    @defer.inlineCallbacks
-    def get_last_modified(self):
-        res = yield self._db.find_one(
+    def get(self):
+        """Return subscription or empty dict if it doesn't exist."""
+        return self._db.find_one({"url": self._url})
+
+    def set_schedule(self, interval, next_update):
+        """Save poll interval and next update time
+        (unix timestamp).
+        """
+        return self._db.update(
             {"url": self._url},
-            fields=["last_modified"])
-        if "last_modified" in res:
-            defer.returnValue(res["last_modified"])
+            {"$set": {"update_interval": interval,
+                      "next_update": next_update}})
 
-    def set_last_modified(self, last_modified):
+    def set_validators(self, last_modified, etag):
+        """Save Last-Modified and ETag headers of the
+        last fetched page.
+        """
+        return self._db.update(
+            {"url": self._url},
+            {"$set": {"last_modified": last_modified, "etag": etag}})
+
+    def set_range(self, offset, checksum):
+        """Save offset of the page tail which should be
+        fetched next time and checksum of the chunk
+        before it.
+        """
         return self._db.update(
             {"url": self._url},
-            {"$set": {"last_modified": last_modified}})
+            {"$set": {"range_offset": offset, "range_checksum": checksum}})
 
     @defer.inlineCallbacks
     def get_last(self):
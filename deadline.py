@@ -0,0 +1,23 @@
+from twisted.internet import defer, error
+
+
+def timeout(d, seconds, clock=None):
+    """Return deferred which fires with the result of d or
+    fails with TimeoutError if d doesn't fire in given
+    seconds. d is cancelled then; its late result is
+    discarded.
+    """
+    if clock is None:
+        from twisted.internet import reactor as clock
+    result = defer.Deferred()
+    def on_timeout():
+        result.errback(error.TimeoutError(
+            "No result in %s seconds" % seconds))
+        d.cancel()
+    call = clock.callLater(seconds, on_timeout)
+    def on_result(res):
+        if call.active():
+            call.cancel()
+            result.callback(res)
+    d.addBoth(on_result)
+    return result
@@ -0,0 +1,309 @@
+from collections import deque
+from twisted.internet import defer
+from twisted.words.xish import domish
+from stanza_queue import REPLY, BULK
+
+
+NS_ADDRESS = "http://jabber.org/protocol/address"
+NS_DISCO_INFO = "http://jabber.org/protocol/disco#info"
+NS_DISCO_ITEMS = "http://jabber.org/protocol/disco#items"
+NS_DATA = "jabber:x:data"
+
+_MULTICAST = (
+    u"<%s to='%s' id='%s'%s><addresses xmlns='%s'>%s</addresses>%s</%s>")
+_ADDRESS = u"<address type='bcc' jid='%s'/>"
+
+
+def _get_domain(jid):
+    return jid.split("/", 1)[0].split("@", 1)[-1]
+
+
+def _split(name, xml):
+    """Return (attributes, content) of serialized stanza."""
+    end = xml.index(">")
+    if xml[end-1] == "/":
+        return xml[len(name)+1:end-1], u""
+    return xml[len(name)+1:end], xml[end+1:-len(name)-3]
+
+
+def _get_limit(query):
+    """Return addresses limit for messages to other servers
+    which multicast service advertises in disco#info result
+    (as ejabberd does) or None.
+    """
+    for form in query.elements():
+        if form.name != "x" or form.uri != NS_DATA:
+            continue
+        fields = {}
+        for field in form.elements():
+            if field.name == "field":
+                for value in field.elements():
+                    if value.name == "value":
+                        fields[field.getAttribute("var")] = unicode(value)
+                        break
+        if fields.get("FORM_TYPE") != NS_ADDRESS:
+            continue
+        try:
+            limit = int(fields.get("limit-remote-message"))
+        except (TypeError, ValueError):
+            # Missing or "infinite".
+            return
+        if limit > 0:
+            return limit
+
+
+class _Discovery(object):
+    """Multicast service discovery of one server."""
+
+    def __init__(self, domain):
+        self.domain = domain
+        # Ids of queries without answer.
+        self.queries = set()
+        self.items_asked = False
+        self.waiting = []
+        self.timer = None
+
+
+class Fanout(object):
+    """Sends the same stanza to many recipients. Stanza is
+    serialized once; only recipient is written for every
+    copy.
+
+    Messages to servers which support Extended Stanza
+    Addressing (XEP-0033) are sent as one multicast stanza
+    per server instead. Multicast service is looked for by
+    service discovery of the server and its items; results
+    are cached. Recipients on servers which aren't
+    discovered yet get unicast stanzas. If multicast stanza
+    bounces, service is treated as unsupported and its
+    recipients get unicast stanzas.
+    """
+
+    # Recipients on one server worth multicast stanza.
+    MIN_RECIPIENTS = 2
+    # Addresses in one multicast stanza if service doesn't
+    # advertise its limit.
+    MAX_ADDRESSES = 20
+    # Server items which are asked for multicast support.
+    MAX_ITEMS = 10
+    # How long discovery results are trusted.
+    SUPPORTED_TTL = 60 * 60 * 6
+    UNSUPPORTED_TTL = 60 * 60
+    # Discovery without answer means no support.
+    DISCO_TIMEOUT = 60
+    # How long sent multicast stanzas are remembered to
+    # resend them if they bounce.
+    BOUNCE_TTL = 60 * 10
+
+    def __init__(self, put, jid, clock=None):
+        """put(stanza, domain, priority) queues stanza
+        (StanzaQueue.put); jid is our address for disco
+        queries.
+        """
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self._put = put
+        self.jid = jid
+        self._clock = clock
+        # Domain -> (multicast service jid or None, expires).
+        self._services = {}
+        # Service jid -> addresses limit it advertises.
+        self._limits = {}
+        # Domain -> _Discovery in progress.
+        self._discoveries = {}
+        # Disco query id -> _Discovery.
+        self._queries = {}
+        # Multicast stanza id -> (domain, recipients, stanza
+        # name, serialized stanza, priority).
+        self._sent = {}
+        # (expires, id) of sent multicast stanzas in order.
+        self._sent_order = deque()
+        self._serial = 0
+        self.stats = {"unicast": 0, "multicast": 0}
+
+    def send(self, recipients, stanza, priority=BULK):
+        """Send stanza (domish.Element without to attribute)
+        to every recipient jid.
+        """
+        xml = stanza.toXml()
+        if stanza.name == "message":
+            recipients = self._multicast(
+                recipients, stanza.name, xml, priority)
+        self._unicast(recipients, stanza.name, xml, priority)
+
+    def _unicast(self, recipients, name, xml, priority):
+        # The same stanza with to as the first attribute.
+        head = u"<" + name
+        tail = u"'" + xml[len(head):]
+        head += u" to='"
+        for to in recipients:
+            self._put(
+                head + domish.escapeToXml(to, 1) + tail,
+                _get_domain(to), priority)
+        self.stats["unicast"] += len(recipients)
+
+    def _multicast(self, recipients, name, xml, priority):
+        """Send multicast stanzas to servers which support
+        them. Return recipients which should get unicast
+        stanzas.
+        """
+        now = self._clock.seconds()
+        while self._sent_order and self._sent_order[0][0] <= now:
+            self._sent.pop(self._sent_order.popleft()[1], None)
+        servers = {}
+        for to in recipients:
+            servers.setdefault(_get_domain(to), []).append(to)
+        multicast = set()
+        attrs = None
+        for domain, jids in servers.iteritems():
+            if len(jids) < self.MIN_RECIPIENTS:
+                continue
+            service = self.get_service(domain)
+            if service is None:
+                continue
+            multicast.add(domain)
+            if attrs is None:
+                attrs, content = _split(name, xml)
+            limit = self._limits.get(service, self.MAX_ADDRESSES)
+            service = domish.escapeToXml(service, 1)
+            for i in xrange(0, len(jids), limit):
+                part = jids[i:i+limit]
+                addresses = u"".join([
+                    _ADDRESS % domish.escapeToXml(jid, 1) for jid in part])
+                self._serial += 1
+                id_ = "multicast%d" % self._serial
+                self._sent[id_] = (domain, part, name, xml, priority)
+                self._sent_order.append((now + self.BOUNCE_TTL, id_))
+                self._put(_MULTICAST % (
+                    name, service, id_, attrs, NS_ADDRESS, addresses,
+                    content, name), domain, priority)
+                self.stats["multicast"] += 1
+        if not multicast:
+            return recipients
+        return [to for to in recipients if _get_domain(to) not in multicast]
+
+    def on_message_error(self, msg):
+        """Handle message error. Return True if it was bounce
+        of our multicast stanza; its recipients get unicast
+        stanzas then.
+        """
+        sent = self._sent.pop(msg.getAttribute("id"), None)
+        if sent is None:
+            return False
+        domain, recipients, name, xml, priority = sent
+        service = self._services.get(domain)
+        if service is not None and service[0] is not None:
+            self._services[domain] = (
+                None, self._clock.seconds() + self.UNSUPPORTED_TTL)
+        self._unicast(recipients, name, xml, priority)
+        return True
+
+    def get_service(self, domain):
+        """Return multicast service jid of the server or None.
+        Discovery is started if server wasn't discovered
+        yet or its result is expired.
+        """
+        service = self._services.get(domain)
+        if service is not None and service[1] > self._clock.seconds():
+            return service[0]
+        self.discover(domain)
+
+    def discover(self, domain):
+        """Return deferred which fires with multicast
+        service jid of the server or None.
+        """
+        discovery = self._discoveries.get(domain)
+        if discovery is None:
+            discovery = self._discoveries[domain] = _Discovery(domain)
+            discovery.timer = self._clock.callLater(
+                self.DISCO_TIMEOUT, self._discovered, discovery, None)
+            self._query(discovery, domain, NS_DISCO_INFO)
+        d = defer.Deferred()
+        discovery.waiting.append(d)
+        return d
+
+    def _query(self, discovery, jid, ns):
+        self._serial += 1
+        id_ = "multicast%d" % self._serial
+        iq = domish.Element((None, "iq"))
+        iq["type"] = "get"
+        iq["to"] = jid
+        iq["from"] = self.jid
+        iq["id"] = id_
+        iq.addElement((ns, "query"))
+        discovery.queries.add(id_)
+        self._queries[id_] = discovery
+        self._put(iq, discovery.domain, REPLY)
+
+    def on_iq(self, iq):
+        """Handle iq result or error. Return True if it was
+        answer to our disco query.
+        """
+        discovery = self._queries.pop(iq.getAttribute("id"), None)
+        if discovery is None:
+            return False
+        discovery.queries.discard(iq["id"])
+        jid = iq.getAttribute("from", discovery.domain)
+        query = None
+        if iq.getAttribute("type") == "result":
+            for query in iq.elements():
+                if query.name == "query":
+                    break
+            else:
+                query = None
+        if query is not None and query.uri == NS_DISCO_INFO:
+            for feature in query.elements():
+                if (feature.name == "feature" and
+                    feature.getAttribute("var") == NS_ADDRESS):
+                    limit = _get_limit(query)
+                    if limit is None:
+                        self._limits.pop(jid, None)
+                    else:
+                        self._limits[jid] = limit
+                    self._discovered(discovery, jid)
+                    return True
+        elif query is not None and query.uri == NS_DISCO_ITEMS:
+            items = [
+                item.getAttribute("jid") for item in query.elements()
+                if item.name == "item" and item.getAttribute("jid")]
+            for item in items[:self.MAX_ITEMS]:
+                self._query(discovery, item, NS_DISCO_INFO)
+        if not discovery.items_asked:
+            # Server itself doesn't support multicast;
+            # look for it among server's services.
+            discovery.items_asked = True
+            self._query(discovery, discovery.domain, NS_DISCO_ITEMS)
+        elif not discovery.queries:
+            self._discovered(discovery, None)
+        return True
+
+    def _discovered(self, discovery, service):
+        if self._discoveries.get(discovery.domain) is not discovery:
+            return
+        del self._discoveries[discovery.domain]
+        for id_ in discovery.queries:
+            del self._queries[id_]
+        if discovery.timer.active():
+            discovery.timer.cancel()
+        if service is None:
+            ttl = self.UNSUPPORTED_TTL
+        else:
+            ttl = self.SUPPORTED_TTL
+        self._services[discovery.domain] = (
+            service, self._clock.seconds() + ttl)
+        for d in discovery.waiting:
+            d.callback(service)
+
+    def get_info(self):
+        """Return dict of unicast and multicast stanzas
+        counters and multicast servers count.
+        """
+        now = self._clock.seconds()
+        servers = len([
+            1 for service, expires in self._services.itervalues()
+            if service is not None and expires > now])
+        return {
+            "unicast": self.stats["unicast"],
+            "multicast": self.stats["multicast"],
+            "servers": servers,
+        }
@@ -1,71 +1,218 @@
-from twisted.internet import defer, reactor
-from twisted.web import client
+import zlib
+from collections import deque
+from twisted.internet import defer
 from twisted.web.error import Error as WebError
+from http_pool import HTTPConnectionPool
 
 
 USER_AGENT = ("Mozilla/5.0 (Windows NT 5.1; rv:8.0) "
               "Gecko/20100101 Firefox/8.0")
 TIMEOUT = 5
+# Default per-host limits; could be redefined in chans
+# config sections.
+MAX_CONNECTIONS_PER_HOST = 4
+IDLE_TIMEOUT = 60
+# Size of the page chunk right before the requested tail
+# which is fetched again to check that page prefix wasn't
+# changed.
+RANGE_CHECK_SIZE = 256
+# Only this much of the page end is kept in memory when
+# page is streamed.
+STREAM_KEEP_SIZE = 64 * 1024
 
 
-# Modified version of _makeGetterFactory from
-# http://twistedmatrix.com/trac/browser/tags/releases/
-# twisted-11.0.0/twisted/web/client.py#L506
-# with connect timeout support.
-def _make_factory(url, *args, **kwargs):
-    scheme, host, port, path = client._parse(url)
-    factory = client.HTTPClientFactory(url, *args, **kwargs)
-    connect_kwargs = {}
-    if "timeout" in kwargs:
-        connect_kwargs["timeout"] = kwargs["timeout"]
-    if scheme == "https":
-        from twisted.internet import ssl
-        contextFactory = ssl.ClientContextFactory()
-        reactor.connectSSL(
-            host, port, factory, contextFactory, **connect_kwargs)
-    else:
-        reactor.connectTCP(host, port, factory, **connect_kwargs)
-    return factory
+# All fetches share this pool so requests to the same
+# host go through a few keep-alive connections.
+pool = HTTPConnectionPool(
+    max_connections=MAX_CONNECTIONS_PER_HOST,
+    idle_timeout=IDLE_TIMEOUT,
+    connect_timeout=TIMEOUT)
+
+
+def configure_host(host, max_connections=None, idle_timeout=None):
+    """Set connection pool limits for the given host."""
+    pool.configure_host(host, max_connections, idle_timeout)
+
+
+# Body bytes received from the network and after
+# content decoding.
+stats = {
+    "wire_bytes": 0,
+    "decoded_bytes": 0,
+}
 
 
 class NotFound(Exception):
     pass
 
 
-@defer.inlineCallbacks
-def get_last_modified(url):
-    """Returns Last-Modified header if available
-    or None.
+class NotModified(Exception):
+    """Page wasn't changed since the previous fetch."""
+
+
+def _checksum(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+class Page(object):
+    """Fetched page with validators which should be passed
+    to the next get_page call. offset is the position of the
+    body in the whole page; it isn't zero if only the page
+    tail was fetched or page was streamed.
     """
-    url = str(url)
-    factory = _make_factory(
-        url, method="HEAD", agent=USER_AGENT,
-        timeout=TIMEOUT, followRedirect=False)
-    try:
-        yield factory.deferred
-    except WebError as e:
-        if e.status == "404":
-            raise NotFound
+
+    def __init__(self, body, last_modified=None, etag=None, offset=0):
+        self.body = body
+        self.last_modified = last_modified
+        self.etag = etag
+        self.offset = offset
+
+    def get_checksum(self, offset):
+        """Return checksum of the page chunk before given
+        offset (for the get_page call) or None if it's not
+        in the fetched body.
+        """
+        start = max(offset - RANGE_CHECK_SIZE, 0) - self.offset
+        end = offset - self.offset
+        if start >= 0 and end <= len(self.body):
+            return _checksum(self.body[start:end])
+
+
+class _PageReceiver(object):
+    """Receives page body from the connection. Checks page
+    prefix if only the tail was requested; passes body to
+    the stream (if any) and keeps it (or only its end in
+    streaming mode) for Page.
+    """
+
+    def __init__(self, stream=None, start=0, check_size=0, checksum=None):
+        self.offset = 0
+        self._stream = stream
+        self._start = start
+        self._check_size = check_size
+        self._checksum = checksum
+        self._valid = True
+        self._write = None
+        self._chunks = deque()
+        self._length = 0
+
+    def start(self, response):
+        if response.code == 206:
+            content_range = response.get_header("content-range", "")
+            self._valid = content_range.startswith("bytes %d-" % self._start)
+            self.offset = self._start
+        elif response.code == 200:
+            # Whole page; nothing to check.
+            self._check_size = 0
         else:
-            raise
-    else:
-        if "last-modified" in factory.response_headers:
-            defer.returnValue(
-                factory.response_headers["last-modified"][0])
+            self._valid = False
+
+    def write(self, data):
+        if not self._valid:
+            return
+        self._chunks.append(data)
+        self._length += len(data)
+        if self._check_size:
+            if self._length < self._check_size:
+                return
+            data = "".join(self._chunks)
+            self._chunks = deque((data,))
+            if _checksum(data[:self._check_size]) != self._checksum:
+                self._valid = False
+                return
+            self._check_size = 0
+        if self._stream is not None:
+            if self._write is None:
+                self._write = self._stream(self.offset)
+            self._write(data)
+            while self._length - len(self._chunks[0]) >= STREAM_KEEP_SIZE:
+                chunk = self._chunks.popleft()
+                self._length -= len(chunk)
+                self.offset += len(chunk)
+
+    def finish(self):
+        """Return kept body or None if page prefix
+        was changed.
+        """
+        if self._check_size:
+            # Body is shorter than the checked chunk.
+            self._valid = False
+        if not self._valid:
+            return
+        if self._stream is not None and self._write is None:
+            # Empty page; stream should be started anyway.
+            self._write = self._stream(self.offset)
+        return "".join(self._chunks)
 
 
 @defer.inlineCallbacks
-def get_page(url):
+def _request(method, url, headers=None, receiver=None):
     url = str(url)
-    factory = _make_factory(
-        url, method="GET", agent=USER_AGENT,
-        timeout=TIMEOUT, followRedirect=False)
-    try:
-        page = yield factory.deferred
-    except WebError as e:
-        if e.status == "404":
-            raise NotFound
+    all_headers = {
+        "User-Agent": USER_AGENT,
+        "Accept-Encoding": "gzip, deflate",
+    }
+    if headers:
+        all_headers.update(headers)
+    response = yield pool.request(
+        method, url, all_headers, timeout=TIMEOUT, receiver=receiver)
+    stats["wire_bytes"] += response.wire_length
+    stats["decoded_bytes"] += response.length
+    if response.code == 404:
+        raise NotFound
+    elif response.code == 304:
+        raise NotModified
+    elif not 200 <= response.code < 300:
+        raise WebError(str(response.code), response.phrase)
+    defer.returnValue(response)
+
+
+def _make_page(response, receiver):
+    return Page(
+        receiver.finish(),
+        response.get_header("last-modified"),
+        response.get_header("etag"),
+        receiver.offset)
+
+
+@defer.inlineCallbacks
+def get_page(url, last_modified=None, etag=None,
+             offset=None, checksum=None, stream=None):
+    """Fetch page and return Page instance. If validators
+    from the previous fetch are given, make conditional
+    request; raise NotModified if page wasn't changed.
+    If offset and checksum (see Page.get_checksum) are
+    given, try to fetch only the page tail from the offset;
+    fall back to the whole page if server doesn't support
+    ranges or page prefix was changed.
+    If stream is given, it's called with the offset of the
+    fetched data in the page once it's known and should
+    return callable which gets body chunks as they arrive.
+    """
+    headers = {}
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+    if etag:
+        headers["If-None-Match"] = etag
+    if offset is not None and checksum is not None:
+        start = max(offset - RANGE_CHECK_SIZE, 0)
+        range_headers = headers.copy()
+        range_headers["Range"] = "bytes=%d-" % start
+        # Range of compressed content is useless for us.
+        range_headers["Accept-Encoding"] = "identity"
+        receiver = _PageReceiver(stream, start, offset - start, checksum)
+        try:
+            response = yield _request("GET", url, range_headers, receiver)
+        except WebError as e:
+            # Range not satisfiable; page was truncated.
+            if e.status != "416":
+                raise
         else:
-            raise
-    else:
-        defer.returnValue(page)
+            page = _make_page(response, receiver)
+            if page.body is not None:
+                defer.returnValue(page)
+        # Page prefix was changed; fetch it again.
+        headers = {}
+    receiver = _PageReceiver(stream)
+    response = yield _request("GET", url, headers, receiver)
+    defer.returnValue(_make_page(response, receiver))
@@ -0,0 +1,471 @@
+import zlib
+from twisted.internet import defer, reactor, protocol
+from twisted.protocols import basic
+from twisted.web import client, http
+
+
+class ResponseFailed(Exception):
+    """Connection was lost before the response was complete.
+    started is False if no response bytes were received at all.
+    """
+
+    def __init__(self, reason, started):
+        Exception.__init__(self, reason, started)
+        self.reason = reason
+        self.started = started
+
+
+class Response(object):
+    """HTTP response. Header names are lowercased;
+    header values are stored in lists. Body is stored
+    decoded (unless it was passed to receiver); length
+    and wire_length are its length after and before
+    decoding.
+    """
+
+    def __init__(self, version, code, phrase):
+        self.version = version
+        self.code = code
+        self.phrase = phrase
+        self.headers = {}
+        self.body = ""
+        self.length = 0
+        self.wire_length = 0
+
+    def get_header(self, name, default=None):
+        values = self.headers.get(name.lower())
+        if values:
+            return values[0]
+        else:
+            return default
+
+
+class _Decompressor(object):
+    """Incremental gzip/deflate content decoder."""
+
+    def __init__(self, encoding):
+        if encoding == "gzip":
+            self._obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            self._try_raw = False
+        else:
+            self._obj = zlib.decompressobj()
+            self._try_raw = True
+
+    def decompress(self, data):
+        try:
+            decoded = self._obj.decompress(data)
+        except zlib.error:
+            if not self._try_raw:
+                raise
+            # Some servers send raw deflate stream
+            # without zlib header.
+            self._obj = zlib.decompressobj(-zlib.MAX_WBITS)
+            decoded = self._obj.decompress(data)
+        self._try_raw = False
+        return decoded
+
+    def flush(self):
+        return self._obj.flush()
+
+
+class HTTPClientProtocol(basic.LineReceiver):
+    """HTTP/1.1 client connection. Processes one request
+    at a time but could be reused for the next request if
+    server keeps connection alive.
+    """
+
+    def __init__(self):
+        self.persistent = True
+        self.requests_count = 0
+        self._lost = []
+        self._finished = None
+        self._response = None
+        self._timeout_call = None
+        self._timed_out = False
+
+    def connectionMade(self):
+        self.factory.deferred.callback(self)
+
+    def request(self, method, host, path, headers, timeout=None,
+                receiver=None):
+        """Send request. Return deferred which fires with
+        Response instance after the whole body is received.
+        If receiver is given, its start method is called with
+        Response after headers are received and body chunks
+        are passed to its write method instead of buffering.
+        If write raises, request fails with its exception and
+        connection is closed.
+        """
+        self.requests_count += 1
+        self._receiver = receiver
+        self._method = method
+        self._finished = defer.Deferred()
+        self._response = None
+        self._header = ""
+        self._body = []
+        self._decoder = None
+        self._decompressor = None
+        lines = ["%s %s HTTP/1.1" % (method, path), "Host: %s" % host]
+        for name, value in headers.iteritems():
+            lines.append("%s: %s" % (name, value))
+        lines.extend(("", ""))
+        self.transport.write("\r\n".join(lines))
+        if timeout is not None:
+            self._timeout_call = reactor.callLater(timeout, self._timeout)
+        return self._finished
+
+    def _timeout(self):
+        self._timeout_call = None
+        self._timed_out = True
+        self.persistent = False
+        self.transport.loseConnection()
+
+    def lineReceived(self, line):
+        if self._finished is None:
+            # Server shouldn't send anything without request.
+            self.persistent = False
+            self.transport.loseConnection()
+            return
+        if self._response is None:
+            parts = line.split(None, 2)
+            if len(parts) < 2 or not parts[1].isdigit():
+                self._fail(ResponseFailed("Bad status line", True))
+                return
+            if len(parts) == 2:
+                parts.append("")
+            self._response = Response(parts[0], int(parts[1]), parts[2])
+            return
+        if not line:
+            if self._header:
+                self._extract_header(self._header)
+                self._header = ""
+            self._headers_received()
+        elif line[0] in " \t":
+            self._header += line
+        else:
+            if self._header:
+                self._extract_header(self._header)
+            self._header = line
+
+    def _extract_header(self, header):
+        name, value = header.split(":", 1)
+        self._response.headers.setdefault(
+            name.strip().lower(), []).append(value.strip())
+
+    def _headers_received(self):
+        response = self._response
+        if 100 <= response.code < 200:
+            # Informational response; real one will follow.
+            self._response = None
+            return
+        if self._receiver is not None:
+            self._receiver.start(response)
+        connection = response.get_header("connection", "").lower()
+        if response.version != "HTTP/1.1" or "close" in connection:
+            self.persistent = False
+        if self._method == "HEAD" or response.code in (204, 304):
+            self._end_response("")
+            return
+        encoding = response.get_header("content-encoding", "").lower()
+        if encoding in ("gzip", "x-gzip"):
+            self._decompressor = _Decompressor("gzip")
+        elif encoding == "deflate":
+            self._decompressor = _Decompressor("deflate")
+        encoding = response.get_header("transfer-encoding", "").lower()
+        if "chunked" in encoding:
+            self._decoder = http._ChunkedTransferDecoder(
+                self._body_received, self._end_response)
+        else:
+            length = response.get_header("content-length")
+            if length is None:
+                # Body lasts until connection close.
+                self.persistent = False
+            else:
+                length = int(length)
+                if length == 0:
+                    self._end_response("")
+                    return
+            self._decoder = http._IdentityTransferDecoder(
+                length, self._body_received, self._end_response)
+        self.setRawMode()
+
+    def rawDataReceived(self, data):
+        if self._decoder is None:
+            self.persistent = False
+            self.transport.loseConnection()
+        else:
+            self._decoder.dataReceived(data)
+
+    def _body_received(self, data):
+        if self._finished is None:
+            # Request already failed.
+            return
+        self._response.wire_length += len(data)
+        if self._decompressor is not None:
+            try:
+                data = self._decompressor.decompress(data)
+            except zlib.error as e:
+                self._fail(e)
+                return
+        if data:
+            self._deliver(data)
+
+    def _deliver(self, data):
+        self._response.length += len(data)
+        if self._receiver is None:
+            self._body.append(data)
+        else:
+            try:
+                self._receiver.write(data)
+            except Exception as e:
+                # Receiver doesn't want the rest of the body.
+                self._fail(e)
+
+    def _end_response(self, extra):
+        if self._finished is None:
+            return
+        if extra:
+            # Garbage after the response; don't trust this
+            # connection anymore.
+            self.persistent = False
+        if self._decompressor is not None:
+            data = self._decompressor.flush()
+            if data:
+                self._deliver(data)
+        response = self._response
+        response.body = "".join(self._body)
+        d = self._reset()
+        if self.persistent:
+            self.setLineMode()
+        else:
+            self.transport.loseConnection()
+        d.callback(response)
+
+    def _fail(self, exc):
+        self.persistent = False
+        d = self._reset()
+        self.transport.loseConnection()
+        d.errback(exc)
+
+    def _reset(self):
+        if self._timeout_call is not None:
+            self._timeout_call.cancel()
+            self._timeout_call = None
+        d = self._finished
+        self._finished = self._response = self._decoder = None
+        self._decompressor = self._receiver = None
+        self._body = []
+        return d
+
+    def connectionLost(self, reason):
+        self.persistent = False
+        if self._finished is not None:
+            # Body cut by timeout isn't complete even if it
+            # has no length.
+            if self._decoder is not None and not self._timed_out:
+                try:
+                    self._decoder.noMoreData()
+                except http.PotentialDataLoss:
+                    # Body without length was finished by close.
+                    pass
+                except http._DataLoss:
+                    pass
+            if self._finished is not None:
+                if self._timed_out:
+                    exc = defer.TimeoutError()
+                else:
+                    exc = ResponseFailed(
+                        reason, self._response is not None)
+                d = self._reset()
+                d.errback(exc)
+        self.factory.pool._connection_lost(self.factory.key, self)
+        for d in self._lost:
+            d.callback(None)
+
+    def notify_lost(self):
+        """Return deferred which fires on connection lost."""
+        d = defer.Deferred()
+        self._lost.append(d)
+        return d
+
+
+class _HTTPClientFactory(protocol.ClientFactory):
+
+    protocol = HTTPClientProtocol
+
+    def __init__(self, pool, key):
+        self.pool = pool
+        self.key = key
+        self.deferred = defer.Deferred()
+
+    def clientConnectionFailed(self, connector, reason):
+        self.deferred.errback(reason)
+
+
+class _HostConnections(object):
+    """Connections to one (scheme, host, port)."""
+
+    def __init__(self, max_connections, idle_timeout):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        # Number of opened and opening connections.
+        self.count = 0
+        # List of (protocol, idle timeout delayed call).
+        self.idle = []
+        # Deferreds of requests waiting for free connection.
+        self.waiting = []
+
+
+class HTTPConnectionPool(object):
+    """Pool of persistent HTTP/1.1 connections.
+    Keeps at most max_connections connections per host;
+    unused connection is closed after idle_timeout seconds.
+    """
+
+    def __init__(self, max_connections=4, idle_timeout=60,
+                 connect_timeout=30):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.connect_timeout = connect_timeout
+        self._settings = {}
+        self._hosts = {}
+
+    def configure_host(self, host, max_connections=None, idle_timeout=None):
+        """Set per-host limits. None means pool default."""
+        self._settings[host] = (max_connections, idle_timeout)
+        for key, conns in self._hosts.iteritems():
+            if key[1] == host:
+                self._apply_settings(key, conns)
+                while self._wake_waiting(key, conns):
+                    pass
+
+    def _apply_settings(self, key, conns):
+        max_connections, idle_timeout = self._settings.get(
+            key[1], (None, None))
+        if max_connections is None:
+            max_connections = self.max_connections
+        if idle_timeout is None:
+            idle_timeout = self.idle_timeout
+        conns.max_connections = max_connections
+        conns.idle_timeout = idle_timeout
+
+    def _get_host(self, key):
+        if key not in self._hosts:
+            conns = _HostConnections(self.max_connections, self.idle_timeout)
+            self._apply_settings(key, conns)
+            self._hosts[key] = conns
+        return self._hosts[key]
+
+    @defer.inlineCallbacks
+    def request(self, method, url, headers=None, timeout=None,
+                receiver=None):
+        """Make request using pooled connection. Return deferred
+        which fires with Response instance. See
+        HTTPClientProtocol.request for receiver description.
+        """
+        scheme, host, port, path = client._parse(url)
+        key = (scheme, host, port)
+        if port in (80, 443):
+            host_header = host
+        else:
+            host_header = "%s:%d" % (host, port)
+        if headers is None:
+            headers = {}
+        while True:
+            proto = yield self._get_connection(key)
+            reused = proto.requests_count > 0
+            try:
+                response = yield proto.request(
+                    method, host_header, path, headers, timeout, receiver)
+            except ResponseFailed as e:
+                # Server could close idle connection at the same
+                # moment we sent request; just retry on new one.
+                if reused and not e.started:
+                    continue
+                raise
+            finally:
+                self._release(key, proto)
+            defer.returnValue(response)
+
+    def _get_connection(self, key):
+        conns = self._get_host(key)
+        if conns.idle:
+            proto, call = conns.idle.pop()
+            call.cancel()
+            return defer.succeed(proto)
+        elif conns.count < conns.max_connections:
+            conns.count += 1
+            return self._connect(key, conns)
+        else:
+            d = defer.Deferred()
+            conns.waiting.append(d)
+            return d
+
+    def _connect(self, key, conns):
+        scheme, host, port = key
+        factory = _HTTPClientFactory(self, key)
+        if scheme == "https":
+            from twisted.internet import ssl
+            contextFactory = ssl.ClientContextFactory()
+            reactor.connectSSL(
+                host, port, factory, contextFactory,
+                timeout=self.connect_timeout)
+        else:
+            reactor.connectTCP(
+                host, port, factory, timeout=self.connect_timeout)
+        d = factory.deferred
+        d.addErrback(self._connect_failed, key, conns)
+        return d
+
+    def _connect_failed(self, failure, key, conns):
+        conns.count -= 1
+        self._wake_waiting(key, conns)
+        return failure
+
+    def _wake_waiting(self, key, conns):
+        if conns.waiting and conns.count < conns.max_connections:
+            conns.count += 1
+            self._connect(key, conns).chainDeferred(conns.waiting.pop(0))
+            return True
+
+    def _release(self, key, proto):
+        if not proto.persistent:
+            # Will be counted in _connection_lost.
+            return
+        conns = self._get_host(key)
+        if conns.waiting:
+            conns.waiting.pop(0).callback(proto)
+        else:
+            call = reactor.callLater(
+                conns.idle_timeout, proto.transport.loseConnection)
+            conns.idle.append((proto, call))
+
+    def _connection_lost(self, key, proto):
+        conns = self._get_host(key)
+        conns.count -= 1
+        for item in conns.idle:
+            if item[0] is proto:
+                conns.idle.remove(item)
+                if item[1].active():
+                    item[1].cancel()
+                break
+        self._wake_waiting(key, conns)
+
+    def get_info(self):
+        """Return dict of (scheme, host, port) -> (connections
+        count, idle count, waiting requests count).
+        """
+        return dict([
+            (key, (c.count, len(c.idle), len(c.waiting)))
+            for key, c in self._hosts.iteritems()])
+
+    def close_cached_connections(self):
+        """Close all idle connections. Return deferred
+        which fires when they are closed.
+        """
+        results = []
+        for conns in self._hosts.itervalues():
+            for proto, call in conns.idle[:]:
+                results.append(proto.notify_lost())
+                proto.transport.loseConnection()
+        return defer.DeferredList(results)
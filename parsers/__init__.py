@@ -2,6 +2,24 @@ import re
 import os
 
 
+class BufferedTask(object):
+    """Streaming task which collects all data and
+    processes it at once.
+    """
+
+    def __init__(self, parser, task):
+        self._parser = parser
+        self._task = task
+        self._chunks = []
+
+    def feed(self, data):
+        self._chunks.append(data)
+
+    def close(self):
+        self._task["_data"] = "".join(self._chunks)
+        return self._parser.do_task(self._task)
+
+
 class Parser(object):
 
     features = ()
@@ -12,6 +30,14 @@ class Parser(object):
     def do_task(self, task):
         return
 
+    def start_task(self, task):
+        """Start streaming task. Return object with feed(data)
+        and close() methods; close returns task result.
+        Parsers could redefine it to process data as it
+        arrives.
+        """
+        return BufferedTask(self, task)
+
 
 def load_parsers():
     """Find and load all available parsers."""
@@ -1,16 +1,19 @@
 import re
 from lxml import etree
-from lxml.builder import E
 from parsers import Parser
+from post_renderer import PostRenderer
 
 
 class Wakaba(Parser):
 
     features = (
         "last_modified",
+        "byte_range",
     )
     BOARD_RE = r"[A-Za-z\d]{1,10}"
     BOARD_REC = re.compile("\A%s\Z" % BOARD_RE)
+    # Makes text and xhtml of the post records.
+    renderer = PostRenderer()
 
     def get_thread_re(self, host):
         host = re.escape(host)
@@ -35,101 +38,137 @@ class Wakaba(Parser):
         if hasattr(self, task_handler):
             return getattr(self, task_handler)(task)
 
-    def task_thread_updates(self, task):
-        tree = etree.HTML(task["_data"])
-        posts = tree.findall(".//td[@class='reply']")
-        if not posts:
-            return {"last": 0}
+    # Page tail starts with markup chunk without meta
+    # charset info so encoding should be set explicitly.
+    # Pages are always in utf-8 so it's used for boards too.
+    _utf8_parser = etree.HTMLParser(encoding="utf-8")
 
-        if "last" in task:
-            # Was parsed in the past; return new posts
-            updates = []
-            for post_node in posts:
-                post_id = self._get_post_id(post_node)
-                if post_id > task["last"]:
-                    updates.append(self._parse_post(post_node, task))
-                    last = post_id
-            if updates:
-                return {"last": last, "updates": updates}
+    def start_task(self, task):
+        if task["type"] == "thread_updates":
+            return _ThreadUpdatesStream(self, task)
         else:
-            # Wasn't parsed; return just last post's id
-            last = self._get_post_id(posts[-1])
-            return {"last": last}
+            return super(Wakaba, self).start_task(task)
 
-    _HR = u"\u2500"*50
-    _HR2 = u"\u2591"*60
+    def task_thread_updates(self, task):
+        data = task["_data"]
+        base = task.get("_offset", 0)
+        known_tail = None
+        if not base and "last" in task:
+            known_tail = self._find_tail(data, task["last"])
+            if known_tail is not None:
+                # Only posts after the last known one are
+                # needed; don't build tree for the rest.
+                data = data[known_tail:]
+                base = known_tail
+                task = dict(task, _offset=base)
+        if base:
+            # Only the page tail after the last known
+            # post was fetched.
+            tree = etree.HTML(data, self._utf8_parser)
+        else:
+            tree = etree.HTML(data)
+        updates = _ThreadUpdates(self, task)
+        if tree is not None:
+            for post_node in tree.findall(".//td[@class='reply']"):
+                updates.add_post(post_node)
+        scanner = _TailScanner(base)
+        if known_tail is not None:
+            scanner.offsets[str(task["last"])] = known_tail
+        scanner.feed(data)
+        return updates.get_result(scanner)
+
+    def _find_tail(self, data, post_id):
+        """Return offset of the page tail which follows
+        the reply post or None if there is no such post
+        (e.g. it was deleted).
+        """
+        pos = data.find('id="reply%d"' % post_id)
+        if pos == -1:
+            return
+        pos = data.find(_TailScanner.TABLE_END, pos)
+        if pos == -1:
+            return
+        return pos + len(_TailScanner.TABLE_END)
 
     def task_board(self, task):
-        # We need to do decoding by ourself because lxml
-        # will not see meta charset info in page chunks.
-        data = task["_data"].decode("utf-8")
-        nodes = [etree.HTML(thr) for thr in data.split("<hr />")[2:-1]]
+        tree = etree.HTML(task["_data"], self._utf8_parser)
         threads = []
-        is_first = True
-        for node in nodes:
-            thread = self._get_thread_node(node, is_first)
-            is_first = False
+        for node in self._get_thread_groups(tree):
+            thread = self._get_thread_node(node)
             thread_id = self._get_post_id(thread)
-            (text, xhtml) = self._parse_post(
-                thread, task, is_op_post=True, show_images=False,
-                render_xhtml=False, thread_id=thread_id)
-            xhtml = E.span(E.br(), self._HR, E.br(), xhtml)
+            op_post = self.renderer.render_post(
+                self._parse_post(
+                    thread, task, is_op_post=True, thread_id=thread_id),
+                show_images=False)
             posts = thread.findall(".//td[@class='reply']")
             if posts:
                 omitted_node = thread.find("span[@class='omittedposts']")
                 if omitted_node is None:
-                    omitted_text = ""
-                    omitted_xhtml = E.br()
+                    omitted = None
                 else:
                     omitted = omitted_node.text
                     omitted = omitted[:omitted.find(".")+1].strip()
-                    omitted_text = u"\n\n/%s/" % omitted
-                    omitted_xhtml = E.span(
-                        E.br(), E.br(), omitted, E.br(),
-                        style="color: #707070;")
-                (text2, xhtml2) = self._parse_post(
-                    posts[-1], task, show_images=False,
-                    render_xhtml=False, thread_id=thread_id)
-                text += omitted_text + "\n\n" + text2
-                xhtml.extend((omitted_xhtml, xhtml2))
-            threads.insert(0, (text, self._to_s(xhtml)))
+                last_post = self.renderer.render_post(
+                    self._parse_post(posts[-1], task, thread_id=thread_id),
+                    show_images=False)
+                thread = self.renderer.render_thread(
+                    op_post, omitted, last_post)
+            else:
+                thread = self.renderer.render_thread(op_post)
+            threads.insert(0, thread)
         # Add separator
         if threads:
-            threads.insert(
-                0, (self._HR2, self._to_s(E.span(E.br(), self._HR2))))
+            threads.insert(0, self.renderer.render_separator())
         return {"threads": threads}
 
-    def _get_thread_node(self, node, is_first):
+    def _get_thread_groups(self, tree):
+        """Return list of board page threads. Thread is
+        the group of delete form children between <hr>s;
+        the group is moved into div container in the form.
+        """
+        form = tree.find(".//form[@id='delform']")
+        if form is None:
+            return []
+        groups = []
+        group = None
+        for node in list(form):
+            if node.tag == "hr":
+                if group is not None:
+                    groups.append(group)
+                group = None
+                continue
+            if group is None:
+                group = etree.SubElement(form, "div")
+            group.append(node)
+        # The last group is delete form controls.
+        return groups
+
+    def _get_thread_node(self, node):
         """Placed in separate method because it
         overriden in subclass parsers.
         """
-        if is_first:
-            return node.find("body/form")
-        else:
-            return node.find("body")
+        return node
 
     def _get_post_id(self, post_node):
         return int(post_node.find("a[@name]").get("name"))
 
-    def _parse_post(self, post_node, task,
-                    is_op_post=False, show_images=True,
-                    render_xhtml=True, thread_id=None):
+    def _parse_post(self, post_node, task, is_op_post=False, thread_id=None):
+        """Return post record (see PostRenderer)."""
         post = {}
-        label = post_node.find("label")
+        # Label spans by class; the first one wins.
+        spans = {}
+        for span in _LABEL_SPANS(post_node):
+            spans.setdefault(span.get("class"), span)
         if is_op_post:
-            title_class = "filetitle"
+            title = spans.get("filetitle")
+            author_node = spans["postername"]
         else:
-            title_class = "replytitle"
-        title = label.find("span[@class='%s']" % title_class)
+            title = spans.get("replytitle")
+            author_node = spans["commentpostername"]
         if title is None:
             post["title"] = ""
         else:
             post["title"] = title.text
-        if is_op_post:
-            author_node_class = "postername"
-        else:
-            author_node_class = "commentpostername"
-        author_node = label.find("span[@class='%s']" % author_node_class)
         author_email_node = author_node.find("a")
         if author_email_node is None:
             post["author_email"] = ""
@@ -139,7 +178,7 @@ class Wakaba(Parser):
             post["author_name"] = author_email_node.text
         if not post["author_name"]:
             post["author_name"] = ""
-        trip_node = label.find("span[@class='postertrip']")
+        trip_node = spans.get("postertrip")
         if trip_node is None:
             post["trip_text"] = ""
             post["trip_email"] = ""
@@ -153,170 +192,339 @@ class Wakaba(Parser):
                 post["trip_text"] = trip_email_node.text
                 post["trip_email"] = trip_email_node.get("href")
             post["date"] = trip_node.tail.strip()
-        post["id"] = post_node.find("a[@name]").get("name")
-        filesize_node = post_node.find("span[@class='filesize']")
-        if filesize_node is None:
+        post["id"] = _POST_ID(post_node)[0]
+        filesize_node = _FILESIZE(post_node)
+        if filesize_node:
+            em_node = filesize_node[0].find("em")
+        else:
+            em_node = None
+        # TODO: parse it right.
+        if em_node is None:
             post["img_src"] = ""
         else:
-            em_node = filesize_node.find("em")
-            # TODO: parse it right.
-            if em_node is None:
-                post["img_src"] = ""
-            else:
-                host = "http://" + task["host"]
-                img_a = filesize_node.find("a")
-                post["img_src"] = host + img_a.get("href")
-                post["img_name"] = img_a.text
-                post["img_size"] = em_node.text
-                img_thumb = post_node.find(".//img[@class='thumb']")
-                post["img_thumb_src"] = host + img_thumb.get("src")
+            host = "http://" + task["host"]
+            img_a = filesize_node[0].find("a")
+            post["img_src"] = host + img_a.get("href")
+            post["img_name"] = img_a.text
+            post["img_size"] = em_node.text
+            img_thumb = _THUMB(post_node)[0]
+            post["img_thumb_src"] = host + img_thumb.get("src")
         # Body
-        post_body_node = post_node.find("blockquote")
-        body = []
-        post["body_xhtml"] = E.span()
-        for node in post_body_node:
-            s = ""
-            tag = E.span()
-            if (node.tag == "blockquote" and
-                node.get("class") == "unkfunc"):
-                tag.set("style", "color: #789922;")
-            elif (node.tag == "div" and
-                  node.get("class") == "abbrev"):
-                tag.set("style", "color: #707070;")
-            elif node.tag == "pre":
-                tag.set("style", "font-family: monospace;")
+        host = task["host"]
+        post["body"] = body = []
+        for node in _BODY(post_node)[0]:
+            kind = _BLOCK_KINDS.get((node.tag, node.get("class")))
+            if kind is None and node.tag == "pre":
+                kind = "pre"
                 node = node[0]
-            # Should be E.p() without additional brs but
-            # xmpp clients processing it incorrect.
-            tag.extend((E.br(), E.br()))
+            items = []
             if node.text:
-                s += node.text
-                tag[-1].tail = node.text
+                items.append(("text", node.text))
             # TODO: <strong><em>bold and italic</em></strong>
             # TODO: ul, ol
             for child in node:
-                if child.tag == "a":
-                    s += child.text
-                    url = child.get("href")
-                    if url.startswith("/"):
-                        url = "http://" + task["host"] + url
-                    tag.append(E.a(child.text, href=url))
-                elif child.tag == "br":
-                    s += "\n"
-                    tag.append(E.br())
-                elif child.tag == "strong":
-                    s += "*%s*" % child.text
-                    tag.append(
-                        E.span(child.text, style="font-weight: bold;"))
-                elif child.tag == "em":
-                    # TODO: baaaad hack, fix it!
-                    if child.text is None:
-                        child.text = ""
-                    s += "/%s/" % child.text
-                    tag.append(
-                        E.span(child.text, style="font-style: italic;"))
-                elif child.tag == "del":
-                    s += "-%s-" % child.text
-                    tag.append(E.span(
-                        child.text,
-                        style="text-decoration: line-through;"))
-                elif child.tag == "code":
-                    s += child.text
-                    tag.append(
-                        E.span(child.text, style="font-family: monospace;"))
-                elif child.tag == "span" and child.get("class") == "spoiler":
-                    s += "%%%%%s%%%%" % child.text
-                    tag.append(E.span(
-                        child.text,
-                        style="color: #F0D0B6; background-color: #F0D0B6;"))
+                handler = _INLINE_HANDLERS.get(child.tag)
+                if handler is not None:
+                    item = handler(child, host)
+                else:
+                    item = None
+                if item is not None:
+                    items.append(item)
+                elif (child.tail and items and
+                      items[-1][0] == "text"):
+                    # Node is skipped; its tail replaces previous
+                    # text in xhtml (like lxml tail did in the tree
+                    # renderer) so that text is kept in text only.
+                    items[-1] = ("plain", items[-1][1])
                 if child.tail:
-                    s += child.tail
-                    tag[-1].tail = child.tail
-            body.append(s)
-            post["body_xhtml"].append(tag)
-        post["body"] = u"\n\n".join(body)
-        return self._format_post(
-            post, task, show_images, render_xhtml, thread_id)
-
-    def _format_post(self, post, task, show_images, render_xhtml, thread_id):
-        """Format post to text and xhtml representations."""
-        # Text formatting
+                    items.append(("text", child.tail))
+            body.append((kind, items))
+        post["url"] = self._get_post_url(post, task, thread_id)
+        return post
+
+    def _get_post_url(self, post, task, thread_id):
         if thread_id is None:
             url = task["url"]
         else:
             url = "%sres/%d.html" % (task["url"], thread_id)
         if str(thread_id) != post["id"]:
-            post_url = "%s#%s" %(url, post["id"])
-        else:
-            post_url = url
-        if post["title"]:
-            title = post["title"] + " "
-        else:
-            title = ""
-        if post["author_email"]:
-            email = " <%s>" % post["author_email"]
-        else:
-            email = ""
-        if post["img_src"]:
-            img = "\nFile: %s -(%s) <%s>" % (
-                post["img_name"], post["img_size"], post["img_src"])
-        else:
-            img = ""
-        if post["body"]:
-            body = "\n\n" + post["body"]
-        else:
-            body = ""
-        text = u"%s\n%s%s%s%s %s No.%s%s%s" % (
-            post_url, title, post["author_name"], post["trip_text"],
-            email, post["date"], post["id"], img, body)
-        # XHTML formatting
-        if post["title"]:
-            title = E.span(
-                post["title"], " ",
-                style="font-size: larger; font-weight: bold; color: #CC1105;")
-        else:
-            title = ""
-        if post["author_name"]:
-            if post["author_email"]:
-                author_text = E.a(
-                    post["author_name"], href=post["author_email"])
-            else:
-                author_text = post["author_name"]
-            author = E.span(
-                author_text, style="color: #117743; font-weight: bold;")
+            return "%s#%s" %(url, post["id"])
+        return url
+
+
+# Post fields lookups of Wakaba._parse_post.
+_LABEL_SPANS = etree.XPath("label[1]/span")
+_POST_ID = etree.XPath("a[@name][1]/@name", smart_strings=False)
+_FILESIZE = etree.XPath("span[@class='filesize'][1]")
+_THUMB = etree.XPath("descendant::img[@class='thumb'][1]")
+_BODY = etree.XPath("blockquote[1]")
+
+# (tag, class) -> kind of post body blocks.
+_BLOCK_KINDS = {
+    ("blockquote", "unkfunc"): "quote",
+    ("div", "abbrev"): "abbrev",
+}
+
+
+def _format_link(child, host):
+    url = child.get("href")
+    if url.startswith("/"):
+        url = "http://" + host + url
+    return ("link", child.text or "", url)
+
+
+def _format_br(child, host):
+    return ("br",)
+
+
+def _format_span(child, host):
+    if child.get("class") == "spoiler":
+        return ("spoiler", child.text or "")
+
+
+def _styled(kind):
+    def format(child, host):
+        return (kind, child.text or "")
+    return format
+
+
+# Inline tag -> function which returns body record item of
+# the node or None if node is skipped. Empty nodes are
+# rendered as empty.
+_INLINE_HANDLERS = {
+    "a": _format_link,
+    "br": _format_br,
+    "strong": _styled("strong"),
+    "em": _styled("em"),
+    "del": _styled("del"),
+    "code": _styled("code"),
+    "span": _format_span,
+}
+
+
+class _ThreadUpdates(object):
+    """Collects thread posts and makes result of the
+    thread_updates task.
+    """
+
+    def __init__(self, wakaba, task):
+        self._wakaba = wakaba
+        self._task = task
+        self._has_posts = False
+        self._last = task.get("last")
+        self._updates = []
+
+    def is_known(self, post_id):
+        """Whether post was parsed in the past so its
+        node isn't needed.
+        """
+        if "last" in self._task and post_id <= self._task["last"]:
+            self._has_posts = True
+            return True
+        return False
+
+    def add_post(self, post_node):
+        self._has_posts = True
+        post_id = self._wakaba._get_post_id(post_node)
+        if "last" not in self._task:
+            # Wasn't parsed; we need just last post's id
+            self._last = post_id
+        elif post_id > self._task["last"]:
+            # Was parsed in the past; collect new posts
+            self._updates.append(
+                self._wakaba._parse_post(post_node, self._task))
+            self._last = post_id
+
+    def get_result(self, scanner):
+        if not self._has_posts and not self._task.get("_offset"):
+            return {"last": 0}
+        if self._updates:
+            result = {"last": self._last, "updates": self._updates}
+        elif "last" in self._task:
+            result = {}
         else:
-            author = ""
-        if post["trip_text"]:
-            if post["trip_email"]:
-                trip_text = E.a(post["trip_text"], href=post["trip_email"])
+            result = {"last": self._last}
+        offset = scanner.offsets.get(str(self._last))
+        if offset is not None:
+            result["offset"] = offset
+        return result
+
+
+class _TailScanner(object):
+    """Scans raw page chunks and finds page offsets of the
+    tails which follow posts i.e. offset of the first
+    </table> end after post's anchor.
+    """
+
+    ANCHOR = '<a name="'
+    TABLE_END = "</table>"
+
+    def __init__(self, base):
+        # Post id (as string) -> tail offset
+        self.offsets = {}
+        self._pending = []
+        self._buf = ""
+        # Page offset of the unscanned buffer
+        self._base = base
+
+    def feed(self, data):
+        buf = self._buf + data
+        pos = 0
+        while True:
+            anchor = buf.find(self.ANCHOR, pos)
+            table_end = buf.find(self.TABLE_END, pos)
+            if anchor != -1 and (table_end == -1 or anchor < table_end):
+                start = anchor + len(self.ANCHOR)
+                end = buf.find('">', start)
+                if end == -1:
+                    # Anchor was cut; wait for the next chunk.
+                    pos = anchor
+                    break
+                self._pending.append(buf[start:end])
+                pos = end
+            elif table_end != -1:
+                pos = table_end + len(self.TABLE_END)
+                for post_id in self._pending:
+                    self.offsets[post_id] = self._base + pos
+                self._pending = []
             else:
-                trip_text = post["trip_text"]
-            trip = E.span(trip_text, style="color: #228854;")
-        else:
-            trip = ""
-        if post["img_src"]:
-            img = [
-                E.br(),
-                "File: ", E.a(post["img_name"], href=post["img_src"]),
-                " - (", E.span(post["img_size"], style="font-style: italic;"),
-                ")"]
-            if show_images:
-                img.extend((
-                    E.br(),
-                    E.a(E.img(
-                        alt="img", src=post["img_thumb_src"]),
-                        href=post["img_src"])))
+                # Keep possibly cut pattern.
+                pos = max(pos, len(buf) - len(self.ANCHOR) + 1)
+                break
+        self._buf = buf[pos:]
+        self._base += pos
+
+
+class _PostsTarget(object):
+    """lxml parser target which builds trees only for reply
+    posts and passes every finished post node to callback.
+    Posts whose ids are known (by is_known predicate) are
+    skipped without building.
+    """
+
+    def __init__(self, callback, is_known=None):
+        self._callback = callback
+        self._is_known = is_known
+        self._builder = None
+        self._depth = 0
+
+    def start(self, tag, attrib):
+        if self._builder is None:
+            if tag != "td" or attrib.get("class") != "reply":
+                return
+            post_id = attrib.get("id", "")[len("reply"):]
+            if (self._is_known is not None and post_id.isdigit() and
+                self._is_known(int(post_id))):
+                return
+            self._builder = etree.TreeBuilder()
+        self._depth += 1
+        self._builder.start(tag, attrib)
+
+    def end(self, tag):
+        if self._builder is None:
+            return
+        self._builder.end(tag)
+        self._depth -= 1
+        if not self._depth:
+            node = self._builder.close()
+            self._builder = None
+            self._callback(node)
+
+    def data(self, data):
+        if self._builder is not None:
+            self._builder.data(data)
+
+    def close(self):
+        pass
+
+
+class _ThreadUpdatesStream(object):
+    """Parses thread page chunks as they arrive; reply
+    posts are processed as soon as they are complete.
+
+    If the whole page is fetched for known thread, chunks
+    are buffered until the end of the last known post is
+    found and only the page tail after it is parsed (see
+    Wakaba._find_tail); page without that post is parsed
+    entirely when it ends.
+    """
+
+    def __init__(self, wakaba, task):
+        self._wakaba = wakaba
+        self._task = task
+        self._fed = False
+        if not task.get("_offset") and "last" in task:
+            self._buf = bytearray()
+            self._reply = 'id="reply%d"' % task["last"]
+            self._reply_pos = None
+            # Buffer before this offset has no pattern
+            # which is looked for.
+            self._searched = 0
         else:
-            img = ()
-        xhtml = E.span(
-            E.br(), title, author, trip,
-            " ", post["date"], " ",
-            E.a("No.", post["id"], href=post_url),
-            *img)
-        xhtml.append(post["body_xhtml"])
-        if render_xhtml:
-            xhtml = self._to_s(xhtml)
-        return (text, xhtml)
-
-    def _to_s(self, node):
-        return etree.tostring(node, encoding=unicode)
+            self._buf = None
+            self._start(task.get("_offset", 0))
+
+    def _start(self, base):
+        task = self._task
+        if base:
+            task = dict(task, _offset=base)
+        self._updates = _ThreadUpdates(self._wakaba, task)
+        self._scanner = _TailScanner(base)
+        # Don't rely on meta charset info in the middle of
+        # the stream (see Wakaba._utf8_parser).
+        self._parser = etree.HTMLParser(
+            target=_PostsTarget(
+                self._updates.add_post, self._updates.is_known),
+            encoding="utf-8")
+
+    def feed(self, data):
+        if self._buf is not None:
+            self._buf.extend(data)
+            tail = self._find_tail()
+            if tail is None:
+                return
+            data = str(self._buf[tail:])
+            self._buf = None
+            self._start(tail)
+            self._scanner.offsets[str(self._task["last"])] = tail
+            if not data:
+                return
+        self._fed = True
+        self._scanner.feed(data)
+        self._parser.feed(data)
+
+    def _find_tail(self):
+        """Return offset of the page tail after the last
+        known post or None if it isn't received yet.
+        """
+        buf = self._buf
+        if self._reply_pos is None:
+            pos = buf.find(
+                self._reply, max(self._searched - len(self._reply) + 1, 0))
+            if pos == -1:
+                self._searched = len(buf)
+                return
+            self._reply_pos = self._searched = pos
+        table_end = _TailScanner.TABLE_END
+        pos = buf.find(
+            table_end,
+            max(self._searched - len(table_end) + 1, self._reply_pos))
+        if pos == -1:
+            self._searched = len(buf)
+            return
+        return pos + len(table_end)
+
+    def close(self):
+        if self._buf is not None:
+            # Last known post isn't in the page (e.g. it
+            # was deleted); parse the whole page.
+            data = str(self._buf)
+            self._buf = None
+            self._start(0)
+            if data:
+                self._fed = True
+                self._scanner.feed(data)
+                self._parser.feed(data)
+        if self._fed:
+            self._parser.close()
+        return self._updates.get_result(self._scanner)
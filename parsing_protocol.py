@@ -1,48 +1,210 @@
-import cPickle
+import time
 from twisted.python import log
 from twisted.internet import defer, reactor, protocol, error
-from pipe_protocol import PipeProtocol
+from pipe_protocol import PipeProtocol, unpack_records
 import config
 
 
+class ParsingStream(object):
+    """Passes page chunks to the worker as they arrive so
+    it could parse page incrementally.
+    """
+
+    def __init__(self, proto, task_id, d):
+        self._proto = proto
+        self._id = task_id
+        self._d = d
+
+    def _alive(self):
+        # Worker could die in the middle of the stream.
+        return self._id in self._proto._callbacks
+
+    def write(self, data):
+        if self._alive():
+            self._proto._send({"_id": self._id, "_chunk": True}, data)
+
+    def finish(self):
+        """Return deferred which fires with parse result."""
+        if self._alive():
+            self._proto._send({"_id": self._id, "_end": True})
+            self._proto._set_ready(self._id)
+        return self._d
+
+    def abort(self):
+        if self._alive():
+            self._proto._send({"_id": self._id, "_abort": True})
+            self._proto._pop_callback(self._id)
+
+
 class ParsingProtocol(protocol.ProcessProtocol):
+    """Parsing worker process. Died worker is respawned with
+    exponential backoff; worker which doesn't return result
+    in PARSE_TIMEOUT is considered stuck and killed. Pending
+    tasks of died worker are failed, not re-dispatched: page
+    which killed one worker would kill the next one too.
+    """
+
+    # Max seconds of worker's work on one task.
+    PARSE_TIMEOUT = 30
+    RESPAWN_DELAY = 1
+    MAX_RESPAWN_DELAY = 60
 
-    def __init__(self, xmpp):
+    def __init__(self, xmpp, clock=None):
+        if clock is None:
+            clock = reactor
         self._xmpp = xmpp
+        self._clock = clock
         self._proto = PipeProtocol()
         self._callbacks = {}
         self._id = 0
+        # Total time spent with non-empty queue.
+        self._busy_time = 0
+        self._busy_since = None
+        # Tasks which were sent completely so the worker
+        # should return their results.
+        self._ready = set()
+        self._deadline = None
+        # Packets sent while the worker is not running.
+        self._queue = []
+        self._respawn_delay = self.RESPAWN_DELAY
+        self._respawn = None
+        self._stopped = False
+        self.running = False
+        self.restarts = 0
 
     def start(self):
+        self._respawn = None
         reactor.spawnProcess(self, "parsing_worker.py")
 
     def stop(self):
+        self._stopped = True
+        if self._respawn is not None and self._respawn.active():
+            self._respawn.cancel()
         try:
             self.transport.signalProcess("KILL")
         except error.ProcessExitedAlready:
             pass
 
+    def connectionMade(self):
+        self.running = True
+        queue, self._queue = self._queue, []
+        self.transport.writeSequence(queue)
+        self._set_deadline()
+
+    def processEnded(self, reason):
+        self.running = False
+        self._cancel_deadline()
+        self._proto = PipeProtocol()
+        self._queue = []
+        self._ready = set()
+        callbacks = self._callbacks.items()
+        for task_id, d in callbacks:
+            self._pop_callback(task_id)
+        if not self._stopped:
+            self.restarts += 1
+            self._report(
+                u"PARSING WORKER DIED (%d tasks failed):\n\n%s" % (
+                    len(callbacks), reason.getErrorMessage()))
+            self._respawn = self._clock.callLater(
+                self._respawn_delay, self.start)
+            self._respawn_delay = min(
+                self._respawn_delay * 2, self.MAX_RESPAWN_DELAY)
+        for task_id, d in sorted(callbacks):
+            d.callback({"_error": True, "_id": task_id})
+
     def outReceived(self, out):
         packets = self._proto.decode(out)
-        for packet in packets:
-            parsed = cPickle.loads(packet)
-            self._callbacks[parsed["_id"]].callback(parsed)
-            del self._callbacks[parsed["_id"]]
+        for message, payload in packets:
+            parsed = unpack_records(message, payload)
+            self._respawn_delay = self.RESPAWN_DELAY
+            if parsed["_id"] in self._callbacks:
+                d = self._pop_callback(parsed["_id"])
+            else:
+                # Stream was aborted after it was finished.
+                d = None
+            self._set_deadline()
+            if d is not None:
+                d.callback(parsed)
 
     def errReceived(self, err):
-        report = u"PARSING WORKER ERROR:\n\n%s" % err
+        self._report(u"PARSING WORKER ERROR:\n\n%s" % err)
+
+    def _report(self, report):
         log.msg(report)
         self._xmpp.send_message(
             to=config.error_report_jid, from_=config.main_full_jid,
             body=report)
 
-    def parse(self, task, data):
+    def _set_deadline(self):
+        """Restart deadline of the current task after the
+        worker made progress.
+        """
+        self._cancel_deadline()
+        if self.running and self._ready:
+            self._deadline = self._clock.callLater(
+                self.PARSE_TIMEOUT, self._stuck)
+
+    def _cancel_deadline(self):
+        if self._deadline is not None and self._deadline.active():
+            self._deadline.cancel()
+        self._deadline = None
+
+    def _stuck(self):
+        self._deadline = None
+        log.msg("PARSING WORKER STUCK, KILLING")
+        try:
+            self.transport.signalProcess("KILL")
+        except error.ProcessExitedAlready:
+            pass
+
+    def _set_ready(self, task_id):
+        self._ready.add(task_id)
+        if self._deadline is None:
+            self._set_deadline()
+
+    def _send(self, message, payload=""):
+        encoded = self._proto.encode(message, payload)
+        if self.running:
+            self.transport.writeSequence(encoded)
+        else:
+            self._queue.extend(encoded)
+
+    def _add_callback(self):
         self._id += 1
-        d = defer.Deferred()
-        self._callbacks[self._id] = d
+        if not self._callbacks:
+            self._busy_since = time.time()
+        d = self._callbacks[self._id] = defer.Deferred()
+        return d
+
+    def _pop_callback(self, task_id):
+        d = self._callbacks.pop(task_id)
+        self._ready.discard(task_id)
+        if not self._callbacks:
+            self._busy_time += time.time() - self._busy_since
+            self._busy_since = None
+        return d
+
+    def get_info(self):
+        """Return (queue length, busy seconds)."""
+        busy_time = self._busy_time
+        if self._busy_since is not None:
+            busy_time += time.time() - self._busy_since
+        return len(self._callbacks), busy_time
+
+    def parse(self, task, data):
+        d = self._add_callback()
         task = task.copy()
         task["_id"] = self._id
-        task["_data"] = data
-        encoded = self._proto.encode(cPickle.dumps(task, protocol=2))
-        self.transport.write(encoded)
+        # Page is sent as raw payload.
+        self._send(task, data)
+        self._set_ready(self._id)
         return d
+
+    def parse_stream(self, task):
+        """Start streaming task. Return ParsingStream."""
+        d = self._add_callback()
+        task = task.copy()
+        task["_id"] = self._id
+        task["_stream"] = True
+        self._send(task)
+        return ParsingStream(self, self._id, d)
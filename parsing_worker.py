@@ -2,39 +2,114 @@
 
 import os
 import sys
-import time
-import fcntl
-import select
-import cPickle
 import traceback
 from parsers import parsers
-from pipe_protocol import PipeProtocol
+from pipe_protocol import PipeProtocol, pack_records
 
 
-# Set stdin in nonblocking-mode
-fd = sys.stdin.fileno()
-fl = fcntl.fcntl(fd, fcntl.F_GETFL)
-fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+def report_error(task):
+    task = task.copy()
+    task.pop("_data", None)
+    err = "TASK:\n%s\n\nTRACEBACK:\n%s" % (
+        repr(task), traceback.format_exc()[:-1])
+    sys.stderr.write(err)
 
+
+def do_task(task):
+    try:
+        res = parsers[task["parser"]].do_task(task)
+        if not res:
+            res = {}
+    except Exception:
+        report_error(task)
+        res = {"_error": True}
+    return res
+
+
+# Streaming tasks: id -> (task, feeder). Feeder is None
+# if task already failed.
+streams = {}
+
+
+def start_stream(task):
+    try:
+        feeder = parsers[task["parser"]].start_task(task)
+    except Exception:
+        report_error(task)
+        feeder = None
+    streams[task["_id"]] = (task, feeder)
+
+
+def feed_stream(task_id, data):
+    task, feeder = streams.get(task_id, (None, None))
+    if feeder is None:
+        return
+    try:
+        feeder.feed(data)
+    except Exception:
+        report_error(task)
+        streams[task_id] = (task, None)
+
+
+def finish_stream(task_id):
+    task, feeder = streams.pop(task_id, (None, None))
+    if feeder is None:
+        return {"_error": True}
+    try:
+        res = feeder.close()
+        if not res:
+            res = {}
+    except Exception:
+        report_error(task)
+        res = {"_error": True}
+    return res
+
+
+def handle(task, payload):
+    """Process packet. Return result or None if
+    there is no result yet.
+    """
+    task_id = task["_id"]
+    res = None
+    if "_chunk" in task:
+        feed_stream(task_id, payload)
+    elif "_end" in task:
+        res = finish_stream(task_id)
+    elif "_abort" in task:
+        streams.pop(task_id, None)
+    elif "_stream" in task:
+        start_stream(task)
+    else:
+        task["_data"] = payload
+        res = do_task(task)
+    if res is not None:
+        res["_id"] = task_id
+    return res
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+# Pipe read size; large pages arrive in a few reads.
+READ_SIZE = 1024 * 1024
+
+stdin_fd = sys.stdin.fileno()
+stdout_fd = sys.stdout.fileno()
 proto = PipeProtocol()
 while True:
-    select.select([sys.stdin], [], [])
-    data = sys.stdin.read()
-    packets = proto.decode(data)
-    for packet in packets:
-        task = cPickle.loads(packet)
-        try:
-            res = parsers[task["parser"]].do_task(task)
-            if not res:
-                res = {}
-        except Exception:
-            del task["_data"]
-            err = "TASK:\n%s\n\nTRACEBACK:\n%s" % (
-                repr(task), traceback.format_exc()[:-1])
-            sys.stderr.write(err)
-            res = {"_error": True}
-        res["_id"] = task["_id"]
-        encoded = proto.encode(cPickle.dumps(res, protocol=2))
-        sys.stdout.write(encoded)
-        sys.stdout.flush()
-    time.sleep(0.001)
+    # Blocks until parent sends something; empty read
+    # means parent closed the pipe.
+    data = os.read(stdin_fd, READ_SIZE)
+    if not data:
+        break
+    results = []
+    for task, payload in proto.decode(data):
+        res = handle(task, payload)
+        if res is not None:
+            results.extend(proto.encode(*pack_records(res)))
+    if results:
+        # All results of the batch in one write.
+        write_all(stdout_fd, "".join(results))
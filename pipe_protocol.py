@@ -1,34 +1,144 @@
+import json
+import struct
+import marshal
+from itertools import izip
+
+
+_PREFIX = struct.Struct(">II")
+
+
 class PipeProtocol(object):
     """Pipe protocol implementation.
     Specification:
-        <packet length>|<packet><next packet length>|<packet>
-    Example:
-        6|packet10|new packet
+        <header length><payload length><header><payload>...
+    Lengths are 4-byte big-endian unsigned integers. Header
+    is a message dict in compact JSON; payload is raw bytes
+    (page data) passed as is without any serialization.
+    Packets which are received whole in one read are sliced
+    right from it. Parts (prefix, header, payload) of the
+    packet which spans reads are collected in chunks and
+    joined once, so every payload is copied only once.
     """
 
     def __init__(self):
-        self._data = ""
-        self._len = None
+        # Received chunks of the incomplete part.
+        self._chunks = []
+        self._length = 0
+        # Incomplete part is the prefix if message is None
+        # and header length is None, the header if only
+        # message is None, the payload otherwise.
+        self._header_len = None
+        self._payload_len = None
+        self._message = None
 
     def decode(self, data):
+        """Return list of received (message, payload)."""
         packets = []
-        self._data += data
-        while True:
-            if self._len is None:
-                pos = self._data.find("|")
-                if pos == -1: break
-                self._len = int(self._data[:pos])
-                self._data = self._data[pos+1:]
-            if len(self._data) >= self._len:
-                packet = self._data[:self._len]
-                self._data = self._data[self._len:]
-                self._len = None
-                packets.append(packet)
-            else:
+        pos = 0
+        if self._chunks or self._header_len is not None:
+            pos = self._feed(data, 0, packets)
+        end = len(data)
+        unpack_from = _PREFIX.unpack_from
+        loads = json.loads
+        while end - pos >= _PREFIX.size:
+            header_len, payload_len = unpack_from(data, pos)
+            start = pos + _PREFIX.size
+            payload_start = start + header_len
+            payload_end = payload_start + payload_len
+            if payload_end > end:
                 break
+            packets.append((
+                loads(data[start:payload_start]),
+                data[payload_start:payload_end]))
+            pos = payload_end
+        if pos < end:
+            self._feed(data, pos, packets)
         return packets
 
-    def encode(self, packet):
-        if type(packet) is unicode:
-            packet = packet.encode("utf-8")
-        return str(len(packet)) + "|" + packet
+    def _feed(self, data, pos, packets):
+        """Process data from pos as continuation of the
+        incomplete packet. Return position after the packet
+        or end of data.
+        """
+        end = len(data)
+        while True:
+            if self._header_len is None:
+                need = _PREFIX.size
+            elif self._message is None:
+                need = self._header_len
+            else:
+                need = self._payload_len
+            missing = need - self._length
+            if end - pos < missing:
+                if pos < end:
+                    self._chunks.append(data[pos:])
+                    self._length += end - pos
+                return end
+            if self._chunks:
+                self._chunks.append(data[pos:pos+missing])
+                part = "".join(self._chunks)
+                self._chunks = []
+                self._length = 0
+            else:
+                part = data[pos:pos+need]
+            pos += missing
+            if self._header_len is None:
+                self._header_len, self._payload_len = _PREFIX.unpack(part)
+            elif self._message is None:
+                self._message = json.loads(part)
+            else:
+                packets.append((self._message, part))
+                self._header_len = self._payload_len = None
+                self._message = None
+                return pos
+
+    def encode(self, message, payload=""):
+        """Return list of strings to be written in order.
+        Payload is not copied.
+        """
+        # Values JSON doesn't know (like ObjectId of
+        # subscription document) are sent as strings.
+        header = json.dumps(
+            message, separators=(",", ":"),
+            ensure_ascii=False, default=unicode)
+        if type(header) is unicode:
+            header = header.encode("utf-8")
+        prefix = _PREFIX.pack(len(header), len(payload))
+        if payload:
+            return [prefix + header, payload]
+        return [prefix + header]
+
+
+# Version of marshal format; both sides run Python 2 so
+# the format is the same.
+_MARSHAL_VERSION = 2
+
+
+def pack_records(message):
+    """Move lists of records (like post updates: dicts or
+    tuples of texts) out of the message into marshal payload;
+    JSON is too slow for large unicode strings and Python
+    level packing is slower to decode than cPickle.
+    Return (message, payload).
+    """
+    message = message.copy()
+    keys = []
+    records = []
+    for key, value in message.items():
+        if not (isinstance(value, list) and value and
+                isinstance(value[0], (tuple, dict))):
+            continue
+        keys.append(key)
+        records.append(message.pop(key))
+    if not keys:
+        return message, ""
+    message["_records"] = keys
+    return message, marshal.dumps(records, _MARSHAL_VERSION)
+
+
+def unpack_records(message, payload):
+    """Reverse pack_records."""
+    keys = message.pop("_records", ())
+    if keys:
+        message.update(izip(keys, marshal.loads(payload)))
+    return message
@@ -2,6 +2,7 @@ import re
 from twisted.application import service
 from twisted.internet import defer
 from parsing_protocol import ParsingProtocol
+from worker_pool import WorkerPool
 from utils import _NotHandled, trim
 import config
 
@@ -83,7 +84,9 @@ class PluginsService(service.Service):
 
     def __init__(self, xmpp_component):
         self._xmpp = xmpp_component
-        self._worker = ParsingProtocol(xmpp_component)
+        self._worker = WorkerPool([
+            ParsingProtocol(xmpp_component)
+            for i in range(config.parsing_workers)])
 
     def startService(self):
         def do_class(matchobj):
@@ -1,6 +1,6 @@
 from twisted.internet import defer
 from plugins.subscriptions import Subscriptions
-from fetcher import get_page
+from fetcher import get_page, configure_host
 from parsers import parsers
 import utils
 import config
@@ -26,6 +26,15 @@ class Chans(Subscriptions):
         self._urls_re = {}
         for item in config:
             self._chans[item["host"]] = item["parser"]
+            configure_host(
+                item["host"],
+                max_connections=self._get_number(
+                    item, "max_connections", int),
+                idle_timeout=self._get_number(item, "idle_timeout", int))
+            utils.host_limiter.configure(
+                item["host"],
+                rate=self._get_number(item, "rate", float),
+                burst=self._get_number(item, "burst", int))
             parser = parsers[item["parser"]]
             r = parser.get_thread_re(item["host"])
             self._urls_re[r] = {
@@ -35,6 +44,10 @@ class Chans(Subscriptions):
             }
         self._chans_str = u"Chans:\n" + u"\n".join(self._chans.keys())
 
+    def _get_number(self, item, key, type_):
+        if key in item:
+            return type_(item[key])
+
     def url_match(self, url):
         for regex in self._urls_re:
             if regex.match(url) is not None:
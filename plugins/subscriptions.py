@@ -4,6 +4,7 @@ from fetcher import get_page
 from plugins import Plugin
 from parsers import parsers
 from utils import _NotHandled, get_full_jid, wait_for_host
+from utils import page_flights, page_key
 import config
 
 
@@ -17,6 +18,7 @@ class Subscriptions(Plugin):
             (r"[Ss] +(\S+)", self.subscribe),
             (r"[Uu](?: +(\S+))?", self.unsubscribe),
             (r"[Ll]", self.list_subscriptions),
+            (r"[Mm]erge(?: +(on|off))?", self.merge_updates),
         )
 
     def url_match(self, url):
@@ -62,16 +64,15 @@ class Subscriptions(Plugin):
                 to=user_jid, from_=sub["jid"],
                 type_="subscribe")
         else:
-            yield wait_for_host(sub["host"], level=2)
             try:
-                page = yield get_page(sub["url"])
+                page, parsed = yield page_flights.run(
+                    page_key(sub), self.fetch_page, sub)
             except Exception:
                 self._xmpp.send_message(
                     to=user_jid, from_=get_full_jid(our_jid),
                     body=u"Url check failed, subscription aborted. "
                           "Seems like not existing url.")
             else:
-                parsed = yield self._worker.parse(sub, page)
                 if "last" in parsed and parsed["last"] is not None:
                     self.process_last(user_jid, our_jid, sub, parsed["last"])
                 else:
@@ -80,6 +81,16 @@ class Subscriptions(Plugin):
                         body=u"Page parsing failed, subscription aborted. "
                               "Seems like not existing url.")
 
+    @defer.inlineCallbacks
+    def fetch_page(self, sub):
+        """Fetch and parse page of new subscription.
+        Return (page, parsed).
+        """
+        yield wait_for_host(sub["host"], level=2)
+        page = yield get_page(sub["url"])
+        parsed = yield self._worker.parse(sub, page.body)
+        defer.returnValue((page, parsed))
+
     @defer.inlineCallbacks
     def unsubscribe(self, user_jid, our_jid, url):
         """U [url]
@@ -114,3 +125,19 @@ class Subscriptions(Plugin):
         lines = [u"Your subscriptions:"]
         lines.extend([sub["url"] for sub in subscriptions])
         defer.returnValue(u"\n".join(lines))
+
+    @defer.inlineCallbacks
+    def merge_updates(self, user_jid, our_jid, value):
+        """Merge [on|off]
+        Merge new posts of the thread into one message
+        (or a few long ones) instead of message per post.
+        Show current mode if called without argument.
+        """
+        settings = UserSettings(user_jid)
+        if value is not None:
+            yield settings.set_merge_updates(value == "on")
+        is_merging = yield settings.get_merge_updates()
+        if is_merging:
+            defer.returnValue(u"New posts are merged.")
+        else:
+            defer.returnValue(u"New posts are sent one by one.")
@@ -1,10 +1,14 @@
+import time
 import traceback
 from twisted.python import log
-from twisted.internet import task, defer
+from twisted.internet import task, defer, reactor, error
 from db_objects import *
-from fetcher import NotFound, get_last_modified, get_page
+import fetcher
+from fetcher import NotFound, NotModified, get_page
 from plugins import Plugin
 from parsers import parsers
+from post_renderer import RenderedPost, merge_posts
+from scheduler import Scheduler, next_interval
 import utils
 import config
 
@@ -12,83 +16,266 @@ import config
 class SubscriptionsUpdater(Plugin):
 
     MAX_CONNECTIONS_COUNT = 50
+    # Max seconds of page fetching and parsing after the
+    # host's request slot is taken; they are abandoned then.
+    PROCESS_TIMEOUT = 60 * 2
+    # How often new subscriptions are looked for.
+    SYNC_TIMEOUT = 60 * 2
+    # Poll interval of new subscription.
     UPDATE_TIMEOUT = 60 * 2
+    # How many slowest in-flight urls are shown in info.
+    SLOWEST_COUNT = 5
+    # Max characters of text and xhtml in message of merged
+    # posts; keeps stanza under usual 64K server limits.
+    MERGED_MESSAGE_SIZE = 16000
+    # Max posts held for offline user per subscription;
+    # older ones are dropped.
+    MAX_HELD_POSTS = 50
+    # Poll interval bounds; could be redefined in config.
+    min_interval = 30
+    max_interval = 60 * 30
+    # What to do with updates for offline users: send
+    # (server stores them as offline messages), skip, hold
+    # (send them when user goes online) or digest (send
+    # them merged when user goes online). Held posts are
+    # kept only in memory and are lost on restart.
+    offline_delivery = "send"
+    OFFLINE_DELIVERIES = ("send", "skip", "hold", "digest")
+
+    def __init__(self, plugins, xmpp, worker, clock=None):
+        super(SubscriptionsUpdater, self).__init__(plugins, xmpp, worker)
+        if clock is None:
+            clock = reactor
+        self._clock = clock
 
     def get_handlers(self):
         return super(SubscriptionsUpdater, self).get_handlers() + (
             (r"[Uu]pd", self.updater_info),
         )
 
+    def reload_config(self, config):
+        if not config: return
+        if "min_interval" in config[0]:
+            self.min_interval = int(config[0]["min_interval"])
+        if "max_interval" in config[0]:
+            self.max_interval = int(config[0]["max_interval"])
+        if "offline_delivery" in config[0]:
+            value = config[0]["offline_delivery"]
+            if value in self.OFFLINE_DELIVERIES:
+                self.offline_delivery = value
+            else:
+                # Bad value shouldn't break reload of other
+                # plugins; previous policy is kept.
+                log.msg("UNKNOWN OFFLINE DELIVERY: %s" % value)
+
     def start(self):
-        self._conn_count = 0
-        self._loop = task.LoopingCall(self.run)
-        self._loop.start(self.UPDATE_TIMEOUT)
+        self._schedule = Scheduler()
+        self._semaphore = defer.DeferredSemaphore(self.MAX_CONNECTIONS_COUNT)
+        # Due urls waiting for the free slot.
+        self._queued = set()
+        # Url -> processing start time.
+        self._in_flight = {}
+        self._timer = None
+        # (user jid, subscription jid) -> posts held until
+        # user goes online; not persisted, lost on restart.
+        self._held = {}
+        self._xmpp.roster.add_watcher(self._user_available)
+        self._loop = task.LoopingCall(self.sync)
+        self._loop.clock = self._clock
+        self._loop.start(self.SYNC_TIMEOUT)
+
+    def stop(self):
+        self._loop.stop()
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
 
     @utils.require_admin
     def updater_info(self, user_jid, our_jid):
+        now = time.time()
+        slowest = sorted(self._in_flight.items(), key=lambda i: i[1])
+        slowest = u"".join([
+            u"\n%ds %s" % (now - started, url)
+            for url, started in slowest[:self.SLOWEST_COUNT]])
+        workers = u", ".join([
+            u"%d (%ds busy)" % info for info in self._worker.get_info()])
+        outbound = self._xmpp.get_queue_info()
+        roster = self._xmpp.roster.get_info()
+        fanout = self._xmpp.get_fanout_info()
         return utils.trim(u"""Updater plugin info:
-            current connections count: %d
-            """ % self._conn_count)
+            in-flight subscriptions: %d
+            queue depth: %d
+            scheduled subscriptions: %d
+            received bytes: %d (decoded: %d)
+            parsing workers queues: %s
+            outbound stanzas: %d pacing, %d replies, %d bulk, %d background
+            sent stanzas: %d (paused by server %d times)
+            fan-out stanzas: %d unicast, %d multicast (%d servers)
+            online users: %d of %d (updates held for %d)
+            slowest in-flight urls:""" % (
+                len(self._in_flight), len(self._queued),
+                len(self._schedule),
+                fetcher.stats["wire_bytes"],
+                fetcher.stats["decoded_bytes"], workers,
+                outbound["pacing"], outbound["replies"],
+                outbound["bulk"], outbound["background"],
+                outbound["sent"],
+                outbound["pauses"], fanout["unicast"],
+                fanout["multicast"], fanout["servers"],
+                roster["online"], roster["users"],
+                len(self._held))) + slowest
 
     def debug(self, msg):
         if config.log_http:
             log.msg(msg)
 
     @defer.inlineCallbacks
-    def run(self):
-        if self._conn_count: return
-        subs = yield Subscription.get_list()
+    def sync(self):
+        """Add new subscriptions to the schedule. Removed
+        subscriptions are dropped when they become due.
+        """
+        subs = yield Subscription.get_list(fields=["url", "next_update"])
+        now = time.time()
         for sub in subs:
-            while self._conn_count >= self.MAX_CONNECTIONS_COUNT:
-                self.debug("MAX CONNECTIONS: %d, WAIT" % self._conn_count)
-                yield utils.sleep(1)
-            self._conn_count += 1
-            parser = parsers[sub["parser"]]
-            if parser.is_supported("last_modified"):
-                self.process_last_modified(sub)
-            else:
-                self.process_page(sub, None)
+            url = sub["url"]
+            if (url not in self._schedule and
+                url not in self._queued and
+                url not in self._in_flight):
+                self._schedule.add(url, sub.get("next_update", now))
+        self._reschedule()
+
+    def _reschedule(self):
+        """Set timer to the nearest due time."""
+        if self._timer is not None and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        due = self._schedule.next_due()
+        if due is not None:
+            delay = max(due - time.time(), 0)
+            self._timer = self._clock.callLater(delay, self.run)
+
+    def run(self):
+        """Queue due subscriptions; they are processed as
+        soon as semaphore slots free up.
+        """
+        self._timer = None
+        for url in self._schedule.pop_due(time.time()):
+            self._queued.add(url)
+            self._semaphore.run(self.process, url)
+        self._reschedule()
+
+    def process(self, url):
+        """Process subscription holding the semaphore slot."""
+        self._queued.discard(url)
+        self._in_flight[url] = time.time()
+        d = self._process(url)
+        d.addErrback(log.err)
+        d.addBoth(self._processed, url)
+        return d
+
+    def _processed(self, _, url):
+        del self._in_flight[url]
 
     @defer.inlineCallbacks
-    def process_last_modified(self, sub):
-        yield utils.wait_for_host(sub["host"])
-        self.debug("HOST OK: %s (last modified)" % sub["url"])
+    def _process(self, url):
+        sub = yield Subscription(url).get()
+        if not sub:
+            # Subscription was removed.
+            return
+        updated = yield self.process_page(sub)
+        if updated is not None:
+            interval = next_interval(
+                sub.get("update_interval", self.UPDATE_TIMEOUT),
+                updated, self.min_interval, self.max_interval)
+            next_update = time.time() + interval
+            self.debug("NEXT UPDATE IN %ds: %s" % (interval, url))
+            self._schedule.add(url, next_update)
+            self._reschedule()
+            yield Subscription(url).set_schedule(interval, next_update)
+
+    @defer.inlineCallbacks
+    def process_page(self, sub):
+        parser = parsers[sub["parser"]]
+        if parser.is_supported("last_modified"):
+            # Validators of the previous fetch; server will
+            # answer with cheap 304 if page wasn't changed.
+            last_modified = sub.get("last_modified")
+            etag = sub.get("etag")
+        else:
+            last_modified = etag = None
+        if parser.is_supported("byte_range"):
+            offset = sub.get("range_offset")
+            checksum = sub.get("range_checksum")
+        else:
+            offset = checksum = None
+        # Return whether thread was updated or None if
+        # url is dead.
+        updated = False
         try:
-            last_modified = yield get_last_modified(sub["url"])
+            page, parsed = yield utils.page_flights.run(
+                utils.page_key(sub, last_modified, etag, offset),
+                self.fetch_page, sub, last_modified, etag,
+                offset, checksum)
+        except NotModified:
+            self.debug("NOT MODIFIED: %s" % sub["url"])
+        except error.TimeoutError:
+            log.msg("SUBSCRIPTION PROCESSING TIMEOUT: %s" % sub["url"])
         except NotFound:
-            self.dead_url(sub)
+            updated = None
+            yield self.dead_url(sub)
         except Exception:
             err = traceback.format_exc()[:-1]
             self.bad_url(sub, err)
         else:
-            if last_modified:
-                db_last_mod = yield Subscription(
-                    sub["url"]).get_last_modified()
-                if last_modified != db_last_mod:
-                    # Header changed, seems like page was changed
-                    # so let's continue.
-                    self.debug("LAST MODIFIED WAS CHANGED: %s" % sub["url"])
-                    self.process_page(sub, last_modified)
-                    return
-        # Exiting and decrement connections count
-        self._conn_count -= 1
+            updated = "updates" in parsed
+            yield self.process_parsed(sub, parsed, page)
+        defer.returnValue(updated)
 
     @defer.inlineCallbacks
-    def process_page(self, sub, last_modified):
+    def fetch_page(self, sub, last_modified, etag, offset, checksum):
+        """Fetch page and parse it as it arrives.
+        Return (page, parsed). Fail with TimeoutError if it
+        takes longer than PROCESS_TIMEOUT; waiting for the
+        host's request slot isn't counted.
+        """
         yield utils.wait_for_host(sub["host"])
-        self.debug("HOST OK: %s (page)" % sub["url"])
+        self.debug("HOST OK: %s" % sub["url"])
+        streams = []
+        # Set when fetching is done or abandoned; get_page
+        # can't be cancelled so it could still deliver
+        # chunks then. They fail the request which closes
+        # its connection.
+        closed = [False]
+        def start_stream(offset):
+            if closed[0]:
+                raise defer.CancelledError()
+            task = sub.copy()
+            task["_offset"] = offset
+            stream = self._worker.parse_stream(task)
+            streams.append(stream)
+            def write(data):
+                if closed[0]:
+                    raise defer.CancelledError()
+                stream.write(data)
+            return write
+        def parse(page):
+            d = streams[-1].finish()
+            d.addCallback(lambda parsed: (page, parsed))
+            return d
+        d = get_page(
+            sub["url"], last_modified, etag, offset, checksum,
+            stream=start_stream)
+        d.addCallback(parse)
         try:
-            page = yield get_page(sub["url"])
-        except NotFound:
-            self.dead_url(sub)
-        except Exception:
-            err = traceback.format_exc()[:-1]
-            self.bad_url(sub, err)
-        else:
-            parsed = yield self._worker.parse(sub, page)
-            self.process_parsed(sub, parsed, last_modified)
-        # We've done, decrement connections count
-        self._conn_count -= 1
+            result = yield utils.timeout(
+                d, self.PROCESS_TIMEOUT, self._clock)
+            streams.pop()
+        finally:
+            closed[0] = True
+            for stream in streams:
+                # Fetching failed in the middle of the page or
+                # timed out; worker drops the task.
+                stream.abort()
+        defer.returnValue(result)
 
     @defer.inlineCallbacks
     def dead_url(self, sub):
@@ -97,16 +284,12 @@ class SubscriptionsUpdater(Plugin):
         users = yield UserSubscriptions.find(sub["url"])
         yield UserSubscriptions.unsubscribe_all(sub["url"])
         yield Subscription(sub["url"]).remove()
-        for user in users:
-            self._xmpp.send_message(
-                to=user["jid"], from_=from_,
-                body=u"Url dead.")
-            self._xmpp.send_presence(
-                to=user["jid"], from_=sub["jid"],
-                type_="unsubscribe")
-            self._xmpp.send_presence(
-                to=user["jid"], from_=sub["jid"],
-                type_="unsubscribed")
+        jids = [user["jid"] for user in users]
+        self._xmpp.send_fanout(
+            jids, self._xmpp.message(from_=from_, body=u"Url dead."))
+        for type_ in ("unsubscribe", "unsubscribed"):
+            self._xmpp.send_fanout(
+                jids, self._xmpp.presence(from_=sub["jid"], type_=type_))
 
     @defer.inlineCallbacks
     def bad_url(self, sub, err):
@@ -116,21 +299,86 @@ class SubscriptionsUpdater(Plugin):
                 "TRACEBACK:\n%s" % (
                 num_errors, sub, err))
 
+    def _hold(self, user_jid, sub_jid, posts):
+        if not posts:
+            return
+        held = self._held.setdefault((user_jid, sub_jid), [])
+        held.extend(posts)
+        del held[:-self.MAX_HELD_POSTS]
+
+    def _user_available(self, user_jid, sub_jid):
+        posts = self._held.pop((user_jid, sub_jid), None)
+        if posts:
+            d = self._release(user_jid, sub_jid, posts)
+            d.addErrback(log.err)
+
+    @defer.inlineCallbacks
+    def _release(self, user_jid, sub_jid, posts):
+        """Send posts held while user was offline."""
+        if self.offline_delivery in ("send", "skip"):
+            # Policy was changed by config reload.
+            return
+        url = yield Subscription.get_url_by_jid(sub_jid)
+        if url is None:
+            return
+        subscribed = yield UserSubscriptions(user_jid).is_subscribed(url)
+        if not subscribed:
+            return
+        if self.offline_delivery == "digest":
+            merge = True
+        else:
+            merge = yield UserSettings(user_jid).get_merge_updates()
+        if merge:
+            posts = merge_posts(posts, self.MERGED_MESSAGE_SIZE)
+        from_ = utils.get_full_jid(sub_jid)
+        for post in posts:
+            self._xmpp.send_post([user_jid], from_, post)
+
     @defer.inlineCallbacks
-    def process_parsed(self, sub, parsed, last_modified):
+    def process_parsed(self, sub, parsed, page):
         if "_error" in parsed: return
         if "updates" in parsed:
-            # Send updates to users
+            # Send updates to users; every post is rendered
+            # once for all of them. Posts are rendered before
+            # sending so a bad post can't break delivery in
+            # the middle; it's skipped.
+            renderer = parsers[sub["parser"]].renderer
+            posts = []
+            for record in parsed["updates"]:
+                try:
+                    post = RenderedPost(renderer, record)
+                except ValueError:
+                    log.msg("POST RENDERING ERROR: %s\n\n%s" % (
+                        record["url"], traceback.format_exc()[:-1]))
+                else:
+                    posts.append(post)
             from_ = utils.get_full_jid(sub["jid"])
             users = yield UserSubscriptions.find(sub["url"])
-            for user in users:
-                for text, xhtml in parsed["updates"]:
-                    self._xmpp.send_message(
-                        to=user["jid"], from_=from_,
-                        body=text, body_xhtml=xhtml)
+            jids = [user["jid"] for user in users]
+            if self.offline_delivery != "send":
+                jids, offline = self._xmpp.roster.split(jids, sub["jid"])
+                if self.offline_delivery != "skip":
+                    for jid in offline:
+                        self._hold(jid, sub["jid"], posts)
+            if len(posts) > 1 and jids:
+                merging = yield UserSettings.find_merging(jids)
+            else:
+                merging = ()
+            jids = [jid for jid in jids if jid not in merging]
+            for post in posts:
+                self._xmpp.send_post(jids, from_, post)
+            if merging:
+                # Users who want updates merged share the same
+                # messages.
+                for post in merge_posts(posts, self.MERGED_MESSAGE_SIZE):
+                    self._xmpp.send_post(merging, from_, post)
         # Update subscription info
         subscription = Subscription(sub["url"])
         if "last" in parsed:
             yield subscription.set_last(parsed["last"])
-        if last_modified:
-            yield subscription.set_last_modified(last_modified)
+        if "offset" in parsed:
+            yield subscription.set_range(
+                parsed["offset"], page.get_checksum(parsed["offset"]))
+        if page.last_modified or page.etag:
+            yield subscription.set_validators(
+                page.last_modified, page.etag)
@@ -0,0 +1,272 @@
+import re
+
+
+# Characters which aren't allowed in XML; lxml refused
+# such strings so they aren't rendered either.
+_INVALID_XML = re.compile(
+    u"[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+
+
+# Most of fields don't need escaping; one regexp scan is
+# cheaper than chain of replaces.
+_TEXT_SPECIAL = re.compile(u"[&<>\r]")
+_ATTR_SPECIAL = re.compile(u'[&<>"\r\n\t]')
+
+
+def escape(text):
+    """Escape text node the same way lxml serializes it."""
+    if _TEXT_SPECIAL.search(text) is None:
+        return text
+    return (text.replace(u"&", u"&amp;").replace(u"<", u"&lt;").
+            replace(u">", u"&gt;").replace(u"\r", u"&#13;"))
+
+
+def escape_attr(text):
+    """Escape attribute value the same way lxml
+    serializes it.
+    """
+    if _ATTR_SPECIAL.search(text) is None:
+        return text
+    return (text.replace(u"&", u"&amp;").replace(u"<", u"&lt;").
+            replace(u">", u"&gt;").replace(u'"', u"&quot;").
+            replace(u"\r", u"&#13;").replace(u"\n", u"&#10;").
+            replace(u"\t", u"&#9;"))
+
+
+class PostRenderer(object):
+    """Renders post records to text and XHTML-IM.
+
+    Post record is dict of url, title, author_name,
+    author_email, trip_text, trip_email, date, id, img_src (with img_name,
+    img_size and img_thumb_src if img_src isn't empty) and
+    body. Body is list of (kind, inlines) blocks; inlines are
+    (kind, text) tuples, links are ("link", text, url) and
+    line breaks are ("br",).
+
+    XHTML is made by templates with escaped fields; it's the
+    same as lxml serialization of the equivalent tree.
+    Parsers could use subclasses with other templates.
+    """
+
+    HR = u"\u2500"*50
+    HR2 = u"\u2591"*60
+
+    TITLE = (u'<span style="font-size: larger; font-weight: bold; '
+             u'color: #CC1105;">%s </span>')
+    AUTHOR = u'<span style="color: #117743; font-weight: bold;">%s</span>'
+    TRIP = u'<span style="color: #228854;">%s</span>'
+    LINK = u'<a href="%s">%s</a>'
+    IMG = (u'<br/>File: <a href="%s">%s</a> - '
+           u'(<span style="font-style: italic;">%s</span>)')
+    THUMB = u'<br/><a href="%s"><img src="%s" alt="img"/></a>'
+    POST = u'<span><br/>%s%s%s %s <a href="%s">No.%s</a>%s%s</span>'
+    THREAD = u"<span><br/>%s<br/>%s%s%s</span>"
+    OMITTED = u'<span style="color: #707070;"><br/><br/>%s<br/></span>'
+    SEPARATOR = u"<span><br/>%s</span>"
+
+    # Block kind -> span style; blocks are separated by two
+    # brs (should be <p> but xmpp clients process it
+    # incorrectly).
+    BLOCK_STYLES = {
+        "quote": u' style="color: #789922;"',
+        "abbrev": u' style="color: #707070;"',
+        "pre": u' style="font-family: monospace;"',
+    }
+    BLOCK = u"<span%s><br/><br/>%s</span>"
+
+    # Inline kind -> (text template, xhtml template). Plain
+    # text inlines are text only: they are dropped from
+    # xhtml like tails of skipped nodes were in lxml trees.
+    INLINES = {
+        "text": (u"%s", u"%s"),
+        "plain": (u"%s", None),
+        "link": (u"%s", LINK),
+        "br": (u"\n", u"<br/>"),
+        "strong": (u"*%s*", u'<span style="font-weight: bold;">%s</span>'),
+        "em": (u"/%s/", u'<span style="font-style: italic;">%s</span>'),
+        "del": (u"-%s-",
+                u'<span style="text-decoration: line-through;">%s</span>'),
+        "code": (u"%s", u'<span style="font-family: monospace;">%s</span>'),
+        "spoiler": (u"%%%%%s%%%%", u'<span style="color: #F0D0B6; '
+                    u'background-color: #F0D0B6;">%s</span>'),
+    }
+
+    def render_post(self, post, show_images=True):
+        """Return (text, xhtml) of the post."""
+        return (self.render_text(post),
+                self.render_xhtml(post, show_images))
+
+    def render_text(self, post):
+        if post["title"]:
+            title = post["title"] + " "
+        else:
+            title = ""
+        if post["author_email"]:
+            email = " <%s>" % post["author_email"]
+        else:
+            email = ""
+        if post["img_src"]:
+            img = "\nFile: %s -(%s) <%s>" % (
+                post["img_name"], post["img_size"], post["img_src"])
+        else:
+            img = ""
+        body = self.render_body_text(post["body"])
+        if body:
+            body = "\n\n" + body
+        return u"%s\n%s%s%s%s %s No.%s%s%s" % (
+            post["url"], title, post["author_name"], post["trip_text"],
+            email, post["date"], post["id"], img, body)
+
+    def render_xhtml(self, post, show_images=True):
+        if post["title"]:
+            title = self.TITLE % escape(post["title"])
+        else:
+            title = u""
+        if post["author_name"]:
+            author = self._link(post["author_name"], post["author_email"])
+            author = self.AUTHOR % author
+        else:
+            author = u""
+        if post["trip_text"]:
+            trip = self.TRIP % self._link(
+                post["trip_text"], post["trip_email"])
+        else:
+            trip = u""
+        if post["img_src"]:
+            src = escape_attr(post["img_src"])
+            img = self.IMG % (
+                src, escape(post["img_name"]), escape(post["img_size"]))
+            if show_images:
+                img += self.THUMB % (
+                    src, escape_attr(post["img_thumb_src"]))
+        else:
+            img = u""
+        xhtml = self.POST % (
+            title, author, trip, escape(post["date"]),
+            escape_attr(post["url"]), escape(post["id"]), img,
+            self.render_body_xhtml(post["body"]))
+        self._check(xhtml)
+        return xhtml
+
+    def _link(self, text, url):
+        if url:
+            return self.LINK % (escape_attr(url), escape(text))
+        return escape(text)
+
+    def render_body_text(self, body):
+        texts = []
+        inlines = self.INLINES
+        for kind, items in body:
+            text = []
+            for item in items:
+                text_tpl = inlines[item[0]][0]
+                if len(item) == 1:
+                    # Inline without text, i.e. br.
+                    text.append(text_tpl)
+                else:
+                    text.append(text_tpl % item[1])
+            texts.append(u"".join(text))
+        return u"\n\n".join(texts)
+
+    def render_body_xhtml(self, body):
+        if not body:
+            return u"<span/>"
+        blocks = []
+        inlines = self.INLINES
+        for kind, items in body:
+            xhtml = []
+            for item in items:
+                xhtml_tpl = inlines[item[0]][1]
+                if xhtml_tpl is None:
+                    continue
+                n = len(item)
+                if n == 1:
+                    xhtml.append(xhtml_tpl)
+                elif n == 2:
+                    xhtml.append(xhtml_tpl % escape(item[1]))
+                else:
+                    xhtml.append(xhtml_tpl % (
+                        escape_attr(item[2]), escape(item[1])))
+            blocks.append(self.BLOCK % (
+                self.BLOCK_STYLES.get(kind, u""), u"".join(xhtml)))
+        return u"<span>%s</span>" % u"".join(blocks)
+
+    def render_thread(self, op_post, omitted=None, last_post=None):
+        """Return (text, xhtml) of the board thread preview
+        made of rendered opening post, omitted posts note
+        and rendered last post.
+        """
+        text, xhtml = op_post
+        if last_post is None:
+            return (text, self.THREAD % (self.HR, xhtml, u"", u""))
+        if omitted is None:
+            text += u"\n\n" + last_post[0]
+            omitted_xhtml = u"<br/>"
+        else:
+            text += u"\n\n/%s/\n\n%s" % (omitted, last_post[0])
+            omitted_xhtml = self.OMITTED % escape(omitted)
+        return (text, self.THREAD % (
+            self.HR, xhtml, omitted_xhtml, last_post[1]))
+
+    def render_separator(self):
+        """Return (text, xhtml) of the board threads separator."""
+        return (self.HR2, self.SEPARATOR % self.HR2)
+
+    def _check(self, xhtml):
+        if _INVALID_XML.search(xhtml) is not None:
+            raise ValueError("Post has characters not allowed in XML")
+
+
+class RenderedPost(object):
+    """Post record rendered to text and xhtml once for all
+    recipients of the post. Raise ValueError if post can't
+    be rendered.
+    """
+
+    def __init__(self, renderer, post, show_images=True):
+        self.post = post
+        self.text = renderer.render_text(post)
+        self.xhtml = renderer.render_xhtml(post, show_images)
+        # Stanza payload made of the rendered post is kept
+        # here by xmpp component.
+        self.payload = None
+
+
+class MergedPosts(object):
+    """Several rendered posts sent as one message. Has the
+    same interface as RenderedPost.
+    """
+
+    # Between posts' xhtml; same gap as between texts.
+    XHTML_SEPARATOR = u"<br/>"
+
+    def __init__(self, posts):
+        self.posts = posts
+        self.text = u"\n\n".join([post.text for post in posts])
+        self.xhtml = self.XHTML_SEPARATOR.join([
+            post.xhtml for post in posts])
+        self.payload = None
+
+
+def merge_posts(posts, max_size):
+    """Group rendered posts into messages whose text and
+    xhtml together are not longer than max_size characters
+    (post which alone is longer gets its own message).
+    Return list of RenderedPost and MergedPosts.
+    """
+    messages = []
+    group = []
+    size = 0
+    for post in posts:
+        post_size = len(post.text) + len(post.xhtml)
+        if group and size + post_size > max_size:
+            messages.append(group)
+            group = []
+            size = 0
+        group.append(post)
+        size += post_size
+    if group:
+        messages.append(group)
+    return [
+        message[0] if len(message) == 1 else MergedPosts(message)
+        for message in messages]
@@ -0,0 +1,109 @@
+from collections import deque
+from twisted.internet import defer
+
+
+# Tolerance for float errors in tokens calculation.
+_EPSILON = 1e-9
+
+
+class _Lane(object):
+    """Token bucket with FIFO queue of waiting requests."""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+        self.waiting = deque()
+        self.timer = None
+
+    def refill(self, now):
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def has_token(self):
+        return self.tokens + _EPSILON >= 1
+
+
+class RateLimiter(object):
+    """Per-host token bucket rate limiter. Every (host, level)
+    pair has its own lane so requests with different levels
+    don't wait each other. Waiting requests are released in
+    FIFO order by one timer per lane; idle lanes with full
+    bucket are dropped.
+    """
+
+    def __init__(self, rate=1/3.0, burst=1, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+        self.rate = rate
+        self.burst = burst
+        self._clock = clock
+        self._settings = {}
+        self._lanes = {}
+
+    def configure(self, host, rate=None, burst=None):
+        """Set requests per second rate and burst size for the
+        given host. None means limiter default.
+        """
+        if rate is None:
+            rate = self.rate
+        if burst is None:
+            burst = self.burst
+        self._settings[host] = (rate, burst)
+        for key, lane in self._lanes.items():
+            if key[0] == host:
+                lane.rate = rate
+                lane.burst = burst
+                self._schedule(key, lane)
+
+    def wait(self, host, level=1):
+        """Return deferred which fires when request to
+        the host could be made.
+        """
+        key = (host, level)
+        lane = self._lanes.get(key)
+        if lane is None:
+            rate, burst = self._settings.get(host, (self.rate, self.burst))
+            lane = self._lanes[key] = _Lane(
+                rate, burst, self._clock.seconds())
+        lane.refill(self._clock.seconds())
+        if not lane.waiting and lane.has_token():
+            lane.tokens -= 1
+            d = defer.succeed(None)
+        else:
+            d = defer.Deferred()
+            lane.waiting.append(d)
+        self._schedule(key, lane)
+        return d
+
+    def _schedule(self, key, lane):
+        if lane.timer is not None and lane.timer.active():
+            lane.timer.cancel()
+        if lane.waiting:
+            # Time to the next token.
+            need = 1 - lane.tokens
+        else:
+            # Time to the full bucket so lane could be dropped.
+            need = lane.burst - lane.tokens
+        lane.timer = self._clock.callLater(
+            max(need, 0) / lane.rate, self._on_timer, key)
+
+    def _on_timer(self, key):
+        lane = self._lanes[key]
+        lane.timer = None
+        lane.refill(self._clock.seconds())
+        while lane.waiting and lane.has_token():
+            lane.tokens -= 1
+            lane.waiting.popleft().callback(None)
+        if not lane.waiting and lane.tokens + _EPSILON >= lane.burst:
+            del self._lanes[key]
+        else:
+            self._schedule(key, lane)
+
+    def get_info(self):
+        """Return dict of (host, level) -> waiting requests count."""
+        return dict([
+            (key, len(lane.waiting))
+            for key, lane in self._lanes.iteritems()])
@@ -0,0 +1,114 @@
+class Roster(object):
+    """Online users of the gate. Available resources are
+    tracked for every (user bare jid, our jid) pair since
+    users send presence to every our jid (main jid and jids
+    of subscriptions) in their rosters separately.
+
+    Availability loaded from the database is used until
+    the first presence of the pair arrives.
+    """
+
+    def __init__(self):
+        # (user jid, our jid) -> set of available resources.
+        self._pairs = {}
+        # (user jid, our jid) -> availability from the database.
+        self._loaded = {}
+        # User jid -> set of our jids.
+        self._users = {}
+        self._watchers = []
+
+    def load(self, entries):
+        """Load saved (user jid, our jid, available) entries.
+        Pairs which already got presence are kept.
+        """
+        for user_jid, our_jid, available in entries:
+            key = (user_jid, our_jid)
+            if key not in self._pairs:
+                self._loaded[key] = available
+                self._users.setdefault(user_jid, set()).add(our_jid)
+
+    def add_watcher(self, fn):
+        """fn(user_jid, our_jid) is called when the pair
+        becomes available.
+        """
+        self._watchers.append(fn)
+
+    def update(self, full_jid, our_jid, available):
+        """Handle presence of the user's resource. Bare jid
+        (presence error or unavailable from server) means
+        all resources. Return True if availability of the
+        pair was changed.
+        """
+        user_jid = full_jid.split("/", 1)[0]
+        key = (user_jid, our_jid)
+        was_available = self._get_state(key)
+        resources = self._pairs.get(key)
+        if resources is None:
+            resources = self._pairs[key] = set()
+            self._loaded.pop(key, None)
+            self._users.setdefault(user_jid, set()).add(our_jid)
+        if available:
+            resources.add(full_jid)
+        elif full_jid == user_jid:
+            resources.clear()
+        else:
+            resources.discard(full_jid)
+        is_available = bool(resources)
+        if is_available == was_available:
+            return False
+        if is_available:
+            for fn in self._watchers:
+                fn(user_jid, our_jid)
+        return True
+
+    def is_available(self, user_jid, our_jid=None):
+        """Return whether user is available for our jid
+        (or for any our jid) or None if it's unknown.
+        """
+        if our_jid is not None:
+            state = self._get_state((user_jid, our_jid))
+            if state is not None:
+                return state
+        # Pair wasn't seen yet (e.g. user just subscribed);
+        # use user's presence to other our jids.
+        states = [
+            self._get_state((user_jid, jid))
+            for jid in self._users.get(user_jid, ())]
+        if True in states:
+            return True
+        if states:
+            return False
+
+    def _get_state(self, key):
+        if key in self._pairs:
+            return bool(self._pairs[key])
+        return self._loaded.get(key)
+
+    def split(self, jids, our_jid):
+        """Return (online, offline) lists of the given user
+        jids; users with unknown presence are online.
+        """
+        online = []
+        offline = []
+        for jid in jids:
+            if self.is_available(jid, our_jid) is False:
+                offline.append(jid)
+            else:
+                online.append(jid)
+        return online, offline
+
+    def get_pairs(self):
+        """Return list of known (user jid, our jid) pairs."""
+        return list(set(self._pairs) | set(self._loaded))
+
+    def get_info(self):
+        """Return dict of users, online and offline counts."""
+        online = 0
+        for user_jid in self._users:
+            if self.is_available(user_jid):
+                online += 1
+        return {
+            "users": len(self._users),
+            "online": online,
+            "offline": len(self._users) - online,
+        }
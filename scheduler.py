@@ -0,0 +1,62 @@
+import heapq
+
+
+class Scheduler(object):
+    """Priority queue of subscriptions' next update times.
+    Items are identified by url; adding url again
+    reschedules it.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._due = {}
+
+    def __len__(self):
+        return len(self._due)
+
+    def __contains__(self, url):
+        return url in self._due
+
+    def add(self, url, due):
+        self._due[url] = due
+        heapq.heappush(self._heap, (due, url))
+
+    def remove(self, url):
+        self._due.pop(url, None)
+
+    def _drop_stale(self):
+        # Heap entries of removed and rescheduled urls
+        # are dropped lazily.
+        heap = self._heap
+        while heap and self._due.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def next_due(self):
+        """Return the nearest due time or None."""
+        self._drop_stale()
+        if self._heap:
+            return self._heap[0][0]
+
+    def pop_due(self, now):
+        """Remove and return urls which are due to now
+        in order of their due times.
+        """
+        urls = []
+        self._drop_stale()
+        while self._heap and self._heap[0][0] <= now:
+            due, url = heapq.heappop(self._heap)
+            del self._due[url]
+            urls.append(url)
+            self._drop_stale()
+        return urls
+
+
+def next_interval(interval, updated, min_interval, max_interval, factor=2):
+    """Shorten poll interval of subscription which was
+    updated; back off exponentially for idle one.
+    """
+    if updated:
+        interval /= float(factor)
+    else:
+        interval *= factor
+    return min(max(interval, min_interval), max_interval)
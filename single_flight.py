@@ -0,0 +1,34 @@
+from twisted.internet import defer
+
+
+class SingleFlight(object):
+    """Shares in-flight call between concurrent callers with
+    the same key: only the first caller runs the function,
+    the others get its result. Results are shared so callers
+    shouldn't modify them.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    def __contains__(self, key):
+        return key in self._calls
+
+    def run(self, key, fn, *args, **kwargs):
+        """Return deferred which fires with result of
+        fn(*args, **kwargs) or of the same key call which is
+        already in flight.
+        """
+        if key in self._calls:
+            d = defer.Deferred()
+            self._calls[key].append(d)
+            return d
+        self._calls[key] = []
+        d = defer.maybeDeferred(fn, *args, **kwargs)
+        d.addBoth(self._done, key)
+        return d
+
+    def _done(self, result, key):
+        for d in self._calls.pop(key):
+            d.callback(result)
+        return result
@@ -0,0 +1,94 @@
+from collections import deque
+from zope.interface import implements
+from twisted.internet.interfaces import IPushProducer
+from rate_limiter import RateLimiter
+
+
+# Priorities of outbound stanzas; lower is sent first.
+REPLY = 0
+BULK = 1
+# Stanzas which could wait (like startup presence probes);
+# they don't take bulk tokens and go after bulk ones.
+BACKGROUND = 2
+
+
+class StanzaQueue(object):
+    """Outbound stanzas queue. Stanzas to every destination
+    domain are paced by token bucket (every priority has
+    separate bucket). Paced stanzas wait in priority queues
+    and are written while transport accepts them: queue is
+    registered as streaming producer so transport pauses it
+    when its write buffer (max_buffer bytes) is full and
+    resumes when buffer is flushed to the server.
+    """
+
+    implements(IPushProducer)
+
+    def __init__(self, send, rate=10, burst=50,
+                 max_buffer=64*1024, clock=None):
+        self._send = send
+        self._limiter = RateLimiter(rate, burst, clock)
+        self.max_buffer = max_buffer
+        self._ready = tuple([deque() for i in (REPLY, BULK, BACKGROUND)])
+        self._transport = None
+        self._paused = True
+        self._pacing = 0
+        self.stats = {"sent": 0, "pauses": 0}
+
+    def attach(self, transport):
+        """Start writing stanzas to the connected stream."""
+        self._transport = transport
+        transport.bufferSize = self.max_buffer
+        transport.registerProducer(self, True)
+        self._paused = False
+        self._flush()
+
+    def detach(self):
+        """Hold stanzas until stream is attached again."""
+        self._transport = None
+        self._paused = True
+
+    def put(self, stanza, domain, priority=BULK):
+        self._pacing += 1
+        d = self._limiter.wait(domain, priority)
+        d.addCallback(self._paced, stanza, priority)
+
+    def _paced(self, _, stanza, priority):
+        self._pacing -= 1
+        self._ready[priority].append(stanza)
+        self._flush()
+
+    def _flush(self):
+        # Transport could pause us right in the send.
+        while not self._paused:
+            for queue in self._ready:
+                if queue:
+                    break
+            else:
+                return
+            self._send(queue.popleft())
+            self.stats["sent"] += 1
+
+    def pauseProducing(self):
+        self.stats["pauses"] += 1
+        self._paused = True
+
+    def resumeProducing(self):
+        if self._transport is not None:
+            self._paused = False
+            self._flush()
+
+    def stopProducing(self):
+        self.detach()
+
+    def get_info(self):
+        """Return dict of queue depths and counters."""
+        return {
+            "pacing": self._pacing,
+            "replies": len(self._ready[REPLY]),
+            "bulk": len(self._ready[BULK]),
+            "background": len(self._ready[BACKGROUND]),
+            "paused": self._paused,
+            "sent": self.stats["sent"],
+            "pauses": self.stats["pauses"],
+        }
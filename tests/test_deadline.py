@@ -0,0 +1,43 @@
+from twisted.internet import defer, error, task
+from twisted.trial.unittest import TestCase
+from deadline import timeout
+
+
+class TestTimeout(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.results = []
+
+    def _timeout(self, d):
+        result = timeout(d, 10, self.clock)
+        result.addBoth(self.results.append)
+
+    def test_result(self):
+        d = defer.Deferred()
+        self._timeout(d)
+        self.clock.advance(9)
+        d.callback("page")
+        self.assertEqual(self.results, ["page"])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        # Failure is passed too.
+        d = defer.Deferred()
+        self._timeout(d)
+        d.errback(ValueError())
+        self.results.pop().trap(ValueError)
+
+    def test_timeout(self):
+        cancelled = []
+        d = defer.Deferred(cancelled.append)
+        self._timeout(d)
+        self.clock.advance(10)
+        self.results.pop().trap(error.TimeoutError)
+        self.assertEqual(cancelled, [d])
+        # Late result of work which can't be cancelled is
+        # discarded.
+        d = defer.Deferred()
+        self._timeout(d)
+        self.clock.advance(10)
+        d.callback("page")
+        self.results.pop().trap(error.TimeoutError)
+        self.assertEqual(self.results, [])
@@ -0,0 +1,310 @@
+from twisted.internet import defer, reactor, task
+from twisted.trial.unittest import TestCase
+from twisted.words.xish import domish
+from twisted.words.protocols.jabber import component, xmlstream
+from fanout import (
+    Fanout, NS_ADDRESS, NS_DATA, NS_DISCO_INFO, NS_DISCO_ITEMS)
+from stanza_queue import StanzaQueue
+
+
+def _message(body=u"new post"):
+    msg = domish.Element((None, "message"))
+    msg["type"] = "chat"
+    msg.addElement("body", content=body)
+    return msg
+
+
+def _answer(iq, features=None, items=None, limit=None):
+    """Return disco result (error if both are None) for iq.
+    limit is advertised multicast addresses limit.
+    """
+    reply = domish.Element((None, "iq"))
+    reply["from"] = iq["to"]
+    reply["to"] = iq["from"]
+    reply["id"] = iq["id"]
+    if features is None and items is None:
+        reply["type"] = "error"
+        return reply
+    reply["type"] = "result"
+    query = reply.addElement((iq.query.uri, "query"))
+    for var in features or ():
+        query.addElement("feature")["var"] = var
+    for item in items or ():
+        query.addElement("item")["jid"] = item
+    if limit is not None:
+        form = query.addElement((NS_DATA, "x"))
+        form["type"] = "result"
+        for var, value in (("FORM_TYPE", NS_ADDRESS),
+                           ("limit-local-message", "infinite"),
+                           ("limit-remote-message", limit)):
+            field = form.addElement("field")
+            field["var"] = var
+            field.addElement("value", content=value)
+    return reply
+
+
+class _StandInServers(object):
+    """Remote servers behind the stand-in router: big1.org
+    has multicast service among its items, big2.org doesn't
+    support multicast, others don't answer disco. Counts
+    stanzas and expands multicast ones.
+    """
+
+    SERVICES = {
+        "big1.org": ([NS_DISCO_INFO], ["multicast.big1.org", "muc.big1.org"]),
+        "big2.org": ([NS_DISCO_INFO], []),
+        "multicast.big1.org": ([NS_DISCO_INFO, NS_ADDRESS], []),
+        "muc.big1.org": ([NS_DISCO_INFO], []),
+    }
+
+    def __init__(self, router):
+        self.router = router
+        self.messages = 0
+        self.delivered = []
+
+    def send(self, stanza):
+        if stanza.name == "iq":
+            features, items = self.SERVICES.get(stanza["to"], (None, None))
+            if stanza.query.uri == NS_DISCO_INFO:
+                reply = _answer(stanza, features=features)
+            else:
+                reply = _answer(stanza, items=items)
+            self.router.route(reply)
+        elif stanza.name == "message":
+            self.messages += 1
+            for child in stanza.elements():
+                if child.name == "addresses":
+                    self.delivered.extend([
+                        address["jid"] for address in child.elements()])
+                    break
+            else:
+                self.delivered.append(stanza["to"])
+
+
+class _Gate(object):
+    """Component which sends fan-out as XMPPComponent does."""
+
+    def __init__(self):
+        self.connected = defer.Deferred()
+        self.xs = None
+        self.queue = StanzaQueue(
+            self._write, rate=1, burst=1000, clock=task.Clock())
+        self.fanout = Fanout(self.queue.put, "gate.localhost")
+
+    def componentConnected(self, xs):
+        self.xs = xs
+        xs.addObserver("/iq[@type='result']", self.fanout.on_iq)
+        xs.addObserver("/iq[@type='error']", self.fanout.on_iq)
+        xs.addObserver(
+            "/message[@type='error']", self.fanout.on_message_error)
+        self.queue.attach(xs.transport)
+        self.connected.callback(None)
+
+    def _write(self, obj):
+        self.xs.send(obj)
+
+
+class TestFanout(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sent = []
+        self.fanout = Fanout(
+            lambda stanza, domain, priority: self.sent.append(stanza),
+            "gate.localhost", clock=self.clock)
+
+    def _sent(self):
+        sent = [
+            stanza.toXml() if isinstance(stanza, domish.Element) else stanza
+            for stanza in self.sent]
+        del self.sent[:]
+        return sent
+
+    def test_unicast(self):
+        self.fanout.send(["a@x.org", "b@y.org"], _message(u"<&>"))
+        self.assertEqual(self._sent(), [
+            u"<message to='a@x.org' type='chat'>"
+            u"<body>&lt;&amp;&gt;</body></message>",
+            u"<message to='b@y.org' type='chat'>"
+            u"<body>&lt;&amp;&gt;</body></message>"])
+        # Presences are always unicast and aren't discovered.
+        presence = domish.Element((None, "presence"))
+        presence["type"] = "unsubscribed"
+        self.fanout.send(["a@x.org", "b@x.org"], presence)
+        self.assertEqual(self._sent(), [
+            u"<presence to='a@x.org' type='unsubscribed'/>",
+            u"<presence to='b@x.org' type='unsubscribed'/>"])
+
+    def test_discovery(self):
+        results = []
+        self.fanout.discover("x.org").addCallback(results.append)
+        self.fanout.discover("x.org").addCallback(results.append)
+        info, = self.sent
+        self.assertEqual(
+            (info["to"], info.query.uri), ("x.org", NS_DISCO_INFO))
+        self.assertTrue(self.fanout.on_iq(_answer(info, features=[])))
+        self.assertFalse(self.fanout.on_iq(_answer(info, features=[])))
+        items = self.sent[1]
+        self.assertEqual(
+            (items["to"], items.query.uri), ("x.org", NS_DISCO_ITEMS))
+        self.fanout.on_iq(_answer(items, items=["a.x.org", "b.x.org"]))
+        self.assertEqual(
+            [iq["to"] for iq in self.sent[2:]], ["a.x.org", "b.x.org"])
+        self.fanout.on_iq(_answer(self.sent[2]))
+        self.assertEqual(results, [])
+        self.fanout.on_iq(_answer(self.sent[3], features=[NS_ADDRESS]))
+        self.assertEqual(results, ["b.x.org", "b.x.org"])
+        self.assertEqual(self.fanout.get_service("x.org"), "b.x.org")
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        # Result expires.
+        del self.sent[:]
+        self.clock.advance(Fanout.SUPPORTED_TTL)
+        self.assertIs(self.fanout.get_service("x.org"), None)
+        self.assertEqual(len(self.sent), 1)
+
+    def test_discovery_timeout(self):
+        results = []
+        self.fanout.discover("x.org").addCallback(results.append)
+        self.clock.advance(Fanout.DISCO_TIMEOUT)
+        self.assertEqual(results, [None])
+        # Late answer is ignored.
+        self.assertFalse(
+            self.fanout.on_iq(_answer(self.sent[0], features=[NS_ADDRESS])))
+        self.assertIs(self.fanout.get_service("x.org"), None)
+        self.assertEqual(len(self.sent), 1)
+
+    def test_multicast(self):
+        self.fanout.discover("x.org")
+        self.fanout.on_iq(_answer(self.sent[0], features=[NS_ADDRESS]))
+        del self.sent[:]
+        jids = ["u%d@x.org" % i for i in range(Fanout.MAX_ADDRESSES + 1)]
+        self.fanout.send(jids + ["a@y.org"], _message())
+        first, second, unicast = self._sent()
+        self.assertEqual(first.count("<address "), Fanout.MAX_ADDRESSES)
+        self.assertEqual(second, (
+            u"<message to='x.org' id='multicast3' type='chat'>"
+            u"<addresses xmlns='%s'>"
+            u"<address type='bcc' jid='u20@x.org'/></addresses>"
+            u"<body>new post</body></message>" % NS_ADDRESS))
+        self.assertTrue(unicast.startswith(u"<message to='a@y.org'"))
+        self.assertEqual(
+            self.fanout.get_info(),
+            {"unicast": 1, "multicast": 2, "servers": 1})
+
+    def test_advertised_limit(self):
+        self.fanout.discover("x.org")
+        self.fanout.on_iq(
+            _answer(self.sent[0], features=[NS_ADDRESS], limit="30"))
+        del self.sent[:]
+        jids = ["u%d@x.org" % i for i in range(31)]
+        self.fanout.send(jids, _message())
+        self.assertEqual(
+            [stanza.count("<address ") for stanza in self._sent()], [30, 1])
+        # "infinite" limit isn't trusted.
+        self.fanout.discover("y.org")
+        self.fanout.on_iq(
+            _answer(self.sent[0], features=[NS_ADDRESS], limit="infinite"))
+        del self.sent[:]
+        self.fanout.send(["u%d@y.org" % i for i in range(21)], _message())
+        self.assertEqual(
+            [stanza.count("<address ") for stanza in self._sent()],
+            [Fanout.MAX_ADDRESSES, 1])
+
+    def _bounce(self, id_):
+        error = domish.Element((None, "message"))
+        error["from"] = "x.org"
+        error["id"] = id_
+        error["type"] = "error"
+        return error
+
+    def _on_error(self, id_):
+        return self.fanout.on_message_error(self._bounce(id_))
+
+    def test_bounce(self):
+        self.fanout.discover("x.org")
+        self.fanout.on_iq(_answer(self.sent[0], features=[NS_ADDRESS]))
+        del self.sent[:]
+        jids = ["u%d@x.org" % i for i in range(25)]
+        self.fanout.send(jids, _message())
+        self.fanout.send(jids, _message())
+        self.assertEqual(len(self._sent()), 4)
+        self.assertFalse(self._on_error("chat1"))
+        # Service doesn't deliver multicast stanzas; its
+        # recipients get unicast ones.
+        self.assertTrue(self._on_error("multicast2"))
+        self.assertFalse(self._on_error("multicast2"))
+        sent = self._sent()
+        self.assertEqual(len(sent), Fanout.MAX_ADDRESSES)
+        self.assertTrue(sent[0].startswith(u"<message to='u0@x.org'"))
+        self.assertIs(self.fanout.get_service("x.org"), None)
+        self.fanout.send(jids, _message())
+        self.assertEqual(len(self._sent()), 25)
+        # Late bounces are resent too.
+        self.assertTrue(self._on_error("multicast5"))
+        self.assertEqual(len(self._sent()), 5)
+        # Sent stanzas are forgotten.
+        self.clock.advance(Fanout.BOUNCE_TTL)
+        self.fanout.send(["a@y.org"], _message())
+        self.assertFalse(self._on_error("multicast3"))
+
+
+class TestFanoutServer(TestCase):
+    """Fan-out through the stand-in XMPP server."""
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        self.router = component.Router()
+        self.servers = _StandInServers(self.router)
+        self.router.routes[None] = self.servers
+        self.server_factory = component.XMPPComponentServerFactory(
+            self.router, "secret")
+        self.port = reactor.listenTCP(
+            0, self.server_factory, interface="127.0.0.1")
+        self.gate = _Gate()
+        factory = component.componentFactory("gate.localhost", "secret")
+        factory.addBootstrap(
+            xmlstream.STREAM_AUTHD_EVENT, self.gate.componentConnected)
+        self.factory = factory
+        self.connector = reactor.connectTCP(
+            "127.0.0.1", self.port.getHost().port, factory)
+        yield self.gate.connected
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        closed = defer.Deferred()
+        self.router.routes["gate.localhost"].addObserver(
+            xmlstream.STREAM_END_EVENT, lambda _: closed.callback(None))
+        self.factory.stopTrying()
+        self.connector.disconnect()
+        yield closed
+        yield self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_thread_subscribers(self):
+        # 100 subscribers: 50 on big1.org (multicast, 3
+        # stanzas), 45 on big2.org (no multicast) and 5 on
+        # small servers.
+        jids = (["u%d@big1.org" % i for i in range(50)] +
+                ["u%d@big2.org" % i for i in range(45)] +
+                ["u%d@small%d.org" % (i, i) for i in range(5)])
+        fanout = self.gate.fanout
+        # Servers aren't discovered yet; all stanzas are unicast.
+        fanout.send(jids, _message())
+        services = yield defer.gatherResults([
+            fanout.discover("big1.org"), fanout.discover("big2.org")])
+        self.assertEqual(services, ["multicast.big1.org", None])
+        yield self._wait_messages(100)
+        self.servers.delivered = []
+        fanout.send(jids, _message())
+        yield self._wait_messages(153)
+        self.assertEqual(sorted(self.servers.delivered), sorted(jids))
+
+    @defer.inlineCallbacks
+    def _wait_messages(self, count):
+        for i in range(100):
+            if self.servers.messages >= count:
+                break
+            d = defer.Deferred()
+            reactor.callLater(0.01, d.callback, None)
+            yield d
+        self.assertEqual(self.servers.messages, count)
@@ -0,0 +1,185 @@
+import zlib
+import gzip
+from cStringIO import StringIO
+from twisted.internet import defer, reactor
+from twisted.trial.unittest import TestCase
+from twisted.web import server, resource, http
+import fetcher
+
+
+LAST_MODIFIED = 1293840000
+LAST_MODIFIED_STR = "Sat, 01 Jan 2011 00:00:00 GMT"
+
+
+class _Thread(resource.Resource):
+
+    isLeaf = True
+    body = "<html>thread</html>"
+
+    def render_GET(self, request):
+        if request.postpath == ["404.html"]:
+            request.setResponseCode(404)
+            return ""
+        if (request.setLastModified(LAST_MODIFIED) == http.CACHED or
+            request.setETag('"v1"') == http.CACHED):
+            return ""
+        return self.body
+
+
+class _Compressed(resource.Resource):
+
+    isLeaf = True
+    body = "<html>%s</html>" % ("post " * 1000)
+
+    def render_GET(self, request):
+        encoding = request.postpath[0]
+        if encoding not in request.getHeader("accept-encoding"):
+            return self.body
+        request.setHeader("Content-Encoding", encoding)
+        if encoding == "gzip":
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode="wb")
+            f.write(self.body)
+            f.close()
+            return buf.getvalue()
+        else:
+            return zlib.compress(self.body)
+
+
+class _Ranged(resource.Resource):
+
+    isLeaf = True
+    body = "".join(["<p>post %d</p>" % i for i in range(100)])
+
+    def render_GET(self, request):
+        range_header = request.getHeader("range")
+        if request.postpath == ["ignore"] or not range_header:
+            return self.body
+        start = int(range_header[len("bytes="):-1])
+        if start >= len(self.body):
+            request.setResponseCode(416)
+            return ""
+        request.setResponseCode(206)
+        request.setHeader("Content-Range", "bytes %d-%d/%d" % (
+            start, len(self.body) - 1, len(self.body)))
+        return self.body[start:]
+
+
+class TestFetcher(TestCase):
+
+    def setUp(self):
+        root = resource.Resource()
+        root.putChild("res", _Thread())
+        root.putChild("compressed", _Compressed())
+        root.putChild("ranged", _Ranged())
+        self.port = reactor.listenTCP(
+            0, server.Site(root), interface="127.0.0.1")
+        self.url = "http://127.0.0.1:%d/" % self.port.getHost().port
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield fetcher.pool.close_cached_connections()
+        yield self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_get_page(self):
+        page = yield fetcher.get_page(self.url + "res/1.html")
+        self.assertEqual(page.body, _Thread.body)
+        self.assertEqual(page.last_modified, LAST_MODIFIED_STR)
+        self.assertEqual(page.etag, '"v1"')
+
+    def test_not_found(self):
+        d = fetcher.get_page(self.url + "res/404.html")
+        return self.assertFailure(d, fetcher.NotFound)
+
+    def test_not_modified_by_date(self):
+        d = fetcher.get_page(self.url + "res/1.html", last_modified=LAST_MODIFIED_STR)
+        return self.assertFailure(d, fetcher.NotModified)
+
+    def test_not_modified_by_etag(self):
+        d = fetcher.get_page(self.url + "res/1.html", etag='"v1"')
+        return self.assertFailure(d, fetcher.NotModified)
+
+    @defer.inlineCallbacks
+    def test_modified(self):
+        page = yield fetcher.get_page(
+            self.url + "res/1.html", last_modified="Fri, 31 Dec 2010 00:00:00 GMT",
+            etag='"v0"')
+        self.assertEqual(page.body, _Thread.body)
+
+    @defer.inlineCallbacks
+    def _check_compressed(self, encoding):
+        wire_bytes = fetcher.stats["wire_bytes"]
+        decoded_bytes = fetcher.stats["decoded_bytes"]
+        page = yield fetcher.get_page(self.url + "compressed/" + encoding)
+        self.assertEqual(page.body, _Compressed.body)
+        wire_bytes = fetcher.stats["wire_bytes"] - wire_bytes
+        decoded_bytes = fetcher.stats["decoded_bytes"] - decoded_bytes
+        self.assertEqual(decoded_bytes, len(_Compressed.body))
+        self.assertTrue(wire_bytes < decoded_bytes / 10)
+
+    def test_gzip(self):
+        return self._check_compressed("gzip")
+
+    def test_deflate(self):
+        return self._check_compressed("deflate")
+
+    @defer.inlineCallbacks
+    def test_range(self):
+        url = self.url + "ranged/"
+        page = yield fetcher.get_page(url)
+        self.assertEqual(page.offset, 0)
+        offset = 1000
+        checksum = page.get_checksum(offset)
+        page = yield fetcher.get_page(
+            url, offset=offset, checksum=checksum)
+        self.assertEqual(page.offset, offset - fetcher.RANGE_CHECK_SIZE)
+        self.assertEqual(page.body, _Ranged.body[page.offset:])
+        self.assertEqual(page.get_checksum(offset), checksum)
+        self.assertIsNone(page.get_checksum(offset - 1))
+
+    @defer.inlineCallbacks
+    def test_range_prefix_changed(self):
+        page = yield fetcher.get_page(
+            self.url + "ranged/", offset=1000, checksum=0)
+        self.assertEqual(page.offset, 0)
+        self.assertEqual(page.body, _Ranged.body)
+
+    @defer.inlineCallbacks
+    def test_range_not_supported(self):
+        page = yield fetcher.get_page(
+            self.url + "ranged/ignore", offset=1000, checksum=0)
+        self.assertEqual(page.offset, 0)
+        self.assertEqual(page.body, _Ranged.body)
+
+    @defer.inlineCallbacks
+    def test_range_not_satisfiable(self):
+        offset = len(_Ranged.body) + 1000
+        page = yield fetcher.get_page(
+            self.url + "ranged/", offset=offset, checksum=0)
+        self.assertEqual(page.offset, 0)
+        self.assertEqual(page.body, _Ranged.body)
+
+    @defer.inlineCallbacks
+    def test_stream(self):
+        chunks = []
+        offsets = []
+        def stream(offset):
+            offsets.append(offset)
+            return chunks.append
+        self.patch(fetcher, "STREAM_KEEP_SIZE", 100)
+        url = self.url + "ranged/"
+        page = yield fetcher.get_page(url, stream=stream)
+        self.assertEqual(offsets, [0])
+        self.assertEqual("".join(chunks), _Ranged.body)
+        self.assertTrue(len(page.body) >= 100)
+        self.assertEqual(page.body, _Ranged.body[page.offset:])
+        # Tail and the chunk before it
+        offset = len(_Ranged.body) - 10
+        checksum = page.get_checksum(offset)
+        del chunks[:]
+        page = yield fetcher.get_page(
+            url, offset=offset, checksum=checksum, stream=stream)
+        start = offset - fetcher.RANGE_CHECK_SIZE
+        self.assertEqual(offsets, [0, start])
+        self.assertEqual("".join(chunks), _Ranged.body[start:])
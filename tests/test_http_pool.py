@@ -0,0 +1,109 @@
+from twisted.internet import defer, reactor, protocol
+from twisted.trial.unittest import TestCase
+from twisted.web import server, resource
+from http_pool import HTTPConnectionPool
+
+
+class _Page(resource.Resource):
+
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader("Last-Modified", "Sat, 01 Jan 2011 00:00:00 GMT")
+        return "page " + request.path
+
+    def render_HEAD(self, request):
+        return self.render_GET(request)
+
+
+class _CountingSite(server.Site):
+
+    connections = 0
+
+    def buildProtocol(self, addr):
+        self.connections += 1
+        return server.Site.buildProtocol(self, addr)
+
+
+class _Stalled(protocol.Protocol):
+    """Sends the beginning of the body without length and
+    stalls.
+    """
+
+    def dataReceived(self, data):
+        self.transport.write("HTTP/1.1 200 OK\r\n\r\n<html>partial")
+
+
+class _Receiver(object):
+    """Refuses the body."""
+
+    def start(self, response):
+        pass
+
+    def write(self, data):
+        raise ValueError(data)
+
+
+class TestHTTPConnectionPool(TestCase):
+
+    def setUp(self):
+        self.site = _CountingSite(_Page())
+        self.port = reactor.listenTCP(0, self.site, interface="127.0.0.1")
+        self.url = "http://127.0.0.1:%d/" % self.port.getHost().port
+        self.pool = HTTPConnectionPool(max_connections=2, idle_timeout=10)
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        yield self.pool.close_cached_connections()
+        yield self.port.stopListening()
+
+    @defer.inlineCallbacks
+    def test_reuse_connection(self):
+        response = yield self.pool.request("HEAD", self.url + "a")
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.body, "")
+        self.assertEqual(
+            response.get_header("Last-Modified"),
+            "Sat, 01 Jan 2011 00:00:00 GMT")
+        response = yield self.pool.request("GET", self.url + "b")
+        self.assertEqual(response.body, "page /b")
+        self.assertEqual(self.site.connections, 1)
+
+    @defer.inlineCallbacks
+    def test_max_connections(self):
+        results = yield defer.gatherResults([
+            self.pool.request("GET", self.url + str(i))
+            for i in range(10)])
+        self.assertEqual(
+            [r.body for r in results],
+            ["page /%d" % i for i in range(10)])
+        self.assertEqual(self.site.connections, 2)
+        self.assertEqual(self.pool.get_info().values(), [(2, 2, 0)])
+
+    @defer.inlineCallbacks
+    def test_closed_idle_connection(self):
+        yield self.pool.request("GET", self.url)
+        yield self.pool.close_cached_connections()
+        self.assertEqual(self.pool.get_info().values(), [(0, 0, 0)])
+        response = yield self.pool.request("GET", self.url)
+        self.assertEqual(response.body, "page /")
+        self.assertEqual(self.site.connections, 2)
+
+    @defer.inlineCallbacks
+    def test_timeout_without_length(self):
+        factory = protocol.ServerFactory()
+        factory.protocol = _Stalled
+        port = reactor.listenTCP(0, factory, interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        url = "http://127.0.0.1:%d/" % port.getHost().port
+        d = self.pool.request("GET", url, timeout=0.1)
+        yield self.assertFailure(d, defer.TimeoutError)
+
+    @defer.inlineCallbacks
+    def test_receiver_error(self):
+        d = self.pool.request("GET", self.url, receiver=_Receiver())
+        yield self.assertFailure(d, ValueError)
+        # Connection with the rest of the body isn't reused.
+        response = yield self.pool.request("GET", self.url)
+        self.assertEqual(response.body, "page /")
+        self.assertEqual(self.site.connections, 2)
@@ -0,0 +1,22 @@
+from parsers.iichan_ru import IichanRu
+from parsers.wakaba import Wakaba
+from twisted.trial.unittest import TestCase
+from tests.test_wakaba import get_fixture
+
+
+class TestIichanRu(TestCase):
+
+    def test_board(self):
+        # Same posts as wakaba_board.html, but every thread
+        # is wrapped in div.
+        task = {
+            "type": "board",
+            "host": "nyak.ru",
+            "url": "http://nyak.ru/b/",
+        }
+        res = IichanRu().do_task(
+            dict(task, _data=get_fixture("iichan_ru_board.html")))
+        expected = Wakaba().do_task(
+            dict(task, _data=get_fixture("wakaba_board.html")))
+        self.assertEqual(len(res["threads"]), 4)
+        self.assertEqual(res, expected)
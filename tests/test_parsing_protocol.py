@@ -0,0 +1,167 @@
+from twisted.internet import error, task
+from twisted.python import failure
+from twisted.trial.unittest import TestCase
+from parsing_protocol import ParsingProtocol
+from pipe_protocol import PipeProtocol, pack_records
+
+
+class _ProcessTransport(object):
+    """Worker process which dies of any signal."""
+
+    def __init__(self, proto):
+        self.proto = proto
+        self.written = []
+        self.signals = []
+        self.ended = False
+
+    def writeSequence(self, seq):
+        self.written.extend(seq)
+
+    def signalProcess(self, signal):
+        if self.ended:
+            raise error.ProcessExitedAlready()
+        self.signals.append(signal)
+        self.end(error.ProcessTerminated(signal=signal))
+
+    def end(self, reason):
+        self.ended = True
+        self.proto.processEnded(failure.Failure(reason))
+
+
+class _Xmpp(object):
+
+    def __init__(self):
+        self.reports = []
+
+    def send_message(self, to, from_, body):
+        self.reports.append(body)
+
+
+class _ParsingProtocol(ParsingProtocol):
+    """Spawns fake worker processes."""
+
+    def __init__(self, *args, **kwargs):
+        ParsingProtocol.__init__(self, *args, **kwargs)
+        self.processes = []
+
+    def start(self):
+        self._respawn = None
+        process = _ProcessTransport(self)
+        self.processes.append(process)
+        self.makeConnection(process)
+
+
+class TestParsingProtocol(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.xmpp = _Xmpp()
+        self.proto = _ParsingProtocol(self.xmpp, self.clock)
+        self.proto.start()
+        self.results = []
+
+    def _parse(self, data="page"):
+        self.proto.parse({}, data).addCallback(self.results.append)
+
+    def _answer(self, task_id, **res):
+        res["_id"] = task_id
+        self.proto.outReceived(
+            "".join(PipeProtocol().encode(*pack_records(res))))
+
+    def _received(self, process):
+        return PipeProtocol().decode("".join(process.written))
+
+    def _crash(self):
+        self.proto.processes[-1].end(error.ProcessTerminated(exitCode=1))
+
+    def _respawn_delay(self):
+        respawn, = self.clock.getDelayedCalls()
+        return respawn.getTime() - self.clock.seconds()
+
+    def test_crash(self):
+        self._parse()
+        self._parse()
+        self._answer(1, last=1)
+        self._crash()
+        self.assertEqual(self.results, [
+            {"_id": 1, "last": 1},
+            {"_error": True, "_id": 2}])
+        self.assertFalse(self.proto.running)
+        self.assertEqual(self.proto.restarts, 1)
+        self.assertEqual(len(self.xmpp.reports), 1)
+        self.assertEqual(self.proto.get_info()[0], 0)
+        # Tasks wait for the respawned worker; failed ones
+        # aren't re-dispatched.
+        self._parse("page3")
+        self.clock.advance(self._respawn_delay())
+        self.assertTrue(self.proto.running)
+        process = self.proto.processes[-1]
+        self.assertEqual(self._received(process), [({"_id": 3}, "page3")])
+        self._answer(3)
+        self.assertEqual(self.results[-1], {"_id": 3})
+
+    def test_respawn_backoff(self):
+        delays = []
+        for i in range(8):
+            self._crash()
+            delays.append(self._respawn_delay())
+            self.clock.advance(delays[-1])
+        self.assertEqual(delays, [1, 2, 4, 8, 16, 32, 60, 60])
+        self.assertEqual(len(self.proto.processes), 9)
+        # Worker which returns results is healthy again.
+        self._parse()
+        self._answer(1)
+        self._crash()
+        self.assertEqual(self._respawn_delay(), ParsingProtocol.RESPAWN_DELAY)
+
+    def test_deadline(self):
+        process = self.proto.processes[-1]
+        self._parse()
+        self._parse()
+        self.clock.advance(ParsingProtocol.PARSE_TIMEOUT - 1)
+        # Result restarts deadline of the next task.
+        self._answer(1)
+        self.clock.advance(ParsingProtocol.PARSE_TIMEOUT - 1)
+        self.assertEqual(process.signals, [])
+        self.clock.advance(1)
+        self.assertEqual(process.signals, ["KILL"])
+        self.assertEqual(
+            self.results, [{"_id": 1}, {"_error": True, "_id": 2}])
+        # Deadline of the stream starts when it's finished.
+        self.clock.advance(self._respawn_delay())
+        process = self.proto.processes[-1]
+        stream = self.proto.parse_stream({})
+        stream.write("page")
+        self.clock.advance(ParsingProtocol.PARSE_TIMEOUT * 2)
+        stream.finish().addCallback(self.results.append)
+        self.clock.advance(ParsingProtocol.PARSE_TIMEOUT)
+        self.assertEqual(process.signals, ["KILL"])
+        self.assertEqual(self.results[-1], {"_error": True, "_id": 3})
+
+    def test_abort_finished_stream(self):
+        process = self.proto.processes[-1]
+        stream = self.proto.parse_stream({})
+        stream.finish().addCallback(self.results.append)
+        stream.abort()
+        self.assertEqual(self.proto.get_info()[0], 0)
+        self._parse()
+        # Late result of the aborted stream is dropped.
+        self._answer(1)
+        self._answer(2)
+        self.assertEqual(self.results, [{"_id": 2}])
+        self.clock.advance(ParsingProtocol.PARSE_TIMEOUT)
+        self.assertEqual(process.signals, [])
+
+    def test_stop(self):
+        self._parse()
+        self.proto.stop()
+        self.assertEqual(self.results, [{"_error": True, "_id": 1}])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.xmpp.reports, [])
+        # Worker is stopped while waiting for respawn.
+        self.proto = _ParsingProtocol(self.xmpp, self.clock)
+        self.proto.start()
+        self._crash()
+        self.proto.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(len(self.proto.processes), 1)
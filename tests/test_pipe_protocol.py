@@ -0,0 +1,64 @@
+from twisted.trial.unittest import TestCase
+from pipe_protocol import PipeProtocol, pack_records, unpack_records
+
+
+class TestPipeProtocol(TestCase):
+
+    def setUp(self):
+        self.proto = PipeProtocol()
+
+    def _encode(self, packets):
+        return "".join([
+            "".join(self.proto.encode(message, payload))
+            for message, payload in packets])
+
+    def test_roundtrip(self):
+        packets = [
+            ({"_id": 1}, "packet"),
+            ({"_id": 2, "last": None}, ""),
+            ({"updates": [[u"\u043d\u044f", u"<span/>"]]}, ""),
+            ({}, "\x00\xff" * 100),
+        ]
+        data = self._encode(packets)
+        self.assertEqual(self.proto.decode(data), packets)
+        self.assertEqual(self.proto.decode(""), [])
+
+    def test_split(self):
+        packets = [({"n": 1}, "nyak"), ({}, "x" * 1000), ({"n": 3}, "")]
+        data = self._encode(packets)
+        decoded = []
+        for char in data:
+            decoded.extend(self.proto.decode(char))
+        self.assertEqual(decoded, packets)
+        self.assertEqual(self.proto._chunks, [])
+        # Reads with whole packets and parts of the others.
+        for size in (3, 7, 100, 1003):
+            decoded = []
+            for i in xrange(0, len(data), size):
+                decoded.extend(self.proto.decode(data[i:i+size]))
+            self.assertEqual(decoded, packets)
+
+    def test_payload_not_copied(self):
+        payload = "x" * 1000
+        self.assertIs(self.proto.encode({}, payload)[1], payload)
+
+
+class TestRecords(TestCase):
+
+    def test_roundtrip(self):
+        result = {
+            "_id": 1, "last": 3,
+            "updates": [{"id": "101", "body": [(None, [("br",)])]}],
+            "threads": [(u"\u043d\u044f", u"<b/>"), ()],
+        }
+        message, payload = pack_records(result)
+        self.assertEqual(
+            sorted(message["_records"]), ["threads", "updates"])
+        self.assertNotIn("updates", message)
+        self.assertEqual(unpack_records(message, payload), result)
+
+    def test_no_records(self):
+        result = {"_id": 1, "updates": []}
+        message, payload = pack_records(result)
+        self.assertEqual(payload, "")
+        self.assertEqual(unpack_records(message, payload), result)
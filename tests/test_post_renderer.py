@@ -0,0 +1,89 @@
+from lxml import etree
+from twisted.trial.unittest import TestCase
+from post_renderer import PostRenderer, RenderedPost, MergedPosts, \
+    merge_posts, escape, escape_attr
+
+
+class TestPostRenderer(TestCase):
+
+    def _post(self, **kwargs):
+        post = {
+            "url": "http://x/#101", "title": "", "author_name": u"Name", "author_email": "",
+            "trip_text": "", "trip_email": "", "date": u"Mon",
+            "id": "101", "img_src": "", "body": [],
+        }
+        post.update(kwargs)
+        return post
+
+    def test_escape(self):
+        s = u"a&b<c>d\"e'f\r\ng\th\U0001F600"
+        node = etree.Element("span", href=s)
+        node.text = s
+        self.assertEqual(
+            etree.tostring(node, encoding=unicode),
+            u'<span href="%s">%s</span>' % (escape_attr(s), escape(s)))
+
+    def test_body(self):
+        renderer = PostRenderer()
+        body = [
+            (None, [("text", u"a"), ("br",), ("strong", u"<b>"),
+                    ("plain", u"hidden"), ("text", u" end")]),
+            ("quote", [("link", u">>1", u"http://x/?a&b")]),
+            ("pre", []),
+        ]
+        text = renderer.render_body_text(body)
+        xhtml = renderer.render_body_xhtml(body)
+        self.assertEqual(text, u"a\n*<b>*hidden end\n\n>>1\n\n")
+        self.assertEqual(xhtml, (
+            u'<span><span><br/><br/>a<br/>'
+            u'<span style="font-weight: bold;">&lt;b&gt;</span> end</span>'
+            u'<span style="color: #789922;"><br/><br/>'
+            u'<a href="http://x/?a&amp;b">&gt;&gt;1</a></span>'
+            u'<span style="font-family: monospace;"><br/><br/></span>'
+            u'</span>'))
+        self.assertEqual(renderer.render_body_text([]), u"")
+        self.assertEqual(renderer.render_body_xhtml([]), u"<span/>")
+
+    def test_invalid_chars(self):
+        post = self._post(body=[(None, [("text", u"a\x01")])])
+        self.assertRaises(
+            ValueError, PostRenderer().render_post, post)
+
+    def test_custom_templates(self):
+        class Renderer(PostRenderer):
+            AUTHOR = u"<b>%s</b>"
+        text, xhtml = Renderer().render_post(
+            self._post(author_email=u"mailto:a"))
+        self.assertEqual(text, u"http://x/#101\nName <mailto:a> Mon No.101")
+        self.assertEqual(xhtml, (
+            u'<span><br/><b><a href="mailto:a">Name</a></b> Mon '
+            u'<a href="http://x/#101">No.101</a><span/></span>'))
+
+    def test_rendered_post(self):
+        renderer = PostRenderer()
+        post = self._post()
+        rendered = RenderedPost(renderer, post, show_images=False)
+        self.assertEqual(rendered.text, renderer.render_text(post))
+        self.assertEqual(rendered.xhtml, renderer.render_xhtml(post, False))
+        self.assertRaises(
+            ValueError, RenderedPost, renderer, self._post(title=u"\x01"))
+
+    def test_merge_posts(self):
+        renderer = PostRenderer()
+        posts = [
+            RenderedPost(renderer, self._post(id=str(i)))
+            for i in range(101, 106)]
+        size = len(posts[0].text) + len(posts[0].xhtml)
+        merged = merge_posts(posts, size * 2)
+        self.assertEqual(
+            [getattr(m, "posts", None) for m in merged],
+            [posts[:2], posts[2:4], None])
+        self.assertIs(merged[2], posts[4])
+        self.assertEqual(merged[0].text, u"%s\n\n%s" % (
+            posts[0].text, posts[1].text))
+        self.assertEqual(merged[0].xhtml, u"%s<br/>%s" % (
+            posts[0].xhtml, posts[1].xhtml))
+        # Too long post is sent alone.
+        merged = merge_posts(posts[:2], size - 1)
+        self.assertEqual(merged, posts[:2])
+        self.assertIsInstance(merge_posts(posts, size * 10)[0], MergedPosts)
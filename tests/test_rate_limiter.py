@@ -0,0 +1,55 @@
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+from rate_limiter import RateLimiter
+
+
+class TestRateLimiter(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.limiter = RateLimiter(rate=1/3.0, burst=1, clock=self.clock)
+        self.released = []
+
+    def _wait(self, name, host="nyak.ru", level=1):
+        d = self.limiter.wait(host, level)
+        d.addCallback(lambda _: self.released.append(name))
+
+    def test_fifo(self):
+        for i in range(4):
+            self._wait(i)
+        self.assertEqual(self.released, [0])
+        self.clock.advance(2.9)
+        self.assertEqual(self.released, [0])
+        self.clock.advance(0.1)
+        self.assertEqual(self.released, [0, 1])
+        self.clock.pump([3, 3])
+        self.assertEqual(self.released, [0, 1, 2, 3])
+        # Only one timer per lane.
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_levels_and_hosts(self):
+        self._wait("a1")
+        self._wait("a2", level=2)
+        self._wait("b1", host="example.com")
+        self._wait("a1-2")
+        self.assertEqual(self.released, ["a1", "a2", "b1"])
+        self.clock.advance(3)
+        self.assertEqual(self.released, ["a1", "a2", "b1", "a1-2"])
+
+    def test_burst(self):
+        self.limiter.configure("nyak.ru", rate=1, burst=3)
+        for i in range(5):
+            self._wait(i)
+        self.assertEqual(self.released, [0, 1, 2])
+        self.clock.advance(1)
+        self.assertEqual(self.released, [0, 1, 2, 3])
+        self.clock.advance(1)
+        self.assertEqual(self.released, [0, 1, 2, 3, 4])
+
+    def test_idle_lanes_dropped(self):
+        for i in range(3):
+            self._wait(i, host="host%d" % i)
+        self.assertEqual(len(self.limiter.get_info()), 3)
+        self.clock.advance(3)
+        self.assertEqual(self.limiter.get_info(), {})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
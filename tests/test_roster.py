@@ -0,0 +1,68 @@
+from twisted.trial.unittest import TestCase
+from roster import Roster
+
+
+class TestRoster(TestCase):
+
+    def setUp(self):
+        self.roster = Roster()
+        self.available = []
+        self.roster.add_watcher(
+            lambda user_jid, our_jid:
+                self.available.append((user_jid, our_jid)))
+
+    def test_resources(self):
+        roster = self.roster
+        self.assertIs(roster.is_available("u@x.org", "t@gate"), None)
+        self.assertTrue(roster.update("u@x.org/a", "t@gate", True))
+        self.assertFalse(roster.update("u@x.org/b", "t@gate", True))
+        self.assertEqual(self.available, [("u@x.org", "t@gate")])
+        self.assertFalse(roster.update("u@x.org/a", "t@gate", False))
+        self.assertTrue(roster.is_available("u@x.org", "t@gate"))
+        self.assertTrue(roster.update("u@x.org/b", "t@gate", False))
+        self.assertIs(roster.is_available("u@x.org", "t@gate"), False)
+        # Bare jid is every resource.
+        roster.update("u@x.org/a", "t@gate", True)
+        roster.update("u@x.org/b", "t@gate", True)
+        self.assertTrue(roster.update("u@x.org", "t@gate", False))
+        self.assertIs(roster.is_available("u@x.org", "t@gate"), False)
+        self.assertEqual(len(self.available), 2)
+
+    def test_our_jids(self):
+        roster = self.roster
+        roster.update("u@x.org/a", "t1@gate", True)
+        roster.update("u@x.org/a", "t2@gate", False)
+        self.assertTrue(roster.is_available("u@x.org", "t1@gate"))
+        self.assertIs(roster.is_available("u@x.org", "t2@gate"), False)
+        # Unknown pair falls back to the other our jids.
+        self.assertTrue(roster.is_available("u@x.org", "t3@gate"))
+        self.assertTrue(roster.is_available("u@x.org"))
+        roster.update("u@x.org/a", "t1@gate", False)
+        self.assertIs(roster.is_available("u@x.org", "t3@gate"), False)
+        self.assertEqual(
+            roster.get_info(), {"users": 1, "online": 0, "offline": 1})
+
+    def test_load(self):
+        roster = self.roster
+        roster.update("u1@x.org/a", "t@gate", True)
+        roster.load([
+            ("u1@x.org", "t@gate", False),
+            ("u2@x.org", "t@gate", False),
+            ("u3@x.org", "t@gate", True)])
+        self.assertTrue(roster.is_available("u1@x.org", "t@gate"))
+        self.assertIs(roster.is_available("u2@x.org", "t@gate"), False)
+        self.assertEqual(len(roster.get_pairs()), 3)
+        # First presence replaces saved state.
+        self.assertTrue(roster.update("u2@x.org/a", "t@gate", True))
+        self.assertFalse(roster.update("u3@x.org/a", "t@gate", True))
+        self.assertEqual(
+            self.available,
+            [("u1@x.org", "t@gate"), ("u2@x.org", "t@gate")])
+
+    def test_split(self):
+        roster = self.roster
+        roster.update("u1@x.org/a", "t@gate", True)
+        roster.update("u2@x.org/a", "t@gate", False)
+        self.assertEqual(
+            roster.split(["u1@x.org", "u2@x.org", "u3@x.org"], "t@gate"),
+            (["u1@x.org", "u3@x.org"], ["u2@x.org"]))
@@ -0,0 +1,43 @@
+from twisted.trial.unittest import TestCase
+from scheduler import Scheduler, next_interval
+
+
+class TestScheduler(TestCase):
+
+    def test_pop_due(self):
+        s = Scheduler()
+        s.add("c", 30)
+        s.add("a", 10)
+        s.add("b", 20)
+        self.assertEqual(len(s), 3)
+        self.assertEqual(s.next_due(), 10)
+        self.assertEqual(s.pop_due(5), [])
+        self.assertEqual(s.pop_due(20), ["a", "b"])
+        self.assertNotIn("a", s)
+        self.assertIn("c", s)
+        self.assertEqual(s.next_due(), 30)
+
+    def test_reschedule(self):
+        s = Scheduler()
+        s.add("a", 10)
+        s.add("b", 20)
+        s.add("a", 30)
+        self.assertEqual(len(s), 2)
+        self.assertEqual(s.pop_due(25), ["b"])
+        self.assertEqual(s.pop_due(35), ["a"])
+        self.assertIsNone(s.next_due())
+
+    def test_remove(self):
+        s = Scheduler()
+        s.add("a", 10)
+        s.add("b", 20)
+        s.remove("a")
+        s.remove("nyak")
+        self.assertEqual(s.next_due(), 20)
+        self.assertEqual(s.pop_due(100), ["b"])
+
+    def test_next_interval(self):
+        self.assertEqual(next_interval(120, True, 30, 1800), 60)
+        self.assertEqual(next_interval(40, True, 30, 1800), 30)
+        self.assertEqual(next_interval(120, False, 30, 1800), 240)
+        self.assertEqual(next_interval(1000, False, 30, 1800), 1800)
@@ -0,0 +1,44 @@
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+from single_flight import SingleFlight
+
+
+class TestSingleFlight(TestCase):
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.calls = []
+
+    def _call(self, value):
+        d = defer.Deferred()
+        self.calls.append((value, d))
+        return d
+
+    def test_shared(self):
+        results = []
+        for i in range(3):
+            d = self.flights.run("nyak", self._call, i)
+            d.addCallback(results.append)
+        d = self.flights.run("desu", self._call, 3)
+        d.addCallback(results.append)
+        self.assertEqual([v for v, _ in self.calls], [0, 3])
+        self.calls[0][1].callback("page")
+        self.assertEqual(results, ["page", "page", "page"])
+        self.assertNotIn("nyak", self.flights)
+        # Finished call isn't shared.
+        self.flights.run("nyak", self._call, 4)
+        self.assertEqual(len(self.calls), 3)
+
+    def test_failure(self):
+        d1 = self.flights.run("nyak", self._call, 0)
+        d2 = self.flights.run("nyak", self._call, 1)
+        self.calls[0][1].errback(ValueError())
+        self.assertFailure(d1, ValueError)
+        self.assertFailure(d2, ValueError)
+        return defer.gatherResults([d1, d2])
+
+    def test_sync_result(self):
+        d = self.flights.run("nyak", lambda: "page")
+        d.addCallback(self.assertEqual, "page")
+        self.assertNotIn("nyak", self.flights)
+        return d
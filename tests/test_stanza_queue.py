@@ -0,0 +1,83 @@
+from twisted.internet import task
+from twisted.trial.unittest import TestCase
+from stanza_queue import StanzaQueue, REPLY, BULK, BACKGROUND
+
+
+class _Transport(object):
+
+    def __init__(self):
+        self.producer = None
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+
+class TestStanzaQueue(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.sent = []
+        self.queue = StanzaQueue(
+            self.sent.append, rate=1, burst=2, clock=self.clock)
+        self.transport = _Transport()
+
+    def test_held_until_attached(self):
+        self.queue.put("a", "nyak.ru")
+        self.assertEqual(self.sent, [])
+        self.queue.attach(self.transport)
+        self.assertEqual(self.sent, ["a"])
+        self.assertIs(self.transport.producer, self.queue)
+        self.assertEqual(self.transport.bufferSize, 64*1024)
+
+    def test_domain_pacing(self):
+        self.queue.attach(self.transport)
+        for i in range(4):
+            self.queue.put("a%d" % i, "nyak.ru")
+        self.queue.put("b", "example.com")
+        self.assertEqual(self.sent, ["a0", "a1", "b"])
+        self.assertEqual(self.queue.get_info()["pacing"], 2)
+        self.clock.advance(1)
+        self.assertEqual(self.sent, ["a0", "a1", "b", "a2"])
+        self.clock.advance(1)
+        self.assertEqual(self.sent[-1], "a3")
+
+    def test_background_tokens(self):
+        self.queue.attach(self.transport)
+        for i in range(3):
+            self.queue.put("p%d" % i, "nyak.ru", BACKGROUND)
+        # Background stanzas don't delay bulk ones.
+        self.queue.put("a", "nyak.ru")
+        self.assertEqual(self.sent, ["p0", "p1", "a"])
+        self.clock.advance(1)
+        self.assertEqual(self.sent[-1], "p2")
+
+    def test_backpressure_and_priority(self):
+        self.queue.attach(self.transport)
+        self.queue.pauseProducing()
+        self.queue.put("background", "nyak.ru", BACKGROUND)
+        self.queue.put("bulk", "nyak.ru")
+        self.queue.put("reply", "nyak.ru", REPLY)
+        info = self.queue.get_info()
+        self.assertEqual(
+            (info["replies"], info["bulk"], info["background"]), (1, 1, 1))
+        self.assertEqual(self.sent, [])
+        self.queue.resumeProducing()
+        self.assertEqual(self.sent, ["reply", "bulk", "background"])
+        # Transport pauses queue in the middle of flush.
+        self.queue.pauseProducing()
+        self.queue.put("b1", "example.com")
+        self.queue.put("b2", "example.com")
+        self.queue._send = lambda s: (
+            self.sent.append(s), self.queue.pauseProducing())
+        self.queue.resumeProducing()
+        self.assertEqual(self.sent[3:], ["b1"])
+        self.assertEqual(self.queue.get_info()["pauses"], 3)
+
+    def test_detached(self):
+        self.queue.attach(self.transport)
+        self.queue.stopProducing()
+        self.queue.put("a", "nyak.ru", BULK)
+        self.queue.resumeProducing()
+        self.assertEqual(self.sent, [])
+        self.queue.attach(_Transport())
+        self.assertEqual(self.sent, ["a"])
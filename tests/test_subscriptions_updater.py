@@ -0,0 +1,114 @@
+from twisted.internet import defer, error, task
+from twisted.trial.unittest import TestCase
+from plugins import subscriptions_updater
+from plugins.subscriptions_updater import SubscriptionsUpdater
+from fetcher import NotModified
+import utils
+
+
+class _Stream(object):
+    """Parsing stream whose result never comes."""
+
+    def __init__(self):
+        self.chunks = []
+        self.aborted = False
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def finish(self):
+        return defer.Deferred()
+
+    def abort(self):
+        self.aborted = True
+
+
+class _Worker(object):
+
+    def __init__(self):
+        self.streams = []
+
+    def parse_stream(self, task):
+        self.streams.append(_Stream())
+        return self.streams[-1]
+
+
+class _Fetch(object):
+    """get_page which doesn't finish until told to."""
+
+    def __init__(self):
+        self.stream = None
+        self.calls = []
+
+    def __call__(self, url, last_modified, etag, offset, checksum, stream):
+        self.stream = stream
+        self.calls.append(defer.Deferred())
+        return self.calls[-1]
+
+
+class TestSubscriptionsUpdater(TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.worker = _Worker()
+        self.updater = SubscriptionsUpdater(
+            [], None, self.worker, clock=self.clock)
+        self.fetch = _Fetch()
+        self.patch(subscriptions_updater, "get_page", self.fetch)
+
+    def test_fetch_timeout(self):
+        timeout = SubscriptionsUpdater.PROCESS_TIMEOUT
+        slot = defer.Deferred()
+        self.patch(utils, "wait_for_host", lambda host: slot)
+        sub = {"url": "http://nyak.ru/b/res/1.html", "host": "nyak.ru"}
+        results = []
+        d = self.updater.fetch_page(sub, None, None, None, None)
+        d.addErrback(results.append)
+        # Waiting for the host's request slot isn't counted.
+        self.clock.advance(timeout * 2)
+        self.assertEqual(results, [])
+        slot.callback(None)
+        write = self.fetch.stream(0)
+        write("page")
+        self.clock.advance(timeout)
+        results.pop().trap(error.TimeoutError)
+        # Parsing is abandoned.
+        stream, = self.worker.streams
+        self.assertEqual(stream.chunks, ["page"])
+        self.assertTrue(stream.aborted)
+        # Late chunks fail the request instead of starting
+        # new parsing tasks.
+        self.assertRaises(defer.CancelledError, write, "tail")
+        self.assertRaises(defer.CancelledError, self.fetch.stream, 0)
+        self.assertEqual(stream.chunks, ["page"])
+        self.assertEqual(len(self.worker.streams), 1)
+
+    def test_shared_fetch(self):
+        self.patch(utils, "wait_for_host", lambda host: defer.succeed(None))
+        sub = {
+            "url": "http://nyak.ru/b/res/1.html", "host": "nyak.ru",
+            "type": "thread_updates", "parser": "wakaba", "last": 1,
+            "last_modified": "Sat, 01 Jan 2011 00:00:00 GMT",
+        }
+        results = []
+        for i in range(2):
+            d = self.updater.process_page(sub.copy())
+            d.addCallback(results.append)
+        # Polls of the same state share the fetch.
+        d, = self.fetch.calls
+        d.errback(NotModified())
+        self.assertEqual(results, [False, False])
+        # Poll of the other state doesn't.
+        self.updater.process_page(dict(sub, last=2))
+        self.updater.process_page(sub.copy())
+        self.assertEqual(len(self.fetch.calls), 3)
+        for d in self.fetch.calls[1:]:
+            d.errback(NotModified())
+
+    def test_reload_config(self):
+        self.updater.reload_config([{"offline_delivery": "hold"}])
+        # Bad value is logged and previous policy is kept.
+        self.updater.reload_config([
+            {"offline_delivery": "drop", "min_interval": "60"}])
+        self.assertEqual(self.updater.offline_delivery, "hold")
+        self.assertEqual(self.updater.min_interval, 60)
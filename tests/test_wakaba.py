@@ -1,7 +1,21 @@
+import os
+import json
+from parsers import wakaba
 from parsers.wakaba import Wakaba
+from pipe_protocol import pack_records, unpack_records
 from twisted.trial.unittest import TestCase
 
 
+# Trial runs tests in its temp directory.
+FIXTURES_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def get_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), "rb") as f:
+        return f.read()
+
+
 class TestWakaba(TestCase):
 
     def setUp(self):
@@ -28,3 +42,159 @@ class TestWakaba(TestCase):
         self.assertEqual(get_username({"type": "nyak"}), "main")
         sub = {"type": "thread_updates", "url": "http://nyak.ru/b/res/1.html"}
         self.assertEqual(get_username(sub), "nyak.ru_b_1")
+
+    def _thread_task(self, data, **kwargs):
+        task = {
+            "type": "thread_updates",
+            "host": "nyak.ru",
+            "url": "http://nyak.ru/b/res/100.html",
+            "_data": data,
+        }
+        task.update(kwargs)
+        return task
+
+    def test_thread_updates(self):
+        data = get_fixture("wakaba_thread.html")
+        res = self.wakaba.do_task(self._thread_task(data))
+        self.assertEqual(res["last"], 103)
+        res = self.wakaba.do_task(self._thread_task(data, last=101))
+        self.assertEqual(res["last"], 103)
+        self.assertEqual(len(res["updates"]), 2)
+        self.assertEqual(
+            res["updates"][0]["url"], "http://nyak.ru/b/res/100.html#102")
+
+    def test_thread_updates_tail(self):
+        data = get_fixture("wakaba_thread.html")
+        res = self.wakaba.do_task(self._thread_task(data, last=101))
+        offset = res["offset"]
+        self.assertTrue(data[:offset].endswith("</table>"))
+        self.assertIn('<a name="103">', data[:offset])
+        self.assertNotIn('<a name="103">', data[offset:])
+        # Page tail which contains two new posts
+        base = data.find('<a name="101">')
+        base = data.find("</table>", base) + len("</table>")
+        res2 = self.wakaba.do_task(
+            self._thread_task(data[base:], last=101, _offset=base))
+        self.assertEqual(res2["last"], 103)
+        self.assertEqual(res2["updates"], res["updates"])
+        self.assertEqual(res2["offset"], offset)
+        # Page tail without new posts
+        res3 = self.wakaba.do_task(
+            self._thread_task(data[offset:], last=103, _offset=offset))
+        self.assertEqual(res3, {})
+
+    def test_thread_updates_known_tail(self):
+        data = get_fixture("wakaba_thread.html")
+        offset = data.find("</table>", data.find('id="reply103"'))
+        offset += len("</table>")
+        res = self.wakaba.do_task(self._thread_task(data, last=103))
+        self.assertEqual(res, {"offset": offset})
+        # Last known post was deleted; whole page is parsed.
+        data = data.replace('id="reply102"', 'id="reply1020"')
+        res = self.wakaba.do_task(self._thread_task(data, last=102))
+        self.assertEqual(res["last"], 103)
+        self.assertEqual(len(res["updates"]), 1)
+
+    def test_empty_inline_node(self):
+        data = get_fixture("wakaba_thread.html")
+        data = data.replace("<del>", "<del></del><del>")
+        res = self.wakaba.do_task(self._thread_task(data, last=101))
+        text, xhtml = self.wakaba.renderer.render_post(res["updates"][0])
+        self.assertIn("\n\n---", text)
+        self.assertIn(
+            '<span style="text-decoration: line-through;"></span>', xhtml)
+
+    def _stream_task(self, task, chunk_size=100):
+        data = task.pop("_data")
+        feeder = self.wakaba.start_task(task)
+        for i in xrange(0, len(data), chunk_size):
+            feeder.feed(data[i:i+chunk_size])
+        return feeder.close()
+
+    def test_thread_updates_stream(self):
+        data = get_fixture("wakaba_thread.html")
+        for kwargs in ({}, {"last": 100}, {"last": 102}, {"last": 103}):
+            task = self._thread_task(data, **kwargs)
+            res = self.wakaba.do_task(task.copy())
+            self.assertEqual(self._stream_task(task), res)
+        base = data.find('<a name="102">')
+        task = self._thread_task(data[base:], last=101, _offset=base)
+        res = self.wakaba.do_task(task.copy())
+        self.assertEqual(self._stream_task(task, 7), res)
+
+    def test_thread_updates_stream_known_tail(self):
+        data = get_fixture("wakaba_thread.html")
+        fed = []
+        base_scanner = wakaba._TailScanner
+        class Scanner(base_scanner):
+            def feed(self, data):
+                fed.append(data)
+                base_scanner.feed(self, data)
+        self.patch(wakaba, "_TailScanner", Scanner)
+        # Marker and table end are cut by chunks of any size.
+        for chunk_size in (5, 100, len(data)):
+            for last in (101, 103):
+                task = self._thread_task(data, last=last)
+                res = self.wakaba.do_task(task.copy())
+                del fed[:]
+                self.assertEqual(self._stream_task(task, chunk_size), res)
+                # Page is parsed only after the last known post.
+                tail = data.find("</table>", data.find('id="reply%d"' % last))
+                self.assertEqual("".join(fed), data[tail+len("</table>"):])
+        # Last known post was deleted; whole page is parsed.
+        data = data.replace('id="reply102"', 'id="reply1020"')
+        del fed[:]
+        res = self._stream_task(self._thread_task(data, last=102), 7)
+        self.assertEqual("".join(fed), data)
+        self.assertEqual(res["last"], 103)
+        self.assertEqual(len(res["updates"]), 1)
+
+    def test_board(self):
+        data = get_fixture("wakaba_board.html")
+        task = {
+            "type": "board",
+            "host": "nyak.ru",
+            "url": "http://nyak.ru/b/",
+            "_data": data,
+        }
+        res = self.wakaba.do_task(task)
+        separator, thr300, thr200, thr100 = res["threads"]
+        self.assertEqual(separator[0], self.wakaba.renderer.HR2)
+        self.assertTrue(thr300[0].startswith(
+            "http://nyak.ru/b/res/300.html\n"))
+        self.assertIn("http://nyak.ru/b/res/300.html#301\n", thr300[0])
+        self.assertTrue(thr200[0].startswith(
+            "http://nyak.ru/b/res/200.html\n"))
+        self.assertNotIn("#", thr200[0])
+        # Only the last reply is shown after omitted posts.
+        self.assertIn(u"/5 posts omitted./", thr100[0])
+        self.assertIn("http://nyak.ru/b/res/100.html#108\n", thr100[0])
+        self.assertNotIn("#107", thr100[0])
+        self.assertTrue(thr100[1].startswith(u"<span><br/>\u2500"))
+
+    def test_golden(self):
+        # Golden results were made by the old lxml tree
+        # renderer; template renderer must give the same.
+        golden = json.loads(get_fixture("wakaba_golden.json"))
+        for name, fixture, url, kwargs in (
+            ("thread", "wakaba_thread.html",
+             "http://nyak.ru/b/res/100.html",
+             {"type": "thread_updates", "last": 100}),
+            ("markup_thread", "wakaba_markup.html",
+             "http://nyak.ru/b/res/100.html",
+             {"type": "thread_updates", "last": 99}),
+            ("markup_board", "wakaba_markup.html",
+             "http://nyak.ru/b/", {"type": "board"}),
+            ("board", "wakaba_board.html",
+             "http://nyak.ru/b/", {"type": "board"}),
+        ):
+            task = dict(kwargs, host="nyak.ru", url=url,
+                        _data=get_fixture(fixture))
+            res = self.wakaba.do_task(task)
+            if "updates" in res:
+                # Records pass the pipe as marshal payload.
+                packed = unpack_records(*pack_records(res))
+                res["updates"] = map(
+                    self.wakaba.renderer.render_post, packed["updates"])
+            res = json.loads(json.dumps(res))
+            self.assertEqual(res, golden[name], name)
@@ -0,0 +1,50 @@
+from twisted.internet import defer
+from twisted.trial.unittest import TestCase
+from worker_pool import WorkerPool
+
+
+class _Worker(object):
+
+    def __init__(self, busy_time=0):
+        self.tasks = []
+        self.busy_time = busy_time
+        self.running = True
+
+    def get_info(self):
+        return len(self.tasks), self.busy_time
+
+    def parse(self, task, data):
+        d = defer.Deferred()
+        self.tasks.append((task, d))
+        return d
+
+    def parse_stream(self, task):
+        self.tasks.append((task, None))
+
+
+class TestWorkerPool(TestCase):
+
+    def test_least_loaded(self):
+        workers = [_Worker(), _Worker(), _Worker()]
+        pool = WorkerPool(workers)
+        for i in range(3):
+            pool.parse({"n": i}, "")
+        self.assertEqual([len(w.tasks) for w in workers], [1, 1, 1])
+        workers[1].tasks = []
+        pool.parse_stream({"n": 3})
+        self.assertEqual(workers[1].tasks, [({"n": 3}, None)])
+        self.assertEqual(pool.get_info(), [(1, 0), (1, 0), (1, 0)])
+
+    def test_busy_time(self):
+        workers = [_Worker(10), _Worker(5)]
+        pool = WorkerPool(workers)
+        pool.parse({}, "")
+        self.assertEqual([len(w.tasks) for w in workers], [0, 1])
+
+    def test_not_running(self):
+        workers = [_Worker(), _Worker()]
+        workers[0].running = False
+        pool = WorkerPool(workers)
+        pool.parse({}, "")
+        pool.parse({}, "")
+        self.assertEqual([len(w.tasks) for w in workers], [0, 2])
@@ -1,6 +1,8 @@
-import datetime
 from twisted.internet import defer, reactor
 from db_objects import *
+from deadline import timeout
+from rate_limiter import RateLimiter
+from single_flight import SingleFlight
 import config
 
 
@@ -52,19 +54,27 @@ def sleep(seconds):
     return d
 
 
-@defer.inlineCallbacks
+# Limits requests rate to every host; by default one
+# request per 3 seconds.
+host_limiter = RateLimiter(rate=1/3.0, burst=1)
+
+
 def wait_for_host(host, level=1):
-    """Wait if we used host less than several seconds ago."""
-    if not host in _hosts:
-        _hosts[host] = {}
-    while True:
-        now = datetime.datetime.utcnow()
-        seconds_ago = now - datetime.timedelta(seconds=3)
-        if (not level in _hosts[host] or
-            _hosts[host][level] <= seconds_ago):
-            _hosts[host][level] = now
-            break
-        else:
-            yield sleep(3)
+    """Wait for the host's request slot. Requests with
+    different levels don't wait each other.
+    """
+    return host_limiter.wait(host, level)
+
+
+# Fetches and parses of the same page which are made at the
+# same time. Key is (url, task type, last, last_modified,
+# etag, range offset): everything that shapes the request
+# and the result. So only new subscription checks share
+# with each other and polls share with polls of the same
+# subscription state; check and poll results differ.
+page_flights = SingleFlight()
+
 
-_hosts = {}
+def page_key(sub, last_modified=None, etag=None, offset=None):
+    return (sub["url"], sub["type"], sub.get("last"),
+            last_modified, etag, offset)
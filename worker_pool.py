@@ -0,0 +1,31 @@
+class WorkerPool(object):
+    """Pool of parsing workers with the same interface as
+    single worker. Every task goes to the least loaded
+    running one; ties are broken by total busy time.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def _choose(self):
+        return min(self.workers, key=lambda w: (not w.running, w.get_info()))
+
+    def parse(self, task, data):
+        return self._choose().parse(task, data)
+
+    def parse_stream(self, task):
+        return self._choose().parse_stream(task)
+
+    def get_info(self):
+        """Return list of (queue length, busy seconds)
+        for every worker.
+        """
+        return [worker.get_info() for worker in self.workers]
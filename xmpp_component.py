@@ -4,15 +4,32 @@ from twisted.words.xish import domish
 from twisted.words.protocols.jabber import component
 from db_objects import *
 from utils import get_domain, get_bare_jid, get_full_jid
+from stanza_queue import StanzaQueue, REPLY, BULK, BACKGROUND
+from roster import Roster
+from fanout import Fanout
 import config
 from plugins import command_handler
 
 
 class XMPPComponent(component.Service):
 
+    # Stanzas per second (and burst) to every destination
+    # server; faster sending gets us throttled.
+    DOMAIN_RATE = 10
+    DOMAIN_BURST = 50
+    # Bytes written to the stream but not yet accepted by
+    # the server.
+    MAX_BUFFER = 64 * 1024
+
     def __init__(self):
         self._requests = {}
         self._whitelist = []
+        self._queue = StanzaQueue(
+            self._write, self.DOMAIN_RATE, self.DOMAIN_BURST,
+            self.MAX_BUFFER)
+        self._fanout = Fanout(self._queue.put, config.component_jid)
+        self.roster = Roster()
+        self._roster_loaded = False
 
     def _log_data_in(self, buf):
         log.msg("RECV: %r" % buf)
@@ -28,6 +45,54 @@ class XMPPComponent(component.Service):
     def componentConnected(self, xmlstream):
         xmlstream.addObserver("/presence", self._on_presence)
         xmlstream.addObserver("/message[@type='chat']", self._on_message)
+        xmlstream.addObserver("/iq[@type='result']", self._fanout.on_iq)
+        xmlstream.addObserver("/iq[@type='error']", self._fanout.on_iq)
+        xmlstream.addObserver(
+            "/message[@type='error']", self._fanout.on_message_error)
+        self._queue.attach(xmlstream.transport)
+        d = self._probe_roster()
+        d.addErrback(log.err)
+
+    def componentDisconnected(self):
+        self._queue.detach()
+
+    def send(self, obj, priority=BULK):
+        """Queue stanza for sending. Command replies should
+        be sent with REPLY priority; they go before bulk
+        stanzas.
+        """
+        domain = get_domain(obj.getAttribute("to", ""))
+        self._queue.put(obj, domain, priority)
+
+    def _write(self, obj):
+        component.Service.send(self, obj)
+
+    def get_queue_info(self):
+        return self._queue.get_info()
+
+    def get_fanout_info(self):
+        return self._fanout.get_info()
+
+    @defer.inlineCallbacks
+    def _probe_roster(self):
+        """Load saved roster on startup and probe presence
+        of all known users since it could be changed while
+        we were offline. Probes go in background so they
+        don't delay updates.
+        """
+        if not self._roster_loaded:
+            entries = yield UserPresence.get_list()
+            self.roster.load([
+                (entry["jid"], entry["our_jid"], entry["available"])
+                for entry in entries])
+            self._roster_loaded = True
+        users = {}
+        for user_jid, our_jid in self.roster.get_pairs():
+            users.setdefault(our_jid, []).append(user_jid)
+        for our_jid, jids in users.iteritems():
+            self.send_fanout(
+                jids, self.presence(from_=our_jid, type_="probe"),
+                BACKGROUND)
 
     def is_filtered_jid(self, user_jid):
         if (self._whitelist and
@@ -37,9 +102,6 @@ class XMPPComponent(component.Service):
 
     @defer.inlineCallbacks
     def _on_presence(self, prs):
-        # TODO: Save subscriptions to the database and
-        # send appropriate presences to users when go
-        # online/offline (service restart).
         user_jid = get_bare_jid(prs["from"])
         if config.only_admin and user_jid != config.admin_jid:
             return
@@ -48,25 +110,38 @@ class XMPPComponent(component.Service):
         our_jid = get_bare_jid(prs["to"])
         our_full_jid = get_full_jid(our_jid)
         type_ = prs.getAttribute("type")
+        if type_ in (None, "unavailable", "error"):
+            yield self._update_roster(prs["from"], our_jid, type_)
         send_status = False
         if type_ == "subscribe":
             self.send_presence(
                 to=user_jid, from_=our_jid,
-                type_="subscribed")
+                type_="subscribed", priority=REPLY)
             if our_jid == config.main_jid:
                 self.send_presence(
                     to=user_jid, from_=our_jid,
-                    type_="subscribe")
+                    type_="subscribe", priority=REPLY)
                 is_exists = yield UserSettings(user_jid).is_exists()
                 if not is_exists:
                     self.send_message(
                         to=prs["from"],
                         from_=our_full_jid,
                         body=(u"Oh hai. Type 'help' (without quotes) "
-                               "for help and basic info."))
+                               "for help and basic info."),
+                        priority=REPLY)
             send_status = True
         if type_ == "probe" or send_status:
-            self.send_presence(to=prs["from"], from_=our_full_jid)
+            self.send_presence(
+                to=prs["from"], from_=our_full_jid, priority=REPLY)
+
+    def _update_roster(self, full_jid, our_jid, type_):
+        if type_ == "error":
+            # User's server can't deliver to any resource.
+            full_jid = get_bare_jid(full_jid)
+        available = type_ is None
+        if self.roster.update(full_jid, our_jid, available):
+            return UserPresence(
+                get_bare_jid(full_jid), our_jid).set_available(available)
 
     def _on_message(self, msg):
         user_jid = get_bare_jid(msg["from"])
@@ -103,18 +178,18 @@ class XMPPComponent(component.Service):
         if not reply: return
         if type(reply) is unicode:
             reply_msg.body.addContent(reply)
-            self.send(reply_msg)
+            self.send(reply_msg, REPLY)
         elif type(reply) is list:
             for text, xhtml in reply:
                 self.send_message(
                     to=reply_msg["to"], from_=reply_msg["from"],
-                    body=text, body_xhtml=xhtml)
+                    body=text, body_xhtml=xhtml, priority=REPLY)
 
     def _send_error_report(self, failure, reply_msg, msg):
         reply_msg.body.addContent(u"Sorry, error while handling the request "
                                    "was occured. We will try to fix it as "
                                    "soon as possible.")
-        self.send(reply_msg)
+        self.send(reply_msg, REPLY)
         report = (u"HANDLING XMPP REQUEST ERROR:\n\n"
                    "INPUT STANZA:\n%s\n\n"
                    "FAILURE:\n%s" % (msg.toXml(), failure))
@@ -133,10 +208,11 @@ class XMPPComponent(component.Service):
             del self._requests[user_jid]
 
     def message(self, to="", from_="", type_="chat", body="",
-                body_xhtml=""):
+                body_xhtml="", payload=None):
         """Create message stanza. Return instance of domish.Element.
         If body_xhtml is specified, create xhtml-im body and add
-        body_xhtml as raw xml into it.
+        body_xhtml as raw xml into it. Payload made by
+        message_payload is used instead of body and body_xhtml.
         """
         msg = domish.Element((None, "message"))
         if to:
@@ -144,6 +220,9 @@ class XMPPComponent(component.Service):
         if from_:
             msg["from"] = from_
         msg["type"] = type_
+        if payload is not None:
+            msg.addChild(payload)
+            return msg
         msg.addElement("body", content=body)
         if body_xhtml:
             xhtml = domish.Element(
@@ -155,8 +234,43 @@ class XMPPComponent(component.Service):
         return msg
 
     def send_message(self, *args, **kwargs):
+        priority = kwargs.pop("priority", BULK)
         msg = self.message(*args, **kwargs)
-        self.send(msg)
+        self.send(msg, priority)
+
+    def message_payload(self, body, body_xhtml=""):
+        """Return message children (body and xhtml-im body)
+        serialized once; payload could be shared by any
+        number of messages.
+        """
+        msg = self.message(body=body, body_xhtml=body_xhtml)
+        return domish.SerializedXML(
+            u"".join([child.toXml() for child in msg.children]))
+
+    def post_payload(self, post):
+        """Return message payload of the post
+        (post_renderer.RenderedPost). Payload is made only
+        once.
+        """
+        if post.payload is None:
+            post.payload = self.message_payload(post.text, post.xhtml)
+        return post.payload
+
+    def send_post(self, recipients, from_, post):
+        """Send post (post_renderer.RenderedPost) to every
+        recipient jid.
+        """
+        self.send_fanout(
+            recipients,
+            self.message(from_=from_, payload=self.post_payload(post)))
+
+    def send_fanout(self, recipients, stanza, priority=BULK):
+        """Send stanza (domish.Element without to attribute)
+        to every recipient jid. Stanza is serialized once;
+        messages go as multicast stanzas to servers which
+        support it (see fanout.Fanout).
+        """
+        self._fanout.send(recipients, stanza, priority)
 
     def presence(self, to="", from_="", type_=""):
         """Create presence stanza. Return instance of domish.Element."""
@@ -170,5 +284,6 @@ class XMPPComponent(component.Service):
         return prs
 
     def send_presence(self, *args, **kwargs):
+        priority = kwargs.pop("priority", BULK)
         prs = self.presence(*args, **kwargs)
-        self.send(prs)
+        self.send(prs, priority)